@@ -0,0 +1,179 @@
+from udptherbone.cobs import *
+
+def test_cobs_host():
+    import random
+    
+    assert cobs_encode(b"") == b"\x01\x00"
+    assert cobs_encode(b"\x00") == b"\x01\x01\x00"
+    assert cobs_encode(b"\x11\x22\x00\x33") == b"\x03\x11\x22\x02\x33\x00"
+    assert cobs_encode(bytes(range(1, 255))) == b"\xff" + bytes(range(1, 255)) + b"\x01\x00"
+    
+    for l in (0, 1, 253, 254, 255, 508, 600):
+        for _ in range(8):
+            d = bytes(random.choice([0, 0xc0, random.getrandbits(8)]) for _ in range(l))
+            e = cobs_encode(d)
+            # bounded overhead, no zeros but the delimiter
+            assert len(e) <= len(d) + (len(d) // 254) + 2
+            assert 0 not in e[:-1]
+            assert cobs_decode(e) == d
+
+def test_framer_sim():
+    from nmigen.back.pysim import Simulator, Passive
+    import random
+    
+    input = i = StreamSource(Layout([("data", 8, DIR_FANOUT)]), name="input")
+    framer = f = COBSFramer(input)
+
+    sim = Simulator(framer)
+    sim.add_clock(1e-6)
+    
+    pkts = [b"hello\x00world", b"\x00", bytes(random.getrandbits(8) | 1 for _ in range(300)), b"\x00\x00x\x00",
+            bytes(random.getrandbits(8) | 1 for _ in range(254)), bytes(random.getrandbits(8) for _ in range(64))]
+    
+    def transmit_proc():
+        yield
+        for pkt in pkts:
+            g = 0
+            while g < len(pkt):
+                yield i.data.eq(pkt[g])
+                yield i.sop.eq(g == 0)
+                yield i.eop.eq(g == len(pkt)-1)
+                yield i.valid.eq(1)
+                yield
+                if (yield f.sink.ready) == 1:
+                    g += 1
+        yield i.valid.eq(0)
+    
+    def receive_proc():
+        expected = b"".join(cobs_encode(pkt) for pkt in pkts)
+        data = bytearray()
+        while len(data) < len(expected):
+            ready = random.getrandbits(1)
+            yield f.source.ready.eq(ready)
+            yield
+            if ready and (yield f.source.valid) == 1:
+                data.append((yield f.source.data))
+        
+        assert list(map(hex, data)) == list(map(hex, expected))
+
+    sim.add_sync_process(transmit_proc)
+    sim.add_sync_process(receive_proc)
+    
+    with sim.write_vcd("cobs.vcd", "cobs.gtkw"):
+        sim.run()
+
+def test_unframer_sim():
+    from nmigen.back.pysim import Simulator, Passive
+    import random
+    
+    input = i = StreamSource(Layout([("data", 8, DIR_FANOUT)]), name="input", sop=False, eop=False)
+    framer = f = COBSUnframer(input)
+
+    sim = Simulator(framer)
+    sim.add_clock(1e-6)
+    
+    pkts = [bytes(random.getrandbits(8) for _ in range(64)), b"hello\x00world", b"\x00", 
+            bytes(random.getrandbits(8) | 1 for _ in range(300)), b"\x00\x00x\x00", bytes(random.getrandbits(8) | 1 for _ in range(254))]
+    # an empty packet in the middle is skipped
+    d = b"".join(cobs_encode(pkt) for pkt in pkts[:3]) + cobs_encode(b"") + b"".join(cobs_encode(pkt) for pkt in pkts[3:])
+    
+    def transmit_proc():
+        yield
+        g = 0
+        while g < len(d):
+            yield i.data.eq(d[g])
+            yield i.valid.eq(1)
+            yield
+            if (yield f.sink.ready) == 1:
+                g += 1
+        yield i.valid.eq(0)
+    
+    def receive_proc():
+        recv = []
+        data = bytearray()
+        cycles = 0
+        while len(recv) < len(pkts):
+            # full rate for the first packet, then random backpressure
+            ready = len(recv) == 0 or random.getrandbits(1)
+            yield f.source.ready.eq(ready)
+            yield
+            assert (yield f.err) == 0
+            if (yield f.source.valid) == 1:
+                cycles += 1
+                if ready:
+                    assert ((yield f.source.sop) == 1) == (len(data) == 0)
+                    data.append((yield f.source.data))
+                    if (yield f.source.eop) == 1:
+                        recv.append(bytes(data))
+                        data = bytearray()
+                        if len(recv) == 1:
+                            # one byte per clock
+                            assert cycles == len(pkts[0])
+        
+        assert recv == pkts
+
+    sim.add_sync_process(transmit_proc)
+    sim.add_sync_process(receive_proc)
+    
+    with sim.write_vcd("cobs_unframe.vcd", "cobs_unframe.gtkw"):
+        sim.run()
+
+def test_loopback_sim():
+    from nmigen.back.pysim import Simulator, Passive
+    import random
+    
+    class Top(Elaboratable):
+        def __init__(self):
+            self.i = i = StreamSource(Layout([("data", 8, DIR_FANOUT)]), name="input", sop=True, eop=True)
+            self.f = f = COBSFramer(i)
+            self.u = u = COBSUnframer(f.source)
+            self.o = o = u.source
+        
+        def elaborate(self, platform):
+            m = Module()
+            
+            m.submodules.f = self.f
+            m.submodules.u = self.u
+            
+            return m
+    
+    t = Top()
+    sim = Simulator(t)
+    sim.add_clock(1e-6)
+    
+    # data full of the values SLIP would have to escape
+    pkts = [bytes(random.choice([0x00, 0xc0, 0xdb, random.getrandbits(8)]) for _ in range(random.randrange(1, 600))) for _ in range(4)]
+    
+    def transmit_proc():
+        yield
+        for pkt in pkts:
+            g = 0
+            while g < len(pkt):
+                yield t.i.data.eq(pkt[g])
+                yield t.i.sop.eq(g == 0)
+                yield t.i.eop.eq(g == len(pkt)-1)
+                yield t.i.valid.eq(1)
+                yield
+                if (yield t.f.sink.ready) == 1:
+                    g += 1
+        yield t.i.valid.eq(0)
+    
+    def receive_proc():
+        recv = []
+        data = bytearray()
+        yield t.o.ready.eq(1)
+        while len(recv) < len(pkts):
+            yield
+            if (yield t.o.valid) == 1:
+                data.append((yield t.o.data))
+                if (yield t.o.eop) == 1:
+                    recv.append(bytes(data))
+                    data = bytearray()
+        
+        assert recv == pkts
+
+    sim.add_sync_process(transmit_proc)
+    sim.add_sync_process(receive_proc)
+    
+    with sim.write_vcd("cobs_loopback.vcd", "cobs_loopback.gtkw"):
+        sim.run()
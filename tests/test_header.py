@@ -0,0 +1,109 @@
+
+from udptherbone.header import *
+
+def test_header_parser_sim():
+    from nmigen.back.pysim import Simulator, Passive
+    
+    # a made-up header: a 12 bit magic number, a 4 bit flags nibble with one flag captured, a 16 bit length
+    # checked against a register, and a byte that's captured whole
+    length = Signal(16)
+    parser = p = HeaderParser([
+            ("magic", 0, 12, FieldAction.MATCH, 0xABC),
+            ("flag", 13, 1, FieldAction.CAPTURE, None),
+            ("length", 16, 16, FieldAction.MATCH, length),
+            ("id", 32, 8, FieldAction.CAPTURE, None),
+        ], length=5)
+    
+    sim = Simulator(parser)
+    sim.add_clock(1e-6)
+    
+    # header, whether it should match, and the captured fields
+    headers = [
+            (bytes([0xAB, 0xC4, 0x01, 0x23, 0x55]), True, 1, 0x55),
+            (bytes([0xAB, 0xCB, 0x01, 0x23, 0x66]), True, 0, 0x66),
+            (bytes([0xAB, 0xD4, 0x01, 0x23, 0x77]), False, None, None),
+            (bytes([0xAB, 0xC0, 0x01, 0x24, 0x88]), False, None, None),
+        ]
+    
+    def proc():
+        yield length.eq(0x0123)
+        for (header, match, flag, id) in headers:
+            # a few bytes that aren't part of a header first
+            for b in [0x00, 0x11]:
+                yield p.data.eq(b)
+                yield p.valid.eq(1)
+                yield
+                assert (yield p.done) == 0
+                assert (yield p.err) == 0
+            for (g, b) in enumerate(header):
+                yield p.start.eq(g == 0)
+                yield p.data.eq(b)
+                yield p.valid.eq(1)
+                # a gap in the middle
+                if g == 2:
+                    yield p.valid.eq(0)
+                    yield
+                    yield p.valid.eq(1)
+                yield
+                last = g == len(header) - 1
+                assert (yield p.done) == (last and match)
+                assert (yield p.err) == (last and not match)
+            yield p.start.eq(0)
+            yield p.valid.eq(0)
+            yield
+            if match:
+                assert (yield p.fields["flag"]) == flag
+                assert (yield p.fields["id"]) == id
+    
+    sim.add_sync_process(proc)
+    
+    with sim.write_vcd("header.vcd", "header.gtkw"):
+        sim.run()
+
+def test_header_checksum():
+    # the IPv4 header from RFC 1071's example traffic, with its checksum left out
+    header = bytes.fromhex("450000730000400040110000c0a80001c0a800c7")
+    fields = [("word{}".format(n), n * 16, 16, int.from_bytes(header[2*n:2*n+2], "big")) for n in range(10)]
+    assert 0xFFFF - header_checksum(fields) == 0xB861
+    # dynamic fields count as 0
+    fields[1] = ("length", 16, 16, Signal(16))
+    assert header_checksum(fields) == header_checksum(fields[:1] + fields[2:])
+    # an odd stop pads the last byte
+    assert header_checksum(fields, 16, 19) == 0xC0A8 + 0x0000
+
+def test_header_inserter_sim():
+    from nmigen.back.pysim import Simulator, Passive
+    
+    length = Signal(16)
+    inserter = i = HeaderInserter([
+            ("magic", 0, 12, 0xABC),
+            ("flag", 13, 1, C(1, 1)),
+            ("length", 16, 16, length),
+            ("id", 32, 8, 0x55),
+        ], length=5)
+    
+    sim = Simulator(inserter)
+    sim.add_clock(1e-6)
+    
+    def proc():
+        for l in [0x0123, 0xBEEF]:
+            yield length.eq(l)
+            data = []
+            for g in range(5):
+                # a gap in the middle
+                if g == 2:
+                    yield i.advance.eq(0)
+                    yield
+                yield i.advance.eq(1)
+                yield
+                assert (yield i.first) == (g == 0)
+                assert (yield i.last) == (g == 4)
+                data.append((yield i.data))
+            yield i.advance.eq(0)
+            yield
+            assert bytes(data) == bytes([0xAB, 0xC4]) + l.to_bytes(2, "big") + bytes([0x55])
+    
+    sim.add_sync_process(proc)
+    
+    with sim.write_vcd("header_inserter.vcd", "header_inserter.gtkw"):
+        sim.run()
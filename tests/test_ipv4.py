@@ -0,0 +1,153 @@
+
+from udptherbone.ipv4 import *
+from scapy.all import *
+
+def packetizer_burst(in_flight, payloads):
+    """
+    Offer payloads back to back at one byte per cycle with the output always ready, and return the packets that
+    come out, the cycles the input was stalled for, and the cycles from the first output byte to the last
+    """
+    from nmigen.back.pysim import Simulator, Passive
+
+    input = i = StreamSource(Layout([("data", 8, DIR_FANOUT)]))
+    packetizer = p = IPv4Packetizer(input, ipaddress.IPv4Address("127.0.0.1"), ipaddress.IPv4Address("127.0.0.2"),
+            in_flight = in_flight)
+
+    sim = Simulator(packetizer)
+    sim.add_clock(1e-6)
+
+    stalls = []
+    packets = []
+    output_cycles = []
+
+    def transmit_proc():
+        yield
+        for payload in payloads:
+            g = 0
+            while g < len(payload):
+                yield i.sop.eq(g == 0)
+                yield i.eop.eq(g == len(payload)-1)
+                yield i.data.eq(payload[g])
+                yield i.valid.eq(1)
+                yield
+                if (yield i.ready) == 1:
+                    g += 1
+                else:
+                    stalls.append(1)
+        yield i.valid.eq(0)
+
+    def receive_proc():
+        yield p.source.ready.eq(1)
+        cycle = 0
+        first = None
+        while len(packets) < len(payloads):
+            data = []
+            while True:
+                yield
+                cycle += 1
+                if (yield p.source.valid) == 1:
+                    if first is None:
+                        first = cycle
+                    data.append((yield p.source.data))
+                    if (yield p.source.eop) == 1:
+                        break
+            packets.append(bytes(data))
+        output_cycles.append(cycle - first + 1)
+
+    sim.add_sync_process(transmit_proc)
+    sim.add_sync_process(receive_proc)
+    sim.run()
+
+    return (packets, len(stalls), output_cycles[0])
+
+def test_packetizer_throughput_sim():
+    # a burst of small packets, where the header is most of the traffic
+    payloads = [bytes([n] * (4 + n % 5)) for n in range(32)]
+    total = sum(20 + len(payload) for payload in payloads)
+
+    print()
+    print("in_flight  input stalls  output cycles  output bytes/cycle")
+    results = {}
+    for in_flight in [1, 2, 4, 8]:
+        (packets, stalls, cycles) = packetizer_burst(in_flight, payloads)
+
+        for (packet, payload) in zip(packets, payloads):
+            r = IP(packet)
+            assert r.len == len(packet)
+            assert r.load == payload
+            c = IP(packet)
+            del c.chksum
+            c = IP(raw(c))
+            assert r.chksum == c.chksum
+
+        print("{:9}  {:12}  {:13}  {:18.3f}".format(in_flight, stalls, cycles, total / cycles))
+        results[in_flight] = (stalls, cycles)
+
+    # packets go out back to back once more than one can be queued
+    for in_flight in [2, 4, 8]:
+        assert results[in_flight][1] == total
+    # and deeper queues take bursts with fewer stalls
+    assert results[1][0] >= results[2][0] >= results[4][0] >= results[8][0]
+
+def test_packetizer_errors_sim():
+    from nmigen.back.pysim import Simulator, Passive
+
+    input = i = StreamSource(Layout([("data", 8, DIR_FANOUT)]))
+    # room for 48 payload bytes
+    packetizer = p = IPv4Packetizer(input, ipaddress.IPv4Address("127.0.0.1"), ipaddress.IPv4Address("127.0.0.2"),
+            mtu = 68)
+
+    sim = Simulator(packetizer)
+    sim.add_clock(1e-6)
+
+    # (payload, sop at the start, eop at the end)
+    writes = [
+            (b"first", True, True),
+            (b"x" * 60, True, True), # too long, overflows
+            (b"?", False, False), # no SOP, skipped
+            (b"cut", True, False), # no EOP, rolled back at the next SOP
+            (b"last", True, True),
+            (b"y" * 48, True, True), # exactly fills the buffer
+        ]
+    errors = {"overflow": 0, "err": 0}
+
+    def transmit_proc():
+        yield
+        for (payload, sop, eop) in writes:
+            g = 0
+            while g < len(payload):
+                yield i.sop.eq(sop and g == 0)
+                yield i.eop.eq(eop and g == len(payload)-1)
+                yield i.data.eq(payload[g])
+                yield i.valid.eq(1)
+                yield
+                if (yield i.ready) == 1:
+                    g += 1
+        yield i.valid.eq(0)
+
+    def error_proc():
+        yield Passive()
+        while True:
+            yield
+            errors["overflow"] += (yield p.overflow)
+            errors["err"] += (yield p.err)
+
+    def receive_proc():
+        yield p.source.ready.eq(1)
+        for payload in [b"first", b"last", b"y" * 48]:
+            data = []
+            while True:
+                yield
+                if (yield p.source.valid) == 1:
+                    data.append((yield p.source.data))
+                    if (yield p.source.eop) == 1:
+                        break
+            assert IP(bytes(data)).load == payload
+        assert errors == {"overflow": 1, "err": 2}
+
+    sim.add_sync_process(transmit_proc)
+    sim.add_sync_process(error_proc)
+    sim.add_sync_process(receive_proc)
+
+    with sim.write_vcd("ipv4_errors.vcd", "ipv4_errors.gtkw"):
+        sim.run()
@@ -0,0 +1,31 @@
+import itertools
+
+from udptherbone.resources import *
+from udptherbone.stream import *
+from udptherbone.udp import *
+from udptherbone.udptherbone import UDPTherbone
+
+def test_udptherbone_bram():
+    # capture and response FIFOs hold an mtu-byte packet in 32-bit words
+    # with cut_through too, where the capture FIFO's bypass register keeps its memory synchronous
+    for (features, cut_through) in itertools.product((["stall"], []), (False, True)):
+        report = bram_report(UDPTherbone(mtu=1500, features=features, cut_through=cut_through), "ice40")
+        assert all(depth <= 1500 // 4 for (path, width, depth, blocks) in report)
+        assert sum(blocks for (path, width, depth, blocks) in report) == 8
+
+def test_udp_bram():
+    ip = ipaddress.IPv4Address("127.0.0.1")
+    
+    input = StreamSource(Layout([("data", 8, DIR_FANOUT)]))
+    report = bram_report(UDPDepacketizer(input, ip, 2574, mtu=1500), "ice40")
+    assert sum(blocks for (path, width, depth, blocks) in report) == 3
+    
+    input = StreamSource(Layout([("data", 8, DIR_FANOUT)]))
+    report = bram_report(UDPPacketizer(input, ip, ip, 2574, 7777, mtu=1500), "ice40")
+    assert sum(blocks for (path, width, depth, blocks) in report) == 3
+
+def test_bram_blocks():
+    assert bram_blocks(8, 512, "ice40") == 1
+    assert bram_blocks(32, 375, "ice40") == 4
+    assert bram_blocks(32, 375, "ecp5") == 1
+    assert bram_blocks(8, 1472, "ecp5") == 1
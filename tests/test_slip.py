@@ -61,6 +61,60 @@ def test_framer_sim():
         sim.run()
 
 
+def test_framer_throughput_sim():
+    from nmigen.back.pysim import Simulator, Passive
+    
+    input = i = StreamSource(Layout([("data", 8, DIR_FANOUT)]), name="input")
+    framer = f = SLIPFramer(input)
+
+    sim = Simulator(framer)
+    sim.add_clock(1e-6)
+    
+    d = b"hello \xc0world\xdb!"
+    expected = slip_encode(d)
+    cycles = []
+    stalls = []
+    
+    def transmit_proc():
+        yield
+        g = 0
+        while g < len(d):
+            yield i.data.eq(d[g])
+            yield i.sop.eq(g == 0)
+            yield i.eop.eq(g == len(d)-1)
+            yield i.valid.eq(1)
+            yield
+            if (yield f.sink.ready) == 1:
+                g += 1
+            else:
+                stalls.append(g)
+        yield i.valid.eq(0)
+        
+        # each escaped byte holds off the next one for a single clock
+        assert stalls == [7, 13]
+    
+    def receive_proc():
+        data = []
+        yield f.source.ready.eq(1)
+        yield
+        while len(data) < len(expected):
+            if (yield f.source.valid) == 1:
+                data.append((yield f.source.data))
+                cycles.append(1)
+            elif len(data) > 0:
+                cycles.append(0)
+            yield
+        
+        assert list(map(hex, data)) == list(map(hex, expected))
+        # one byte per clock out, the escape codes fill the input stalls
+        assert len(cycles) == len(expected)
+
+    sim.add_sync_process(transmit_proc)
+    sim.add_sync_process(receive_proc)
+    
+    with sim.write_vcd("slip_throughput.vcd", "slip_throughput.gtkw"):
+        sim.run()
+
 def test_unframer_sim():
     from nmigen.back.pysim import Simulator, Passive
     
@@ -111,6 +165,61 @@ def test_unframer_sim():
         sim.run()
 
 
+def test_unframer_throughput_sim():
+    from nmigen.back.pysim import Simulator, Passive
+    import random
+    
+    input = i = StreamSource(Layout([("data", 8, DIR_FANOUT)]), name="input", sop=False, eop=False)
+    framer = f = SLIPUnframer(input)
+
+    sim = Simulator(framer)
+    sim.add_clock(1e-6)
+    
+    pkts = [b"hello world", b"\xc0\xdb", b"x", bytes(random.getrandbits(8) for _ in range(32))]
+    d = b"".join(slip_encode(pkt) for pkt in pkts)
+    
+    def transmit_proc():
+        yield
+        g = 0
+        while g < len(d):
+            yield i.data.eq(d[g])
+            yield i.valid.eq(1)
+            yield
+            if (yield f.sink.ready) == 1:
+                g += 1
+        yield i.valid.eq(0)
+    
+    def receive_proc():
+        recv = []
+        data = []
+        # full rate for the first packet, then random backpressure
+        yield f.source.ready.eq(1)
+        yield
+        cycles = 0
+        while len(recv) < len(pkts):
+            if (yield f.source.valid) == 1:
+                cycles += 1
+                if (yield f.source.ready) == 1:
+                    if len(data) == 0:
+                        assert (yield f.source.sop) == 1
+                    data.append((yield f.source.data))
+                    if (yield f.source.eop) == 1:
+                        recv.append(bytes(data))
+                        data = []
+                        if len(recv) == 1:
+                            # one byte per clock
+                            assert cycles == len(pkts[0])
+            yield f.source.ready.eq(len(recv) == 0 or random.getrandbits(1))
+            yield
+        
+        assert recv == pkts
+
+    sim.add_sync_process(transmit_proc)
+    sim.add_sync_process(receive_proc)
+    
+    with sim.write_vcd("slip_unframe_throughput.vcd", "slip_unframe_throughput.gtkw"):
+        sim.run()
+
 def test_loopback_sim():
     from nmigen.back.pysim import Simulator, Passive
     
@@ -433,3 +542,556 @@ def test_loopback_uart_in_loop():
     with sim.write_vcd("uart_in_loop.vcd", "uart_in_loop.gtkw"):
         sim.run()
 
+
+def test_wide_framer_sim():
+    from nmigen.back.pysim import Simulator, Passive
+    import random
+    
+    for width in (16, 32, 64):
+        lanes = width // 8
+        input = i = StreamSource(wide_slip_layout(width), name="input", sop=True, eop=True)
+        framer = f = WideSLIPFramer(input)
+
+        sim = Simulator(framer)
+        sim.add_clock(1e-6)
+        
+        # a long packet with nothing to escape, then escapes and ENDs at every lane position
+        pkts = [bytes(random.choice(b"abc") for _ in range(16 * lanes))]
+        pkts += [bytes(random.choice(b"a\xc0\xdb") for _ in range(random.randrange(1, 3 * lanes))) for _ in range(8)]
+        stalls = []
+        
+        def transmit_proc():
+            yield
+            for n, pkt in enumerate(pkts):
+                words = [pkt[g:g+lanes] for g in range(0, len(pkt), lanes)]
+                g = 0
+                while g < len(words):
+                    yield i.data.data.eq(int.from_bytes(words[g], "little"))
+                    yield i.data.keep.eq((1 << len(words[g])) - 1)
+                    yield i.sop.eq(g == 0)
+                    yield i.eop.eq(g == len(words)-1)
+                    yield i.valid.eq(1)
+                    yield
+                    if (yield f.sink.ready) == 1:
+                        g += 1
+                    elif n == 0:
+                        stalls.append(g)
+            yield i.valid.eq(0)
+            
+            # one word per clock while there's nothing to escape
+            assert stalls == []
+        
+        def receive_proc():
+            expected = b"".join(slip_encode(pkt) for pkt in pkts)
+            data = bytearray()
+            while len(data) < len(expected):
+                ready = random.getrandbits(1) | (len(data) < len(pkts[0]))
+                yield f.source.ready.eq(ready)
+                yield
+                if ready and (yield f.source.valid) == 1:
+                    word = (yield f.source.data.data).to_bytes(lanes, "little")
+                    keep = (yield f.source.data.keep)
+                    data += bytes(word[g] for g in range(lanes) if keep & (1 << g))
+            
+            assert list(map(hex, data)) == list(map(hex, expected))
+        
+        sim.add_sync_process(transmit_proc)
+        sim.add_sync_process(receive_proc)
+        
+        with sim.write_vcd("slip_wide.vcd", "slip_wide.gtkw"):
+            sim.run()
+
+def test_wide_unframer_sim():
+    from nmigen.back.pysim import Simulator, Passive
+    import random
+    
+    for width in (16, 32, 64):
+        lanes = width // 8
+        input = i = StreamSource(wide_slip_layout(width), name="input", sop=False, eop=False)
+        framer = f = WideSLIPUnframer(input)
+
+        sim = Simulator(framer)
+        sim.add_clock(1e-6)
+        
+        pkts = [bytes(random.choice(b"abc") for _ in range(16 * lanes))]
+        pkts += [bytes(random.choice(b"a\xc0\xdb") for _ in range(random.randrange(1, 3 * lanes))) for _ in range(8)]
+        # empty packets are skipped
+        d = b"".join(slip_encode(pkt) for pkt in pkts[:4]) + b"\xc0" + b"".join(slip_encode(pkt) for pkt in pkts[4:])
+        
+        def transmit_proc():
+            yield
+            words = [d[g:g+lanes] for g in range(0, len(d), lanes)]
+            g = 0
+            while g < len(words):
+                yield i.data.data.eq(int.from_bytes(words[g], "little"))
+                yield i.data.keep.eq((1 << len(words[g])) - 1)
+                yield i.valid.eq(1)
+                yield
+                if (yield f.sink.ready) == 1:
+                    g += 1
+            yield i.valid.eq(0)
+        
+        def receive_proc():
+            recv = []
+            data = bytearray()
+            cycles = 0
+            while len(recv) < len(pkts):
+                ready = len(recv) == 0 or random.getrandbits(1)
+                yield f.source.ready.eq(ready)
+                yield
+                assert (yield f.err) == 0
+                if (yield f.source.valid) == 1:
+                    cycles += 1
+                    if ready:
+                        word = (yield f.source.data.data).to_bytes(lanes, "little")
+                        keep = (yield f.source.data.keep)
+                        assert ((yield f.source.sop) == 1) == (len(data) == 0)
+                        if (yield f.source.eop) == 0:
+                            # only the last word is partial
+                            assert keep == (1 << lanes) - 1
+                        data += bytes(word[g] for g in range(lanes) if keep & (1 << g))
+                        if (yield f.source.eop) == 1:
+                            recv.append(bytes(data))
+                            data = bytearray()
+                            if len(recv) == 1:
+                                # one word per clock while there's nothing to escape
+                                assert cycles == len(pkts[0]) // lanes
+            
+            assert recv == pkts
+        
+        sim.add_sync_process(transmit_proc)
+        sim.add_sync_process(receive_proc)
+        
+        with sim.write_vcd("slip_wide_unframe.vcd", "slip_wide_unframe.gtkw"):
+            sim.run()
+
+def test_wide_loopback_sim():
+    from nmigen.back.pysim import Simulator, Passive
+    import random
+    
+    class Top(Elaboratable):
+        def __init__(self, width):
+            self.i = i = StreamSource(wide_slip_layout(width), name="input", sop=True, eop=True)
+            self.f = f = WideSLIPFramer(i)
+            self.u = u = WideSLIPUnframer(f.source)
+            self.o = o = u.source
+        
+        def elaborate(self, platform):
+            m = Module()
+            
+            m.submodules.f = self.f
+            m.submodules.u = self.u
+            
+            return m
+    
+    for width in (16, 32, 64):
+        lanes = width // 8
+        t = Top(width)
+        sim = Simulator(t)
+        sim.add_clock(1e-6)
+        
+        pkts = [bytes(random.getrandbits(8) for _ in range(random.randrange(1, 4 * lanes))) for _ in range(8)]
+        
+        def transmit_proc():
+            yield
+            for pkt in pkts:
+                words = [pkt[g:g+lanes] for g in range(0, len(pkt), lanes)]
+                g = 0
+                while g < len(words):
+                    yield t.i.data.data.eq(int.from_bytes(words[g], "little"))
+                    yield t.i.data.keep.eq((1 << len(words[g])) - 1)
+                    yield t.i.sop.eq(g == 0)
+                    yield t.i.eop.eq(g == len(words)-1)
+                    valid = random.getrandbits(1)
+                    yield t.i.valid.eq(valid)
+                    yield
+                    if valid and (yield t.f.sink.ready) == 1:
+                        g += 1
+            yield t.i.valid.eq(0)
+        
+        def receive_proc():
+            recv = []
+            data = bytearray()
+            while len(recv) < len(pkts):
+                ready = random.getrandbits(1)
+                yield t.o.ready.eq(ready)
+                yield
+                if ready and (yield t.o.valid) == 1:
+                    word = (yield t.o.data.data).to_bytes(lanes, "little")
+                    keep = (yield t.o.data.keep)
+                    data += bytes(word[g] for g in range(lanes) if keep & (1 << g))
+                    if (yield t.o.eop) == 1:
+                        recv.append(bytes(data))
+                        data = bytearray()
+            
+            assert recv == pkts
+        
+        sim.add_sync_process(transmit_proc)
+        sim.add_sync_process(receive_proc)
+        
+        with sim.write_vcd("slip_wide_loopback.vcd", "slip_wide_loopback.gtkw"):
+            sim.run()
+
+def test_crc_host():
+    import pytest
+    
+    for width in (16, 32):
+        for pkt in [b"hello world", b"\xc0\xdb", b"x", bytes(range(256))]:
+            d = slip_encode(pkt, crc=width)
+            assert d[-1] == 0xC0
+            assert slip_decode(d, crc=width) == pkt
+            assert slip_decode(d) == pkt + crc_trailer(pkt, width)
+        
+        with pytest.raises(ValueError):
+            slip_decode(slip_encode(b"hello world", crc=width).replace(b"w", b"W"), crc=width)
+        with pytest.raises(ValueError):
+            slip_decode(b"\xc0", crc=width)
+    
+    # check values for "123456789"
+    assert crc(b"123456789", 16) == 0x29B1
+    assert crc(b"123456789", 32) == 0xCBF43926
+
+def _escaped_trailer(width):
+    # a packet whose trailer has to be escaped
+    g = 0
+    while True:
+        pkt = b"crc" + bytes([g])
+        if b"\xc0" in crc_trailer(pkt, width) or b"\xdb" in crc_trailer(pkt, width):
+            return pkt
+        g += 1
+
+def test_crc_framer_sim():
+    from nmigen.back.pysim import Simulator, Passive
+    import random
+    
+    for width in (16, 32):
+        input = i = StreamSource(Layout([("data", 8, DIR_FANOUT)]), name="input", sop=True, eop=True)
+        framer = f = SLIPFramer(input, crc=width)
+
+        sim = Simulator(framer)
+        sim.add_clock(1e-6)
+        
+        pkts = [b"hello world", b"\xc0\xdb", b"x", _escaped_trailer(width), bytes(random.getrandbits(8) for _ in range(32))]
+        
+        def transmit_proc():
+            yield
+            for pkt in pkts:
+                g = 0
+                while g < len(pkt):
+                    yield i.data.eq(pkt[g])
+                    yield i.sop.eq(g == 0)
+                    yield i.eop.eq(g == len(pkt) - 1)
+                    yield i.valid.eq(1)
+                    yield
+                    if (yield f.sink.ready) == 1:
+                        g += 1
+            yield i.valid.eq(0)
+        
+        def receive_proc():
+            expected = b"".join(slip_encode(pkt, crc=width) for pkt in pkts)
+            data = []
+            while len(data) < len(expected):
+                ready = random.getrandbits(1)
+                yield f.source.ready.eq(ready)
+                yield
+                if ready and (yield f.source.valid) == 1:
+                    data.append((yield f.source.data))
+            
+            assert bytes(data) == expected
+            assert (yield f.err) == 0
+        
+        sim.add_sync_process(transmit_proc)
+        sim.add_sync_process(receive_proc)
+        
+        with sim.write_vcd("slip_crc.vcd", "slip_crc.gtkw"):
+            sim.run()
+
+def test_crc_unframer_sim():
+    from nmigen.back.pysim import Simulator, Passive
+    import random
+    
+    for width in (16, 32):
+        input = i = StreamSource(Layout([("data", 8, DIR_FANOUT)]), name="input", sop=False, eop=False)
+        framer = f = SLIPUnframer(input, crc=width, mtu=64)
+
+        sim = Simulator(framer)
+        sim.add_clock(1e-6)
+        
+        pkts = [b"hello world", b"\xc0\xdb", b"x", _escaped_trailer(width), bytes(random.getrandbits(8) for _ in range(32))]
+        bad = bytearray(slip_encode(b"corrupted", crc=width))
+        bad[3] ^= 0x01
+        # good, bad CRC, good, too short for a trailer, good, illegal escape, good...
+        d = slip_encode(pkts[0], crc=width) + bytes(bad) + slip_encode(pkts[1], crc=width)
+        d += b"\x01\xc0" + slip_encode(pkts[2], crc=width) + b"abcdefgh\xdb\x01" + b"".join(slip_encode(pkt, crc=width) for pkt in pkts[3:])
+        
+        errors = []
+        
+        def transmit_proc():
+            yield
+            g = 0
+            while g < len(d):
+                yield i.data.eq(d[g])
+                yield i.valid.eq(1)
+                yield
+                if (yield f.crc_err) == 1:
+                    errors.append(g)
+                if (yield f.sink.ready) == 1:
+                    g += 1
+            yield i.valid.eq(0)
+        
+        def receive_proc():
+            recv = []
+            data = []
+            while len(recv) < len(pkts):
+                ready = random.getrandbits(1)
+                yield f.source.ready.eq(ready)
+                yield
+                if ready and (yield f.source.valid) == 1:
+                    assert ((yield f.source.sop) == 1) == (len(data) == 0)
+                    data.append((yield f.source.data))
+                    if (yield f.source.eop) == 1:
+                        recv.append(bytes(data))
+                        data = []
+            
+            assert recv == pkts
+            # bad CRC and the short packet, the illegal escape only raises err
+            assert len(errors) == 2
+            yield
+            assert (yield f.buffer.level) == 0
+        
+        sim.add_sync_process(transmit_proc)
+        sim.add_sync_process(receive_proc)
+        
+        with sim.write_vcd("slip_crc_unframe.vcd", "slip_crc_unframe.gtkw"):
+            sim.run()
+
+def test_crc_unframer_overflow_sim():
+    from nmigen.back.pysim import Simulator, Passive
+    import random
+    
+    for width in (16, 32):
+        input = i = StreamSource(Layout([("data", 8, DIR_FANOUT)]), name="input", sop=False, eop=False)
+        framer = f = SLIPUnframer(input, crc=width, mtu=32)
+
+        sim = Simulator(framer)
+        sim.add_clock(1e-6)
+        
+        # the largest packet that fits, with its trailer, in mtu bytes
+        pkts = [b"hello", bytes(random.getrandbits(8) for _ in range(32 - width // 8)), b"world"]
+        # too long, good, good, one byte too long, good
+        d = slip_encode(b"x" * 40, crc=width) + slip_encode(pkts[0], crc=width) + slip_encode(pkts[1], crc=width)
+        d += slip_encode(b"y" * (33 - width // 8), crc=width) + slip_encode(pkts[2], crc=width)
+        
+        errors = []
+        
+        def transmit_proc():
+            yield
+            g = 0
+            while g < len(d):
+                yield i.data.eq(d[g])
+                yield i.valid.eq(1)
+                yield
+                if (yield f.err) == 1:
+                    errors.append(g)
+                if (yield f.sink.ready) == 1:
+                    g += 1
+            yield i.valid.eq(0)
+        
+        def receive_proc():
+            recv = []
+            data = []
+            while len(recv) < len(pkts):
+                ready = random.getrandbits(1)
+                yield f.source.ready.eq(ready)
+                yield
+                if ready and (yield f.source.valid) == 1:
+                    assert ((yield f.source.sop) == 1) == (len(data) == 0)
+                    data.append((yield f.source.data))
+                    if (yield f.source.eop) == 1:
+                        recv.append(bytes(data))
+                        data = []
+            
+            assert recv == pkts
+            assert len(errors) == 2
+            yield
+            assert (yield f.buffer.level) == 0
+        
+        sim.add_sync_process(transmit_proc)
+        sim.add_sync_process(receive_proc)
+        
+        with sim.write_vcd("slip_crc_overflow.vcd", "slip_crc_overflow.gtkw"):
+            sim.run()
+
+def test_crc_loopback_sim():
+    from nmigen.back.pysim import Simulator, Passive
+    import random
+    
+    class Top(Elaboratable):
+        def __init__(self, width):
+            self.i = i = StreamSource(Layout([("data", 8, DIR_FANOUT)]), name="input", sop=True, eop=True)
+            self.f = f = SLIPFramer(i, crc=width)
+            self.u = u = SLIPUnframer(f.source, crc=width, mtu=64)
+            self.o = o = u.source
+        
+        def elaborate(self, platform):
+            m = Module()
+            
+            m.submodules.f = self.f
+            m.submodules.u = self.u
+            
+            return m
+    
+    for width in (16, 32):
+        t = Top(width)
+        sim = Simulator(t)
+        sim.add_clock(1e-6)
+        
+        pkts = [bytes(random.choice(b"a\xc0\xdb") for _ in range(random.randrange(1, 48))) for _ in range(8)]
+        
+        def transmit_proc():
+            yield
+            for pkt in pkts:
+                g = 0
+                while g < len(pkt):
+                    yield t.i.data.eq(pkt[g])
+                    yield t.i.sop.eq(g == 0)
+                    yield t.i.eop.eq(g == len(pkt) - 1)
+                    yield t.i.valid.eq(1)
+                    yield
+                    if (yield t.f.sink.ready) == 1:
+                        g += 1
+            yield t.i.valid.eq(0)
+        
+        def receive_proc():
+            recv = []
+            data = []
+            while len(recv) < len(pkts):
+                ready = random.getrandbits(1)
+                yield t.o.ready.eq(ready)
+                yield
+                assert (yield t.u.crc_err) == 0
+                if ready and (yield t.o.valid) == 1:
+                    data.append((yield t.o.data))
+                    if (yield t.o.eop) == 1:
+                        recv.append(bytes(data))
+                        data = []
+            
+            assert recv == pkts
+        
+        sim.add_sync_process(transmit_proc)
+        sim.add_sync_process(receive_proc)
+        
+        with sim.write_vcd("slip_crc_loopback.vcd", "slip_crc_loopback.gtkw"):
+            sim.run()
+
+def test_stripe_host():
+    import random
+    
+    assert slip_stripe(b"abcd\xc0xy\xc0", 3) == [b"ad\xc0x\xc0", b"b\xc0y\xc0", b"c\xc0\xc0"]
+    
+    for lanes in (1, 2, 3, 4):
+        pkts = [bytes(random.choice(b"a\xc0\xdb") for _ in range(random.randrange(0, 24))) for _ in range(8)]
+        d = b"".join(slip_encode(pkt) for pkt in pkts)
+        assert slip_unstripe(slip_stripe(d, lanes)) == d
+    
+    # a lane that loses a byte is back in step after the frame it was in
+    pkts = [b"hello world", b"second", b"third"]
+    striped = slip_stripe(b"".join(slip_encode(pkt) for pkt in pkts), 3)
+    striped[1] = striped[1][:2] + striped[1][3:]
+    recv = slip_unstripe(striped).split(b"\xc0")
+    assert recv[0] != b"hello world"
+    assert recv[1:] == [b"second", b"third", b""]
+    # or gains one
+    striped = slip_stripe(b"".join(slip_encode(pkt) for pkt in pkts), 3)
+    striped[0] = striped[0][:1] + b"!" + striped[0][1:]
+    recv = slip_unstripe(striped).split(b"\xc0")
+    assert recv[0] != b"hello world"
+    assert recv[1:] == [b"second", b"third", b""]
+
+def test_stripe_sim():
+    from nmigen.back.pysim import Simulator, Passive
+    import random
+    
+    class Top(Elaboratable):
+        def __init__(self, lanes):
+            self.i = i = StreamSource(Layout([("data", 8, DIR_FANOUT)]), name="input", sop=False, eop=False)
+            self.s = s = SLIPStriper(i, lanes)
+            self.lanes = [StreamSource(Layout([("data", 8, DIR_FANOUT)]), sop=False, eop=False, name="lane{}".format(l))
+                    for l in range(lanes)]
+            self.m = SLIPMerger(self.lanes, depth=64)
+        
+        def elaborate(self, platform):
+            m = Module()
+            
+            m.submodules.s = self.s
+            m.submodules.m = self.m
+            
+            return m
+    
+    for lanes in (2, 3, 4):
+        t = Top(lanes)
+        sim = Simulator(t)
+        sim.add_clock(1e-6)
+        
+        pkts = [bytes(random.choice(b"ab\xc0\xdb") for _ in range(random.randrange(1, 24))) for _ in range(6)]
+        d = b"".join(slip_encode(pkt) for pkt in pkts)
+        striped = slip_stripe(d, lanes)
+        
+        def transmit_proc():
+            g = 0
+            while g < len(d):
+                yield t.i.data.eq(d[g])
+                yield t.i.valid.eq(1)
+                yield
+                if (yield t.s.sink.ready) == 1:
+                    g += 1
+            yield t.i.valid.eq(0)
+        
+        def lane_proc(l):
+            def proc():
+                source = t.s.sources[l]
+                recv = bytearray()
+                while len(recv) < len(striped[l]):
+                    ready = random.getrandbits(1)
+                    yield source.ready.eq(ready)
+                    yield
+                    if ready and (yield source.valid) == 1:
+                        recv.append((yield source.data))
+                assert recv == striped[l]
+                yield source.ready.eq(0)
+            return proc
+        
+        def skew_proc(l):
+            def proc():
+                # each lane starts late by a different amount
+                lane = t.lanes[l]
+                for _ in range(8 * l):
+                    yield
+                g = 0
+                while g < len(striped[l]):
+                    yield lane.data.eq(striped[l][g])
+                    yield lane.valid.eq(1)
+                    yield
+                    if (yield lane.ready) == 1:
+                        g += 1
+                yield lane.valid.eq(0)
+            return proc
+        
+        def receive_proc():
+            recv = bytearray()
+            while len(recv) < len(d):
+                ready = random.getrandbits(1)
+                yield t.m.source.ready.eq(ready)
+                yield
+                if ready and (yield t.m.source.valid) == 1:
+                    recv.append((yield t.m.source.data))
+            assert recv == d
+        
+        sim.add_sync_process(transmit_proc)
+        for l in range(lanes):
+            sim.add_sync_process(lane_proc(l))
+            sim.add_sync_process(skew_proc(l))
+        sim.add_sync_process(receive_proc)
+        
+        with sim.write_vcd("slip_stripe.vcd", "slip_stripe.gtkw"):
+            sim.run()
@@ -25,10 +25,8 @@ class SLIPFramerSafetyProperties(Elaboratable):
         
         # if SLIP_ESC or SLIP_END is specified, SLIP_ESC and the corresponding escape
         # value must be written out before the next value is written in
-        with m.If(f.sink.we):
-            with m.If((f.sink.data == SLIP_ESC) | (f.sink.data == SLIP_END)):
-                m.d.sync += f_esc.eq(2)
-                m.d.sync += f_escaped.eq(f.sink.data)
+        # (the framer can take the next value in the same cycle the last one is read out, so writes are
+        # tracked after reads)
         with m.If(f.source.re & (f_esc == 2)):
             m.d.comb += Assert(f.source.data == SLIP_ESC)
             m.d.sync += f_esc.eq(1)
@@ -38,15 +36,19 @@ class SLIPFramerSafetyProperties(Elaboratable):
         with m.If(f.source.re & (f_escaped == SLIP_END) & (f_esc == 1)):
             m.d.comb += Assert(f.source.data == SLIP_ESC_END)
             m.d.sync += f_esc.eq(0)
+        with m.If(f.sink.we):
+            with m.If((f.sink.data == SLIP_ESC) | (f.sink.data == SLIP_END)):
+                m.d.sync += f_esc.eq(2)
+                m.d.sync += f_escaped.eq(f.sink.data)
         m.d.comb += Assert((f_escaped == SLIP_ESC) | (f_escaped == SLIP_END))
         
-        # if EOP is signaled, SLIP_END must be written before the next value is written
-        with m.If(f.sink.we & f.sink.eop):
-            m.d.sync += f_eop.eq(1)
+        # if EOP is signaled, SLIP_END must be written before (or as) the next value is written
         with m.If(f.source.re & (f.source.data == SLIP_END)):
             m.d.sync += f_eop.eq(0)
+        with m.If(f.sink.we & f.sink.eop):
+            m.d.sync += f_eop.eq(1)
         with m.If(f.sink.we):
-            m.d.comb += Assert(~f_eop)
+            m.d.comb += Assert(~f_eop | (f.source.re & (f.source.data == SLIP_END)))
         
         # SLIP_ESC can only be followed by SLIP_ESC_ESC or SLIP_ESC_END
         with m.If(f.source.re):
@@ -104,9 +106,9 @@ class SLIPFramerLivenessProperties(Elaboratable):
         m.d.comb += Cover((f.source.data == SLIP_END) & (f_last_read == SLIP_ESC_END) & (f_two_ago == SLIP_ESC))
         
         # Throughput - must be able to handle 4 back-to-back writes
-        #f_w_en = Signal()
-        #m.d.comb += f_w_en.eq(f.sink.we)
-        #m.d.comb += Cover(f_w_en & Past(f_w_en) & Past(f_w_en, 2) & Past(f_w_en, 3) & ~f_rst)
+        f_w_en = Signal()
+        m.d.comb += f_w_en.eq(f.sink.we)
+        m.d.comb += Cover(f_w_en & Past(f_w_en) & Past(f_w_en, 2) & Past(f_w_en, 3) & ~f_rst)
         
         # Throughput - must be able to handle 2 writes in 4 where every write is escapable
         #f_escapable = Signal()
@@ -131,46 +133,88 @@ class SLIPUnframerSafetyProperties(Elaboratable):
         
         m.submodules.dut = u = SLIPUnframer(i)
         
-        # if we get an ESC, shouldn't output anything until we get another input
-        # have to delay by 1 because of internal buffering
-        f_last_written = Signal(8)
+        # reference model: a queue of the decoded bytes that have been written and not yet read
+        # (the unframer holds at most three - one waiting on the next input, the output and skid registers)
+        f_data = Array(Signal(8, name="f_data{}".format(n)) for n in range(4))
+        f_sop = Array(Signal(name="f_sop{}".format(n)) for n in range(4))
+        f_eop = Array(Signal(name="f_eop{}".format(n)) for n in range(4))
+        # a byte is done once the next input has said whether it ends the packet
+        f_done = Array(Signal(name="f_done{}".format(n)) for n in range(4))
+        f_level = Signal(range(5))
         f_esc = Signal()
-        with m.If(u.sink.we):
-            m.d.sync += f_last_written.eq(u.sink.data)
-            with m.If(f_last_written == SLIP_ESC):
-                m.d.sync += f_esc.eq(1)
-            with m.Else():
-                m.d.sync += f_esc.eq(0)
-        with m.If(f_esc):
-            m.d.comb += Assert(~u.source.re)
+        f_first = Signal(reset=1)
         
-        # under non-error conditions, if we get an END, next readout should be previous (possibly escaped) value + EOP
-        f_two_ago = Signal(8)
-        f_three_ago = Signal(8)
+        # checks stop after the first error - the packet in progress is dropped
         f_ever_err = Signal()
         with m.If(u.err):
             m.d.sync += f_ever_err.eq(1)
-        with m.If(u.sink.we):
-            m.d.sync += f_two_ago.eq(f_last_written)
-            m.d.sync += f_three_ago.eq(f_two_ago)
+        
         with m.If(~f_ever_err):
-            with m.If(f_last_written == SLIP_END):
-                with m.If(u.source.re):
-                    m.d.comb += Assert(u.source.eop)
-                    with m.If(f_three_ago == SLIP_ESC):
-                        with m.If(f_two_ago == SLIP_ESC_ESC):
-                            m.d.comb += Assert(u.source.data == SLIP_ESC)
-                        with m.Elif(f_two_ago == SLIP_ESC_END):
-                            m.d.comb += Assert(u.source.data == SLIP_END)
-                    with m.Else():
-                        m.d.comb += Assert(u.source.data == f_two_ago)
-        
-        # if we get an ESC followed by an illegal value, we should raise err
-        f_two_esc = Signal()
+            m.d.comb += Assert(f_level <= 3)
+        
+        # every read must be the next decoded byte, with the right SOP/EOP, once it's known whether it ends the packet
+        with m.If(u.source.re & ~f_ever_err):
+            m.d.comb += Assert(f_level > 0)
+            m.d.comb += Assert(f_done[0])
+            m.d.comb += Assert(u.source.data == f_data[0])
+            m.d.comb += Assert(u.source.sop == f_sop[0])
+            m.d.comb += Assert(u.source.eop == f_eop[0])
+        
+        with m.If(u.source.re):
+            for n in range(3):
+                m.d.sync += [
+                        f_data[n].eq(f_data[n + 1]),
+                        f_sop[n].eq(f_sop[n + 1]),
+                        f_eop[n].eq(f_eop[n + 1]),
+                        f_done[n].eq(f_done[n + 1]),
+                    ]
+        
+        # index of the next free entry, and the last written one, after this cycle's read
+        f_tail = Signal(range(5))
+        m.d.comb += f_tail.eq(f_level - u.source.re)
+        
+        f_decoded = Signal(8)
+        f_decode = Signal()
+        f_end = Signal()
+        f_illegal = Signal()
         with m.If(u.sink.we):
-            m.d.sync += f_two_esc.eq(f_esc)
-        with m.If(u.sink.we & f_esc & ~f_ever_err):
-            m.d.comb += Assert((f_last_written == SLIP_ESC_ESC) | (f_last_written == SLIP_ESC_END) | u.err)
+            with m.If(f_esc):
+                m.d.sync += f_esc.eq(0)
+                with m.If(u.sink.data == SLIP_ESC_ESC):
+                    m.d.comb += f_decoded.eq(SLIP_ESC)
+                    m.d.comb += f_decode.eq(1)
+                with m.Elif(u.sink.data == SLIP_ESC_END):
+                    m.d.comb += f_decoded.eq(SLIP_END)
+                    m.d.comb += f_decode.eq(1)
+                with m.Else():
+                    m.d.comb += f_illegal.eq(1)
+            with m.Elif(u.sink.data == SLIP_ESC):
+                m.d.sync += f_esc.eq(1)
+            with m.Elif(u.sink.data == SLIP_END):
+                m.d.comb += f_end.eq(1)
+                m.d.sync += f_first.eq(1)
+            with m.Else():
+                m.d.comb += f_decoded.eq(u.sink.data)
+                m.d.comb += f_decode.eq(1)
+        
+        # the last byte written is done, ending the packet on END
+        with m.If((f_decode | f_end) & (f_tail > 0) & ~f_first):
+            m.d.sync += f_done[f_tail - 1].eq(1)
+            m.d.sync += f_eop[f_tail - 1].eq(f_end)
+        
+        with m.If(f_decode):
+            m.d.sync += [
+                    f_data[f_tail].eq(f_decoded),
+                    f_sop[f_tail].eq(f_first),
+                    f_eop[f_tail].eq(0),
+                    f_done[f_tail].eq(0),
+                    f_first.eq(0),
+                ]
+        
+        m.d.sync += f_level.eq(f_tail + f_decode)
+        
+        # err is raised when, and only when, an ESC is followed by an illegal value
+        m.d.comb += Assert(u.err == f_illegal)
         
         return m
     
@@ -222,6 +266,9 @@ class SLIPUnframerLivenessProperties(Elaboratable):
         with m.If(u.source.sop & u.source.re):
             m.d.sync += f_past_sop.eq(1)
         m.d.comb += Cover(u.source.sop & f_past_sop & ~f_past_err & u.source.re)
+        
+        # Throughput - must be able to give 4 back-to-back reads
+        m.d.comb += Cover(u.source.re & Past(u.source.re) & Past(u.source.re, 2) & Past(u.source.re, 3) & ~f_past_err)
         return m
 
 class SLIPTestCase(FHDLTestCase):
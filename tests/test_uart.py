@@ -59,3 +59,363 @@ def test_loop_sim():
     
     with sim.write_vcd("uart.vcd", "uart.gtkw"):
         sim.run()
+
+def test_loop_sweep_sim():
+    import random
+    
+    class Top(Elaboratable):
+        def __init__(self, tx_divisor, rx_divisor):
+            self.tx = tx = UARTTx(divisor = tx_divisor)
+            self.rx = rx = UARTRx(divisor = rx_divisor)
+            # single clock glitches on the line
+            self.glitch = Signal()
+        
+        def elaborate(self, platform):
+            m = Module()
+            
+            m.submodules.tx = self.tx
+            m.submodules.rx = self.rx
+            
+            m.d.comb += self.rx.rx_i.eq(self.tx.tx_o ^ self.glitch)
+            
+            return m
+    
+    # (divisor, baud error of the transmitter) - 3M baud from 50MHz, 1M from 12MHz, 115200 from 12MHz
+    sweep = [(4, 0), (4.5, 0), (50e6 / 3e6, 0), (50e6 / 3e6, 0.03), (50e6 / 3e6, -0.03), (12e6 / 1e6, 0.02), (12e6 / 115200, -0.03)]
+    
+    for (divisor, error) in sweep:
+        top = Top(divisor * (1 + error), divisor)
+        
+        sim = Simulator(top)
+        sim.add_clock(1e-6)
+        
+        data = bytearray(random.getrandbits(8) for _ in range(8))
+        
+        def transmit_proc():
+            tx = top.tx
+            bit = tx.divisor
+            yield tx.sink.valid.eq(0)
+            yield
+            # a glitch on the idle line isn't a start bit
+            yield top.glitch.eq(1)
+            yield
+            yield top.glitch.eq(0)
+            for _ in range(int(bit * 2)):
+                yield
+            i = 0
+            while i < len(data):
+                yield tx.sink.data.eq(data[i])
+                yield tx.sink.valid.eq(1)
+                yield
+                if (yield tx.sink.ready) == 1:
+                    i += 1
+                    yield tx.sink.valid.eq(0)
+                    # one glitch somewhere in the start or data bits, outvoted
+                    at = int(bit * (random.randrange(9) + random.uniform(0.1, 0.9)))
+                    for _ in range(at):
+                        yield
+                    yield top.glitch.eq(1)
+                    yield
+                    yield top.glitch.eq(0)
+            for _ in range(int(bit * 12)):
+                yield
+        
+        def receive_proc():
+            rx = top.rx
+            yield rx.source.ready.eq(1)
+            rec = bytearray()
+            while len(rec) < len(data):
+                yield
+                assert (yield rx.err) == 0
+                if (yield rx.source.valid):
+                    rec.append((yield rx.source.data))
+            
+            assert data == rec
+        
+        sim.add_sync_process(transmit_proc)
+        sim.add_sync_process(receive_proc)
+        
+        with sim.write_vcd("uart_sweep.vcd", "uart_sweep.gtkw"):
+            sim.run()
+
+def test_buffered_flow_control_sim():
+    import random
+    
+    class Top(Elaboratable):
+        def __init__(self, flow_control):
+            self.flow_control = flow_control
+            self.i = i = StreamSource(Layout([("data", 8, DIR_FANOUT)]), name="input", sop=False, eop=False)
+            self.a = a = BufferedUART(i, divisor = 4, tx_depth = 8, rx_depth = 16, rts_headroom = 4)
+            self.b = b = BufferedUART(StreamSource(Layout([("data", 8, DIR_FANOUT)]), sop=False, eop=False), divisor = 4,
+                    tx_depth = 8, rx_depth = 16, rts_headroom = 4)
+        
+        def elaborate(self, platform):
+            m = Module()
+            
+            m.submodules.a = self.a
+            m.submodules.b = self.b
+            
+            m.d.comb += self.b.rx_i.eq(self.a.tx_o)
+            if self.flow_control:
+                m.d.comb += self.a.cts_i.eq(self.b.rts_o)
+            
+            return m
+    
+    for flow_control in (True, False):
+        top = Top(flow_control)
+        
+        sim = Simulator(top)
+        sim.add_clock(1e-6)
+        
+        data = bytearray(random.getrandbits(8) for _ in range(48))
+        overruns = []
+        
+        def transmit_proc():
+            i = 0
+            while i < len(data):
+                yield top.i.data.eq(data[i])
+                yield top.i.valid.eq(1)
+                yield
+                if (yield top.a.sink.ready) == 1:
+                    i += 1
+                if (yield top.b.overrun) == 1:
+                    overruns.append(i)
+            yield top.i.valid.eq(0)
+        
+        def receive_proc():
+            source = top.b.source
+            rec = bytearray()
+            stopped = False
+            # stall long enough for the receive FIFO to fill, then drain at line rate
+            for _ in range(4 * 10 * 32):
+                yield
+                stopped |= (yield top.b.rts_o) == 1
+            yield source.ready.eq(1)
+            for _ in range(4 * 10 * len(data)):
+                yield
+                if (yield source.valid) == 1:
+                    rec.append((yield source.data))
+            
+            assert stopped
+            if flow_control:
+                assert data == rec
+                assert overruns == []
+            else:
+                assert len(rec) < len(data)
+                assert overruns != []
+        
+        sim.add_sync_process(transmit_proc)
+        sim.add_sync_process(receive_proc)
+        
+        with sim.write_vcd("uart_buffered.vcd", "uart_buffered.gtkw"):
+            sim.run()
+
+def test_baud_control_sim():
+    ctl = UARTBaudControl(divisor = 8, timeout = 64)
+    
+    sim = Simulator(ctl)
+    sim.add_clock(1e-6)
+    
+    def access(adr, data=None):
+        bus = ctl.bus
+        yield bus.adr.eq(adr)
+        yield bus.we.eq(data is not None)
+        yield bus.dat_w.eq(data or 0)
+        yield bus.sel.eq(0xF)
+        yield bus.cyc.eq(1)
+        yield bus.stb.eq(1)
+        yield
+        yield bus.stb.eq(0)
+        while not (yield bus.ack):
+            yield
+        yield bus.cyc.eq(0)
+        return (yield bus.dat_r)
+    
+    def pulse(signal):
+        yield signal.eq(1)
+        yield
+        yield signal.eq(0)
+    
+    def proc():
+        yield ctl.idle_i.eq(1)
+        yield
+        assert (yield from access(0)) == divisor_fixed(8)
+        
+        for confirm in (True, False):
+            old = (yield ctl.divisor_o)
+            new = divisor_fixed(16 if confirm else 50e6 / 3e6)
+            yield from access(0, new)
+            assert (yield from access(1)) == 0b01
+            # nothing changes until a response has gone out and the UART is idle
+            yield ctl.idle_i.eq(0)
+            for _ in range(16):
+                yield
+            assert (yield ctl.divisor_o) == old
+            yield from pulse(ctl.sent_i)
+            for _ in range(16):
+                yield
+            assert (yield ctl.divisor_o) == old
+            yield ctl.idle_i.eq(1)
+            yield
+            yield
+            assert (yield ctl.divisor_o) == new
+            assert (yield from access(1)) == 0b10
+            if confirm:
+                yield from pulse(ctl.valid_i)
+                for _ in range(128):
+                    yield
+                assert (yield ctl.divisor_o) == new
+            else:
+                # timed out, back to the old divisor
+                for _ in range(128):
+                    yield
+                assert (yield ctl.divisor_o) == old
+            assert (yield from access(1)) == 0b00
+    
+    sim.add_sync_process(proc)
+    
+    with sim.write_vcd("uart_baud.vcd", "uart_baud.gtkw"):
+        sim.run()
+
+def test_autobaud_sim():
+    import random
+    
+    class Top(Elaboratable):
+        def __init__(self, divisor):
+            # host at the real rate, board starts out guessing
+            self.host_tx = UARTTx(divisor = divisor)
+            self.host_rx = UARTRx(divisor = divisor)
+            self.rx = UARTRx(divisor = 50, min_divisor = 8, autobaud = True)
+            self.tx = UARTTx(divisor = 50, dynamic = True)
+        
+        def elaborate(self, platform):
+            m = Module()
+            
+            m.submodules.host_tx = self.host_tx
+            m.submodules.host_rx = self.host_rx
+            m.submodules.rx = self.rx
+            m.submodules.tx = self.tx
+            
+            m.d.comb += self.rx.rx_i.eq(self.host_tx.tx_o)
+            m.d.comb += self.host_rx.rx_i.eq(self.tx.tx_o)
+            # the board echoes what it gets, at the rate it measured
+            m.d.comb += self.tx.divisor_i.eq(self.rx.divisor_o)
+            m.d.comb += self.tx.sink.connect(self.rx.source)
+            
+            return m
+    
+    # clock / baud: 12MHz / 1.5M, 12MHz / 1M, 12MHz / 921600, 50MHz / 3M, 48MHz / 2M, 25MHz / 460800, 12MHz / 115200, 50MHz / 115200
+    sweep = [12e6 / 1.5e6, 12e6 / 1e6, 12e6 / 921600, 50e6 / 3e6, 48e6 / 2e6, 25e6 / 460800, 12e6 / 115200, 50e6 / 115200]
+    
+    for divisor in sweep:
+        top = Top(divisor)
+        
+        sim = Simulator(top)
+        sim.add_clock(1e-6)
+        
+        # bytes without a 7 bit low run and a long enough high after it don't train it
+        training = bytes([0x80, 0x00, 0x40]) + b"\xc0" * 4
+        data = bytearray(random.choice([x for x in range(256) if x != 0xC0]) for _ in range(8))
+        
+        def transmit_proc():
+            tx = top.host_tx
+            for b in training + data:
+                yield tx.sink.data.eq(b)
+                yield tx.sink.valid.eq(1)
+                yield
+                while not (yield tx.sink.ready):
+                    yield
+                yield tx.sink.valid.eq(0)
+                # leave the board time to echo
+                for _ in range(int(divisor * 2)):
+                    yield
+                if b == 0x40:
+                    assert not (yield top.rx.locked)
+        
+        def receive_proc():
+            rx = top.host_rx
+            yield rx.source.ready.eq(1)
+            rec = bytearray()
+            for _ in range(int(divisor * 13 * (len(training) + len(data) + 1))):
+                yield
+                if (yield rx.source.valid):
+                    rec.append((yield rx.source.data))
+            
+            # the training after it locked comes back too
+            assert rec.lstrip(b"\xc0") == data
+            # locked on the training, within a percent
+            assert (yield top.rx.locked)
+            measured = (yield top.rx.divisor_o) / (1 << DIVISOR_FRAC_BITS)
+            assert abs(measured - divisor) / divisor < 0.01
+        
+        sim.add_sync_process(transmit_proc)
+        sim.add_sync_process(receive_proc)
+        
+        with sim.write_vcd("uart_autobaud.vcd", "uart_autobaud.gtkw"):
+            sim.run()
+
+def test_bonded_sim():
+    import random
+    from udptherbone.slip import slip_encode, slip_stripe
+    
+    lanes = 3
+    skew = [0, 13, 29]
+    
+    class Top(Elaboratable):
+        def __init__(self):
+            self.i = i = StreamSource(Layout([("data", 8, DIR_FANOUT)]), name="input", sop=False, eop=False)
+            self.b = BondedUART(i, lanes, divisor = 4)
+        
+        def elaborate(self, platform):
+            m = Module()
+            
+            m.submodules.b = self.b
+            
+            # loop back, each lane late by its own number of clocks
+            for l in range(lanes):
+                line = Signal(skew[l] + 1, reset=-1)
+                m.d.sync += line.eq(Cat(self.b.tx_o[l], line[:-1]))
+                m.d.comb += self.b.rx_i[l].eq(line[-1] if skew[l] else self.b.tx_o[l])
+            
+            return m
+    
+    top = Top()
+    
+    sim = Simulator(top)
+    sim.add_clock(1e-6)
+    
+    pkts = [bytes(random.getrandbits(8) for _ in range(random.randrange(8, 40))) for _ in range(4)]
+    data = b"".join(slip_encode(pkt) for pkt in pkts)
+    
+    def transmit_proc():
+        i = 0
+        while i < len(data):
+            yield top.i.data.eq(data[i])
+            yield top.i.valid.eq(1)
+            yield
+            if (yield top.b.sink.ready) == 1:
+                i += 1
+        yield top.i.valid.eq(0)
+    
+    def receive_proc():
+        source = top.b.source
+        yield source.ready.eq(1)
+        rec = bytearray()
+        cycles = 0
+        while len(rec) < len(data):
+            yield
+            cycles += 1
+            assert (yield top.b.err) == 0
+            if (yield source.valid):
+                rec.append((yield source.data))
+        
+        assert rec == data
+        # each lane carries its share of the bytes, plus END for every frame
+        longest = max(len(x) for x in slip_stripe(data, lanes))
+        assert cycles < (longest + 2) * 10 * 4 + max(skew)
+    
+    sim.add_sync_process(transmit_proc)
+    sim.add_sync_process(receive_proc)
+    
+    with sim.write_vcd("uart_bonded.vcd", "uart_bonded.gtkw"):
+        sim.run()
@@ -56,6 +56,66 @@ def test_packetizer_sim():
     with sim.write_vcd("udp_pa.vcd", "udp_pa.gtkw"):
         sim.run()
         
+def test_packetizer_cut_through_sim():
+    from nmigen.back.pysim import Simulator, Passive
+    
+    input = i = StreamSource(Layout([("data", 8, DIR_FANOUT)]))
+    packetizer = p = UDPPacketizer(input, ipaddress.IPv4Address("127.0.0.1"), ipaddress.IPv4Address("127.0.0.2"), source_port = 2574, dest_port = 7777, cut_through = True)
+
+    sim = Simulator(packetizer)
+    sim.add_clock(1e-6)
+    
+    payload = "hello world"
+    sent = []
+    
+    def transmit_proc():
+        yield
+        yield p.length.eq(len(payload))
+        g = 0
+        while g < len(payload):
+            yield i.sop.eq(g == 0)
+            yield i.eop.eq(g == len(payload)-1)
+            yield i.data.eq(ord(payload[g]))
+            yield i.valid.eq(1)
+            yield
+            if (yield i.ready) == 1:
+                g += 1
+                sent.append(g)
+        yield i.valid.eq(0)
+    
+    def receive_proc():
+        data = []
+        yield p.source.ready.eq(1)
+        yield
+        while True:
+            if (yield p.source.valid) == 1:
+                if len(data) == 0:
+                    assert (yield p.source.sop) == 1
+                    # the headers go out before any of the payload is taken
+                    assert len(sent) == 0
+                data.append((yield p.source.data))
+                if (yield p.source.eop) == 1:
+                    break
+            yield
+        
+        r = IP(bytes(data))
+        
+        assert r.len == 28 + len(payload)
+        assert r[UDP].len == 8 + len(payload)
+        assert r[UDP].chksum == 0
+        assert r.load == payload.encode()
+        
+        i = IP(bytes(data))
+        del i.chksum
+        i = IP(raw(i))
+        assert r.chksum == i.chksum
+
+    sim.add_sync_process(transmit_proc)
+    sim.add_sync_process(receive_proc)
+    
+    with sim.write_vcd("udp_pa_ct.vcd", "udp_pa_ct.gtkw"):
+        sim.run()
+
 def test_depacketizer_sim():
     from nmigen.back.pysim import Simulator, Passive
     from udptherbone.slip import SLIPUnframer, SLIPFramer, slip_encode, slip_decode
@@ -117,6 +177,314 @@ def test_depacketizer_sim():
     with sim.write_vcd("udp_de.vcd", "udp_de.gtkw"):
         sim.run()
 
+def test_depacketizer_cut_through_sim():
+    from nmigen.back.pysim import Simulator, Passive
+    
+    input = i = StreamSource(Layout([("data", 8, DIR_FANOUT)]))
+    depacketizer = d = UDPDepacketizer(input, ipaddress.IPv4Address("127.0.0.2"), port = 2574, cut_through = True)
+
+    sim = Simulator(depacketizer)
+    sim.add_clock(1e-6)
+    
+    input_data = raw(IP(src='127.0.0.1', dst='127.0.0.2', flags='DF')/UDP(dport=2574, sport=7777)/"hello world")
+    sent = []
+    
+    def de_input_proc():
+        yield
+        g = 0
+        while g < len(input_data):
+            yield i.sop.eq(g == 0)
+            yield i.eop.eq(g == len(input_data)-1)
+            yield i.data.eq(input_data[g])
+            yield i.valid.eq(1)
+            yield
+            if (yield i.ready) == 1:
+                g += 1
+                sent.append(g)
+                # bytes arrive slowly, like from a UART
+                yield i.valid.eq(0)
+                for _ in range(3):
+                    yield
+        yield i.valid.eq(0)
+        
+    def de_output_proc():
+        data = []
+        yield
+        yield d.source.ready.eq(1)
+        yield
+        while True:
+            if (yield d.source.valid) == 1:
+                if len(data) == 0:
+                    assert (yield d.source.sop) == 1
+                    # the payload starts coming out while the datagram is still arriving
+                    assert len(sent) < len(input_data)
+                data.append((yield d.source.data))
+                if (yield d.source.eop) == 1:
+                    break
+            yield
+        
+        assert "".join(list(map(chr, data))) == "hello world"
+    
+    sim.add_sync_process(de_input_proc)
+    sim.add_sync_process(de_output_proc)
+    
+    with sim.write_vcd("udp_de_ct.vcd", "udp_de_ct.gtkw"):
+        sim.run()
+
+def test_depacketizer_in_flight_sim():
+    from nmigen.back.pysim import Simulator, Passive
+    
+    input = i = StreamSource(Layout([("data", 8, DIR_FANOUT)]))
+    depacketizer = d = UDPDepacketizer(input, ipaddress.IPv4Address("127.0.0.2"), port = 2574, in_flight = 2)
+
+    sim = Simulator(depacketizer)
+    sim.add_clock(1e-6)
+    
+    payloads = ["hello world", "second datagram", "third"]
+    input_datas = [raw(IP(src='127.0.0.1', dst='127.0.0.2', flags='DF')/UDP(dport=2574, sport=7777)/p) 
+            for p in payloads]
+    stalls = []
+    
+    def de_input_proc():
+        yield
+        for input_data in input_datas:
+            g = 0
+            while g < len(input_data):
+                yield i.sop.eq(g == 0)
+                yield i.eop.eq(g == len(input_data)-1)
+                yield i.data.eq(input_data[g])
+                yield i.valid.eq(1)
+                yield
+                if (yield i.ready) == 1:
+                    g += 1
+                else:
+                    stalls.append(input_data)
+        yield i.valid.eq(0)
+        
+    def de_output_proc():
+        # don't drain anything until two datagrams are in
+        for _ in range(len(input_datas[0]) + len(input_datas[1]) + 8):
+            yield
+        assert len(stalls) == 0
+        
+        yield d.source.ready.eq(1)
+        for p in payloads:
+            data = []
+            while True:
+                yield
+                if (yield d.source.valid) == 1:
+                    data.append((yield d.source.data))
+                    if (yield d.source.eop) == 1:
+                        break
+            assert "".join(list(map(chr, data))) == p
+    
+    sim.add_sync_process(de_input_proc)
+    sim.add_sync_process(de_output_proc)
+    
+    with sim.write_vcd("udp_de_if.vcd", "udp_de_if.gtkw"):
+        sim.run()
+
+def test_depacketizer_checksum_sim():
+    from nmigen.back.pysim import Simulator, Passive
+    
+    input = i = StreamSource(Layout([("data", 8, DIR_FANOUT)]))
+    depacketizer = d = UDPDepacketizer(input, ipaddress.IPv4Address("127.0.0.2"), port = 2574)
+
+    sim = Simulator(depacketizer)
+    sim.add_clock(1e-6)
+    
+    payloads = ["hello world", "bad checksum", "bad TTL", "last"]
+    input_datas = [bytearray(raw(IP(src='127.0.0.1', dst='127.0.0.2', flags='DF')/UDP(dport=2574, sport=7777)/p)) 
+            for p in payloads]
+    # corrupt the checksum itself, then a header byte it covers
+    input_datas[1][11] ^= 0x40
+    input_datas[2][8] ^= 0x01
+    
+    def de_input_proc():
+        yield
+        for input_data in input_datas:
+            g = 0
+            while g < len(input_data):
+                yield i.sop.eq(g == 0)
+                yield i.eop.eq(g == len(input_data)-1)
+                yield i.data.eq(input_data[g])
+                yield i.valid.eq(1)
+                yield
+                if (yield i.ready) == 1:
+                    g += 1
+        yield i.valid.eq(0)
+        
+    def de_output_proc():
+        yield d.source.ready.eq(1)
+        for p in [payloads[0], payloads[3]]:
+            data = []
+            while True:
+                yield
+                if (yield d.source.valid) == 1:
+                    data.append((yield d.source.data))
+                    if (yield d.source.eop) == 1:
+                        break
+            assert "".join(list(map(chr, data))) == p
+        assert (yield d.checksum_errors) == 2
+    
+    sim.add_sync_process(de_input_proc)
+    sim.add_sync_process(de_output_proc)
+    
+    with sim.write_vcd("udp_de_checksum.vcd", "udp_de_checksum.gtkw"):
+        sim.run()
+
+def test_depacketizer_udp_checksum_sim():
+    from nmigen.back.pysim import Simulator, Passive
+    
+    input = i = StreamSource(Layout([("data", 8, DIR_FANOUT)]))
+    depacketizer = d = UDPDepacketizer(input, ipaddress.IPv4Address("127.0.0.2"), port = 2574, udp_checksum = True)
+
+    sim = Simulator(depacketizer)
+    sim.add_clock(1e-6)
+    
+    payloads = ["hello world", "bad payload", "no checksum", "even"]
+    input_datas = [bytearray(raw(IP(src='10.0.0.1', dst='127.0.0.2', flags='DF')/UDP(dport=2574, sport=7777)/p)) 
+            for p in payloads]
+    # corrupt a payload byte (not covered by the IPv4 header checksum), then one with the UDP checksum left out
+    input_datas[1][30] ^= 0x01
+    input_datas[2][26:28] = b"\x00\x00"
+    input_datas[2][30] ^= 0x01
+    payloads[2] = input_datas[2][28:].decode()
+    
+    def de_input_proc():
+        yield
+        for input_data in input_datas:
+            g = 0
+            while g < len(input_data):
+                yield i.sop.eq(g == 0)
+                yield i.eop.eq(g == len(input_data)-1)
+                yield i.data.eq(input_data[g])
+                yield i.valid.eq(1)
+                yield
+                if (yield i.ready) == 1:
+                    g += 1
+        yield i.valid.eq(0)
+        
+    def de_output_proc():
+        yield d.source.ready.eq(1)
+        for p in [payloads[0], payloads[2], payloads[3]]:
+            data = []
+            while True:
+                yield
+                if (yield d.source.valid) == 1:
+                    data.append((yield d.source.data))
+                    if (yield d.source.eop) == 1:
+                        break
+            assert "".join(list(map(chr, data))) == p
+        assert (yield d.udp_checksum_errors) == 1
+        assert (yield d.checksum_errors) == 0
+    
+    sim.add_sync_process(de_input_proc)
+    sim.add_sync_process(de_output_proc)
+    
+    with sim.write_vcd("udp_de_udp_checksum.vcd", "udp_de_udp_checksum.gtkw"):
+        sim.run()
+
+def test_depacketizer_length_sim():
+    from nmigen.back.pysim import Simulator, Passive
+    
+    input = i = StreamSource(Layout([("data", 8, DIR_FANOUT)]))
+    # room for 72 payload bytes
+    depacketizer = d = UDPDepacketizer(input, ipaddress.IPv4Address("127.0.0.2"), port = 2574, mtu = 100)
+
+    sim = Simulator(depacketizer)
+    sim.add_clock(1e-6)
+    
+    payloads = ["x" * 200, "hello", "", "y" * 72]
+    input_datas = [raw(IP(src='10.0.0.1', dst='127.0.0.2', flags='DF')/UDP(dport=2574, sport=7777)/p) 
+            for p in payloads]
+    
+    def de_input_proc():
+        yield
+        for input_data in input_datas:
+            g = 0
+            while g < len(input_data):
+                yield i.sop.eq(g == 0)
+                yield i.eop.eq(g == len(input_data)-1)
+                yield i.data.eq(input_data[g])
+                yield i.valid.eq(1)
+                yield
+                if (yield i.ready) == 1:
+                    g += 1
+        yield i.valid.eq(0)
+        
+    def de_output_proc():
+        yield d.source.ready.eq(1)
+        # too long and empty datagrams are skipped
+        for p in [payloads[1], payloads[3]]:
+            data = []
+            while True:
+                yield
+                if (yield d.source.valid) == 1:
+                    data.append((yield d.source.data))
+                    if (yield d.source.eop) == 1:
+                        break
+            assert "".join(list(map(chr, data))) == p
+        assert (yield d.length_errors) == 2
+    
+    sim.add_sync_process(de_input_proc)
+    sim.add_sync_process(de_output_proc)
+    
+    with sim.write_vcd("udp_de_length.vcd", "udp_de_length.gtkw"):
+        sim.run()
+
+def test_depacketizer_options_sim():
+    from nmigen.back.pysim import Simulator, Passive
+    
+    input = i = StreamSource(Layout([("data", 8, DIR_FANOUT)]))
+    depacketizer = d = UDPDepacketizer(input, ipaddress.IPv4Address("127.0.0.2"), port = 2574, udp_checksum = True)
+
+    sim = Simulator(depacketizer)
+    sim.add_clock(1e-6)
+    
+    payloads = ["options", "bad options", "no options"]
+    options = [IPOption_NOP(), IPOption_NOP(), IPOption_NOP(), IPOption_NOP(), IPOption_Timestamp()]
+    input_datas = [bytearray(raw(IP(src='10.0.0.1', dst='127.0.0.2', flags='DF', options=options)/
+            UDP(dport=2574, sport=7777)/p)) for p in payloads[:2]]
+    input_datas.append(bytearray(raw(IP(src='10.0.0.1', dst='127.0.0.2', flags='DF')/
+            UDP(dport=2574, sport=7777)/payloads[2])))
+    # options are covered by the IPv4 header checksum
+    input_datas[1][21] ^= 0x01
+    
+    def de_input_proc():
+        yield
+        for input_data in input_datas:
+            g = 0
+            while g < len(input_data):
+                yield i.sop.eq(g == 0)
+                yield i.eop.eq(g == len(input_data)-1)
+                yield i.data.eq(input_data[g])
+                yield i.valid.eq(1)
+                yield
+                if (yield i.ready) == 1:
+                    g += 1
+        yield i.valid.eq(0)
+        
+    def de_output_proc():
+        yield d.source.ready.eq(1)
+        for p in [payloads[0], payloads[2]]:
+            data = []
+            while True:
+                yield
+                if (yield d.source.valid) == 1:
+                    data.append((yield d.source.data))
+                    if (yield d.source.eop) == 1:
+                        break
+            assert "".join(list(map(chr, data))) == p
+        assert (yield d.checksum_errors) == 1
+        assert (yield d.udp_checksum_errors) == 0
+    
+    sim.add_sync_process(de_input_proc)
+    sim.add_sync_process(de_output_proc)
+    
+    with sim.write_vcd("udp_de_options.vcd", "udp_de_options.gtkw"):
+        sim.run()
+
 def test_loopback_sim():
     from nmigen.back.pysim import Simulator, Passive
     from ipaddress import IPv4Address
@@ -7,8 +7,8 @@ def test_write_sim():
     from nmigen.back.pysim import Simulator, Passive
     
     class Top(Elaboratable):
-        def __init__(self):
-            self.dut = UDPTherbone()
+        def __init__(self, features):
+            self.dut = UDPTherbone(features=features)
             self.done = Signal()
             self.addr = Signal(32)
             self.data = Signal(32)
@@ -33,47 +33,113 @@ def test_write_sim():
             
             return m
     
-    addr = random.getrandbits(32)
-    data = random.getrandbits(32)
-    pkt = eb_write(addr, [data])
+    # pipelined and classic bus
+    for features in (["stall"], []):
+        addr = random.getrandbits(32)
+        data = random.getrandbits(32)
+        pkt = eb_write(addr, [data])
     
-    top = Top()
-    dut = top.dut
-    i = top.dut.sink
+        top = Top(features)
+        dut = top.dut
+        i = top.dut.sink
 
-    sim = Simulator(top)
-    sim.add_clock(1e-6)
+        sim = Simulator(top)
+        sim.add_clock(1e-6)
     
-    def transmit_proc():
-        yield dut.interface.ack.eq(1)
-        yield
-        g = 0
-        while g < len(pkt):
-            c = pkt[g]
-            if g == 0:
-                yield i.sop.eq(1)
-            elif g == len(pkt)-1:
-                yield i.eop.eq(1)
-            else:
-                yield i.sop.eq(0)
+        def transmit_proc():
+            yield dut.interface.ack.eq(1)
+            yield
+            g = 0
+            while g < len(pkt):
+                c = pkt[g]
+                if g == 0:
+                    yield i.sop.eq(1)
+                elif g == len(pkt)-1:
+                    yield i.eop.eq(1)
+                else:
+                    yield i.sop.eq(0)
+                    yield i.eop.eq(0)
+                yield i.data.eq(c)
+                yield i.valid.eq(1)
+                yield
+                if (yield i.ready) == 1:
+                    g += 1
+            while not (yield top.done):
                 yield i.eop.eq(0)
-            yield i.data.eq(c)
-            yield i.valid.eq(1)
+                yield i.valid.eq(0)
+                yield
+        
+            assert (yield top.addr) == addr
+            assert (yield top.data) == data
+        
+        sim.add_sync_process(transmit_proc)
+    
+        with sim.write_vcd("wb.vcd", "wb.gtkw"):
+            sim.run()
+
+def test_write_byteen_sim():
+    import random
+    from nmigen.back.pysim import Simulator, Passive
+    
+    class Top(Elaboratable):
+        def __init__(self, features):
+            self.dut = UDPTherbone(features=features)
+            self.done = Signal()
+            self.data = Signal(32)
+            self.sel = Signal(4)
+            pass
+        
+        def elaborate(self, platform):
+            
+            m = Module()
+            
+            m.submodules.dut = dut = self.dut
+            
+            m.d.comb += dut.interface.ack.eq(1)
+            
+            with m.If(dut.interface.stb & dut.interface.cyc & dut.interface.we):
+                m.d.sync += self.data.eq(dut.interface.dat_w)
+                m.d.sync += self.sel.eq(dut.interface.sel)
+                m.d.sync += self.done.eq(1)
+            
+            return m
+    
+    # pipelined and classic bus
+    for features in (["stall"], []):
+        data = random.getrandbits(32)
+        byteen = random.choice([0x1, 0x3, 0x5, 0x8, 0xC])
+        pkt = eb_write(random.getrandbits(32), [data], byteen=byteen)
+    
+        top = Top(features)
+        dut = top.dut
+        i = top.dut.sink
+
+        sim = Simulator(top)
+        sim.add_clock(1e-6)
+    
+        def transmit_proc():
             yield
-            if (yield i.ready) == 1:
-                g += 1
-        while not (yield top.done):
-            yield i.eop.eq(0)
+            g = 0
+            while g < len(pkt):
+                c = pkt[g]
+                yield i.sop.eq(g == 0)
+                yield i.eop.eq(g == len(pkt)-1)
+                yield i.data.eq(c)
+                yield i.valid.eq(1)
+                yield
+                if (yield i.ready) == 1:
+                    g += 1
             yield i.valid.eq(0)
-            yield
+            while not (yield top.done):
+                yield
         
-        assert (yield top.addr) == addr
-        assert (yield top.data) == data
+            assert (yield top.data) == data
+            assert (yield top.sel) == byteen
         
-    sim.add_sync_process(transmit_proc)
+        sim.add_sync_process(transmit_proc)
     
-    with sim.write_vcd("wb.vcd", "wb.gtkw"):
-        sim.run()
+        with sim.write_vcd("wb_byteen.vcd", "wb_byteen.gtkw"):
+            sim.run()
 
 def test_write_multi_sim():
     import random
@@ -160,6 +226,251 @@ def test_write_multi_sim():
     
     with sim.write_vcd("wb_multi.vcd", "wb_multi.gtkw"):
         sim.run()
+    
+    # two records in one packet, on a classic bus whose slave takes 20 cycles to ACK - the second record's
+    # address is read while the first record's last write is still waiting
+    class SlowTop(Elaboratable):
+        def __init__(self, count):
+            self.dut = UDPTherbone(features=[])
+            self.done = Signal(range(count + 1))
+            self.addrs = [Signal(32) for _ in range(count)]
+            self.datas = [Signal(32) for _ in range(count)]
+        
+        def elaborate(self, platform):
+            m = Module()
+            
+            m.submodules.dut = dut = self.dut
+            
+            wait = Signal(range(21))
+            m.d.sync += dut.interface.ack.eq(0)
+            with m.If(dut.interface.stb & dut.interface.cyc & ~dut.interface.ack):
+                m.d.sync += wait.eq(wait + 1)
+                with m.If(wait == 19):
+                    m.d.sync += wait.eq(0)
+                    m.d.sync += dut.interface.ack.eq(1)
+                    with m.Switch(self.done):
+                        for i in range(len(self.addrs)):
+                            with m.Case(i):
+                                m.d.sync += self.addrs[i].eq(dut.interface.adr)
+                                m.d.sync += self.datas[i].eq(dut.interface.dat_w)
+                    m.d.sync += self.done.eq(self.done + 1)
+            
+            return m
+    
+    datas = [random.getrandbits(32) for _ in range(3)]
+    # the second record without the packet header
+    pkt = eb_write(0x100, datas[:2]) + eb_write(0x200, datas[2:])[4:]
+    
+    top = SlowTop(len(datas))
+    dut = top.dut
+    i = top.dut.sink
+    
+    sim = Simulator(top)
+    sim.add_clock(1e-6)
+    
+    def slow_transmit_proc():
+        yield
+        g = 0
+        while g < len(pkt):
+            yield i.sop.eq(g == 0)
+            yield i.eop.eq(g == len(pkt)-1)
+            yield i.data.eq(pkt[g])
+            yield i.valid.eq(1)
+            yield
+            if (yield i.ready) == 1:
+                g += 1
+        yield i.valid.eq(0)
+        while (yield top.done) < len(datas):
+            yield
+        
+        for (n, addr) in enumerate([0x100, 0x101, 0x200]):
+            assert (yield top.addrs[n]) == addr
+            assert (yield top.datas[n]) == datas[n]
+        
+    sim.add_sync_process(slow_transmit_proc)
+    
+    with sim.write_vcd("wb_multi_slow.vcd", "wb_multi_slow.gtkw"):
+        sim.run()
+
+def test_write_pipelined_sim():
+    import random
+    from nmigen.back.pysim import Simulator, Passive
+    
+    class Top(Elaboratable):
+        def __init__(self, count):
+            self.dut = UDPTherbone()
+            self.release = Signal()
+            self.done = Signal(range(count + 1))
+            self.first = Signal(16)
+            self.last = Signal(16)
+            self.cycle = Signal(16)
+            self.addrs = [Signal(32) for _ in range(count)]
+            self.datas = [Signal(32) for _ in range(count)]
+            pass
+        
+        def elaborate(self, platform):
+            
+            m = Module()
+            
+            m.submodules.dut = dut = self.dut
+            
+            # stall until the whole record has been captured, then accept an access every cycle
+            m.d.comb += dut.interface.stall.eq(~self.release)
+            m.d.sync += dut.interface.ack.eq(dut.interface.stb & dut.interface.cyc & ~dut.interface.stall)
+            m.d.sync += self.cycle.eq(self.cycle + 1)
+            
+            with m.If(dut.interface.stb & dut.interface.cyc & dut.interface.we & ~dut.interface.stall):
+                with m.Switch(self.done):
+                    for i in range(len(self.datas)):
+                        with m.Case(i):
+                            m.d.sync += self.addrs[i].eq(dut.interface.adr)
+                            m.d.sync += self.datas[i].eq(dut.interface.dat_w)
+                with m.If(self.done == 0):
+                    m.d.sync += self.first.eq(self.cycle)
+                m.d.sync += self.last.eq(self.cycle)
+                m.d.sync += self.done.eq(self.done + 1)
+            
+            return m
+    
+    count = 4
+    addr = random.getrandbits(31)
+    datas = [random.getrandbits(32) for _ in range(count)]
+    pkt = eb_write(addr, datas)
+    
+    top = Top(count)
+    dut = top.dut
+    i = top.dut.sink
+
+    sim = Simulator(top)
+    sim.add_clock(1e-6)
+    
+    def transmit_proc():
+        yield
+        g = 0
+        while g < len(pkt):
+            c = pkt[g]
+            yield i.sop.eq(0)
+            yield i.eop.eq(0)
+            if g == 0:
+                yield i.sop.eq(1)
+            if g == len(pkt)-1:
+                yield i.eop.eq(1)
+            yield i.data.eq(c)
+            yield i.valid.eq(1)
+            yield
+            if (yield i.ready) == 1:
+                g += 1
+        yield i.valid.eq(0)
+        for _ in range(16):
+            yield
+        yield top.release.eq(1)
+        while (yield top.done) < count:
+            yield
+        for _ in range(4):
+            yield
+        
+        for g in range(count):
+            assert (yield top.addrs[g]) == addr + g
+            assert (yield top.datas[g]) == datas[g]
+        # back-to-back strobes, one access per clock
+        assert (yield top.last) - (yield top.first) == count - 1
+        # CYC is released once all ACKs are in
+        assert (yield dut.interface.cyc) == 0
+        
+    sim.add_sync_process(transmit_proc)
+    
+    with sim.write_vcd("wb_pipelined.vcd", "wb_pipelined.gtkw"):
+        sim.run()
+
+def test_write_outstanding_sim():
+    import random
+    from nmigen.back.pysim import Simulator, Passive
+    
+    class Top(Elaboratable):
+        def __init__(self, count, depth, latency):
+            self.dut = UDPTherbone(max_outstanding_writes=depth)
+            self.latency = latency
+            self.release = Signal()
+            self.done = Signal(range(count + 1))
+            self.in_flight = Signal(8)
+            self.peak = Signal(8)
+            self.datas = [Signal(32) for _ in range(count)]
+            pass
+        
+        def elaborate(self, platform):
+            
+            m = Module()
+            
+            m.submodules.dut = dut = self.dut
+            
+            # pipelined slave with a fixed write latency
+            m.d.comb += dut.interface.stall.eq(~self.release)
+            accept = Signal()
+            m.d.comb += accept.eq(dut.interface.stb & dut.interface.cyc & dut.interface.we & ~dut.interface.stall)
+            acks = Signal(self.latency)
+            m.d.sync += acks.eq(Cat(accept, acks[:-1]))
+            m.d.comb += dut.interface.ack.eq(acks[-1])
+            
+            with m.If(accept):
+                with m.Switch(self.done):
+                    for i in range(len(self.datas)):
+                        with m.Case(i):
+                            m.d.sync += self.datas[i].eq(dut.interface.dat_w)
+                m.d.sync += self.done.eq(self.done + 1)
+            
+            in_flight_next = self.in_flight + accept - dut.interface.ack
+            m.d.sync += self.in_flight.eq(in_flight_next)
+            with m.If(in_flight_next > self.peak):
+                m.d.sync += self.peak.eq(in_flight_next)
+            
+            return m
+    
+    count = 6
+    depth = 2
+    datas = [random.getrandbits(32) for _ in range(count)]
+    pkt = eb_write(random.getrandbits(31), datas)
+    
+    top = Top(count, depth, latency=5)
+    dut = top.dut
+    i = top.dut.sink
+
+    sim = Simulator(top)
+    sim.add_clock(1e-6)
+    
+    def transmit_proc():
+        yield
+        g = 0
+        while g < len(pkt):
+            c = pkt[g]
+            yield i.sop.eq(0)
+            yield i.eop.eq(0)
+            if g == 0:
+                yield i.sop.eq(1)
+            if g == len(pkt)-1:
+                yield i.eop.eq(1)
+            yield i.data.eq(c)
+            yield i.valid.eq(1)
+            yield
+            if (yield i.ready) == 1:
+                g += 1
+        yield i.valid.eq(0)
+        for _ in range(16):
+            yield
+        yield top.release.eq(1)
+        while (yield top.done) < count:
+            yield
+        for _ in range(8):
+            yield
+        
+        for g in range(count):
+            assert (yield top.datas[g]) == datas[g]
+        assert (yield top.peak) == depth
+        assert (yield dut.interface.cyc) == 0
+        
+    sim.add_sync_process(transmit_proc)
+    
+    with sim.write_vcd("wb_wr_outstanding.vcd", "wb_wr_outstanding.gtkw"):
+        sim.run()
 
 def test_read_noret_sim():
     import random
@@ -252,25 +563,502 @@ def test_read_sim():
             addr = self.addr
             done = self.done
             
-            m.d.sync += dut.interface.ack.eq(0)
+            m.d.sync += dut.interface.ack.eq(0)
+            
+            with m.If(dut.interface.stb & dut.interface.cyc & ~dut.interface.we):
+                m.d.sync += addr.eq(dut.interface.adr)
+                m.d.sync += dut.interface.dat_r.eq(self.data)
+                m.d.sync += dut.interface.ack.eq(1)
+                m.d.sync += done.eq(1)
+            
+            return m
+    
+    addr = random.getrandbits(32)
+    print()
+    print(hex(addr))
+    pkt = eb_read([addr])
+    
+    data = random.getrandbits(32)
+    #data = 0xBABECAFE
+    print(hex(data))
+    top = Top(data)
+    dut = top.dut
+    i = top.dut.sink
+    o = top.dut.source
+
+    sim = Simulator(top)
+    sim.add_clock(1e-6)
+    
+    def transmit_proc():
+        yield
+        g = 0
+        while g < len(pkt):
+            c = pkt[g]
+            if g == 0:
+                yield i.sop.eq(1)
+            elif g == len(pkt)-1:
+                yield i.eop.eq(1)
+            else:
+                yield i.sop.eq(0)
+                yield i.eop.eq(0)
+            yield i.data.eq(c)
+            yield i.valid.eq(1)
+            yield
+            if (yield i.ready) == 1:
+                g += 1
+        while not (yield top.done):
+            yield i.eop.eq(0)
+            yield i.valid.eq(0)
+            yield
+        yield
+        
+        assert (yield top.addr) == addr
+        
+    def receive_proc():
+        import struct
+        for g in range(0, 16):
+            yield
+        recv = bytearray()
+        yield o.ready.eq(1)
+        yield
+        while not (yield o.eop):
+            if (yield o.valid) == 1:
+                recv.append((yield o.data))
+            yield
+        if (yield o.valid) == 1:
+            recv.append((yield o.data))
+        yield
+        
+        assert struct.unpack("!L", recv[8:12])[0] == 0xdeadbeef
+        assert struct.unpack("!L", recv[12:16])[0] == data
+        
+    sim.add_sync_process(transmit_proc)
+    sim.add_sync_process(receive_proc)
+    
+    with sim.write_vcd("wb_rd.vcd", "wb_rd.gtkw"):
+        sim.run()
+
+def test_read_delay_sim():
+    import random
+    from nmigen.back.pysim import Simulator, Passive
+    
+    class Top(Elaboratable):
+        def __init__(self, data):
+            self.dut = UDPTherbone()
+            self.done = Signal()
+            self.addr = Signal(32)
+            self.data = data
+            pass
+        
+        def elaborate(self, platform):
+            
+            m = Module()
+            
+            m.submodules.dut = dut = self.dut
+            
+            addr = self.addr
+            done = self.done
+            
+            counter = Signal(3)
+            
+            m.d.sync += dut.interface.ack.eq(0)
+            
+            with m.If(dut.interface.stb & dut.interface.cyc & ~dut.interface.we):
+                m.d.sync += counter.eq(1)
+                m.d.sync += addr.eq(dut.interface.adr)
+            
+            with m.If(counter > 0):
+                m.d.sync += counter.eq(counter + 1)
+            
+            with m.If(counter == 4):
+                m.d.sync += dut.interface.dat_r.eq(self.data)
+                m.d.sync += dut.interface.ack.eq(1)
+                m.d.sync += done.eq(1)
+            
+            return m
+    
+    addr = random.getrandbits(32)
+    print()
+    print(hex(addr))
+    pkt = eb_read([addr])
+    
+    data = random.getrandbits(32)
+    #data = 0xBABECAFE
+    print(hex(data))
+    top = Top(data)
+    dut = top.dut
+    i = top.dut.sink
+    o = top.dut.source
+
+    sim = Simulator(top)
+    sim.add_clock(1e-6)
+    
+    def transmit_proc():
+        yield
+        g = 0
+        while g < len(pkt):
+            c = pkt[g]
+            if g == 0:
+                yield i.sop.eq(1)
+            elif g == len(pkt)-1:
+                yield i.eop.eq(1)
+            else:
+                yield i.sop.eq(0)
+                yield i.eop.eq(0)
+            yield i.data.eq(c)
+            yield i.valid.eq(1)
+            yield
+            if (yield i.ready) == 1:
+                g += 1
+        while not (yield top.done):
+            yield i.eop.eq(0)
+            yield i.valid.eq(0)
+            yield
+        yield
+        
+        print("tx done")
+        
+        assert (yield top.addr) == addr
+        
+    def receive_proc():
+        import struct
+        for g in range(0, 16):
+            yield
+        recv = bytearray()
+        yield o.ready.eq(1)
+        yield
+        while not (yield o.eop):
+            if (yield o.valid) == 1:
+                recv.append((yield o.data))
+            yield
+        if (yield o.valid) == 1:
+            recv.append((yield o.data))
+        yield
+        
+        assert struct.unpack("!L", recv[8:12])[0] == 0xdeadbeef
+        assert struct.unpack("!L", recv[12:16])[0] == data
+        
+    sim.add_sync_process(transmit_proc)
+    sim.add_sync_process(receive_proc)
+    
+    with sim.write_vcd("wb_rd_dly.vcd", "wb_rd_dly.gtkw"):
+        sim.run()
+
+def test_read_record_sim():
+    import random
+    from nmigen.back.pysim import Simulator, Passive
+    
+    class Top(Elaboratable):
+        def __init__(self, datas):
+            self.dut = UDPTherbone()
+            self.datas = datas
+            pass
+        
+        def elaborate(self, platform):
+            
+            m = Module()
+            
+            m.submodules.dut = dut = self.dut
+            
+            m.d.sync += dut.interface.ack.eq(0)
+            
+            with m.If(dut.interface.stb & dut.interface.cyc & ~dut.interface.we):
+                with m.Switch(dut.interface.adr):
+                    for i in range(len(self.datas)):
+                        with m.Case(i):
+                            m.d.sync += dut.interface.dat_r.eq(self.datas[i])
+                m.d.sync += dut.interface.ack.eq(1)
+            
+            return m
+    
+    count = 3
+    # every byte of every word distinct, so a stale byte can't go unnoticed
+    datas = [0x11223344 + 0x01010101 * g for g in range(count)]
+    pkt = eb_read(list(range(count)))
+    
+    top = Top(datas)
+    dut = top.dut
+    i = top.dut.sink
+    o = top.dut.source
+
+    sim = Simulator(top)
+    sim.add_clock(1e-6)
+    
+    def transmit_proc():
+        yield
+        g = 0
+        while g < len(pkt):
+            c = pkt[g]
+            yield i.sop.eq(0)
+            yield i.eop.eq(0)
+            if g == 0:
+                yield i.sop.eq(1)
+            if g == len(pkt)-1:
+                yield i.eop.eq(1)
+            yield i.data.eq(c)
+            yield i.valid.eq(1)
+            yield
+            if (yield i.ready) == 1:
+                g += 1
+        yield i.valid.eq(0)
+        
+    def receive_proc():
+        import struct
+        recv = bytearray()
+        yield o.ready.eq(1)
+        yield
+        while not (yield o.eop):
+            if (yield o.valid) == 1:
+                recv.append((yield o.data))
+            yield
+        if (yield o.valid) == 1:
+            recv.append((yield o.data))
+        yield
+        
+        assert struct.unpack("!L", recv[8:12])[0] == 0xdeadbeef
+        for g in range(count):
+            assert struct.unpack("!L", recv[12+4*g:16+4*g])[0] == datas[g]
+        
+    sim.add_sync_process(transmit_proc)
+    sim.add_sync_process(receive_proc)
+    
+    with sim.write_vcd("wb_rd_record.vcd", "wb_rd_record.gtkw"):
+        sim.run()
+
+def test_read_multi_sim():
+    import random
+    from nmigen.back.pysim import Simulator, Passive
+    
+    class Top(Elaboratable):
+        def __init__(self, datas):
+            self.dut = UDPTherbone()
+            self.read = Signal(range(len(datas)))
+            self.addr = Signal(32)
+            self.datas = datas
+            pass
+        
+        def elaborate(self, platform):
+            
+            m = Module()
+            
+            m.submodules.dut = dut = self.dut
+            
+            addr = self.addr
+            
+            m.d.sync += dut.interface.ack.eq(0)
+            
+            with m.If(dut.interface.stb & dut.interface.cyc & ~dut.interface.we):
+                m.d.sync += addr.eq(dut.interface.adr)
+                with m.Switch(self.read):
+                    for i in range(len(datas)):
+                        with m.Case(i):
+                            m.d.sync += dut.interface.dat_r.eq(self.datas[i])
+                m.d.sync += dut.interface.ack.eq(1)
+                m.d.sync += self.read.eq(self.read + 1)
+            
+            return m
+        
+    count = 5
+    
+    addrs = [random.getrandbits(32) for _ in range(count)]
+    print()
+    print(list(map(hex, addrs)))
+    pkts = [eb_read([addrs[i]]) for i in range(count)]
+    
+    datas = [random.getrandbits(32) for _ in range(count)]
+    print(list(map(hex, datas)))
+    top = Top(datas)
+    dut = top.dut
+    i = top.dut.sink
+    o = top.dut.source
+
+    sim = Simulator(top)
+    sim.add_clock(1e-6)
+    
+    def transmit_proc():
+        yield
+        for pkt in pkts:
+            g = 0
+            while g < len(pkt):
+                c = pkt[g]
+                yield i.sop.eq(0)
+                yield i.eop.eq(0)
+                if g == 0:
+                    yield i.sop.eq(1)
+                if g == len(pkt)-1:
+                    yield i.eop.eq(1)
+                yield i.data.eq(c)
+                yield i.valid.eq(1)
+                yield
+                if (yield i.ready) == 1:
+                    g += 1
+            print("sent pkt")
+        
+    def receive_proc():
+        import struct
+        for g in range(0, 16):
+            yield
+        recv = bytearray()
+        yield o.ready.eq(1)
+        yield
+        recv = [bytearray() for _ in range(count)]
+        for g in range(count):
+            while not (yield o.sop):
+                yield
+            while not (yield o.eop):
+                if (yield o.valid) == 1:
+                    recv[g].append((yield o.data))
+                yield
+            if (yield o.valid) == 1:
+                recv[g].append((yield o.data))
+        
+        for g in range(count):
+            print(list(map(hex, recv[g])))
+            assert struct.unpack("!L", recv[g][8:12])[0] == 0xdeadbeef
+            assert struct.unpack("!L", recv[g][12:16])[0] == datas[g]
+        
+    sim.add_sync_process(transmit_proc)
+    sim.add_sync_process(receive_proc)
+    
+    with sim.write_vcd("wb_rd_multi.vcd", "wb_rd_multi.gtkw"):
+        sim.run()
+
+def test_write_read_sim():
+    import random
+    from nmigen.back.pysim import Simulator, Passive
+    
+    class Top(Elaboratable):
+        def __init__(self, features, data):
+            self.dut = UDPTherbone(features=features)
+            self.done = Signal()
+            self.wdata = Signal(32)
+            self.data = data
+            pass
+        
+        def elaborate(self, platform):
+            
+            m = Module()
+            
+            m.submodules.dut = dut = self.dut
+            
+            # slave acking in the same cycle as the access
+            m.d.comb += dut.interface.ack.eq(dut.interface.stb & dut.interface.cyc)
+            m.d.comb += dut.interface.dat_r.eq(self.data)
+            
+            with m.If(dut.interface.stb & dut.interface.cyc & dut.interface.we):
+                m.d.sync += self.wdata.eq(dut.interface.dat_w)
+                m.d.sync += self.done.eq(1)
+            
+            return m
+    
+    # pipelined and classic bus
+    for features in (["stall"], []):
+        wdata = random.getrandbits(32)
+        data = random.getrandbits(32)
+        pkts = [eb_write(random.getrandbits(32), [wdata]), eb_read([random.getrandbits(32)])]
+    
+        top = Top(features, data)
+        dut = top.dut
+        i = top.dut.sink
+        o = top.dut.source
+
+        sim = Simulator(top)
+        sim.add_clock(1e-6)
+    
+        def transmit_proc():
+            yield
+            for pkt in pkts:
+                g = 0
+                while g < len(pkt):
+                    c = pkt[g]
+                    yield i.sop.eq(g == 0)
+                    yield i.eop.eq(g == len(pkt)-1)
+                    yield i.data.eq(c)
+                    yield i.valid.eq(1)
+                    yield
+                    if (yield i.ready) == 1:
+                        g += 1
+                yield i.valid.eq(0)
+                yield
+            
+            assert (yield top.done) == 1
+            assert (yield top.wdata) == wdata
+        
+        def receive_proc():
+            import struct
+            recv = bytearray()
+            yield o.ready.eq(1)
+            yield
+            while not (yield o.eop):
+                if (yield o.valid) == 1:
+                    recv.append((yield o.data))
+                yield
+            if (yield o.valid) == 1:
+                recv.append((yield o.data))
+            yield
+            
+            assert struct.unpack("!L", recv[8:12])[0] == 0xdeadbeef
+            assert struct.unpack("!L", recv[12:16])[0] == data
+            assert (yield dut.interface.cyc) == 0
+            assert (yield dut.length) == len(recv)
+            
+        sim.add_sync_process(transmit_proc)
+        sim.add_sync_process(receive_proc)
+    
+        with sim.write_vcd("wb_wr_rd.vcd", "wb_wr_rd.gtkw"):
+            sim.run()
+
+def test_read_outstanding_sim():
+    import random
+    from nmigen.back.pysim import Simulator, Passive
+    
+    class Top(Elaboratable):
+        def __init__(self, datas, depth, latency):
+            self.dut = UDPTherbone(max_outstanding_reads=depth)
+            self.datas = datas
+            self.latency = latency
+            self.release = Signal()
+            self.in_flight = Signal(8)
+            self.peak = Signal(8)
+            pass
+        
+        def elaborate(self, platform):
+            
+            m = Module()
+            
+            m.submodules.dut = dut = self.dut
             
-            with m.If(dut.interface.stb & dut.interface.cyc & ~dut.interface.we):
-                m.d.sync += addr.eq(dut.interface.adr)
-                m.d.sync += dut.interface.dat_r.eq(self.data)
-                m.d.sync += dut.interface.ack.eq(1)
-                m.d.sync += done.eq(1)
+            # pipelined slave with a fixed read latency, data chosen by the low address bits
+            # stall until the whole record has been captured so the master can run ahead
+            m.d.comb += dut.interface.stall.eq(~self.release)
+            accept = Signal()
+            m.d.comb += accept.eq(dut.interface.stb & dut.interface.cyc & ~dut.interface.we & ~dut.interface.stall)
+            acks = Signal(self.latency)
+            idxs = [Signal(range(len(self.datas))) for _ in range(self.latency)]
+            m.d.sync += acks.eq(Cat(accept, acks[:-1]))
+            m.d.sync += idxs[0].eq(dut.interface.adr)
+            for i in range(1, self.latency):
+                m.d.sync += idxs[i].eq(idxs[i-1])
+            m.d.comb += dut.interface.ack.eq(acks[-1])
+            with m.Switch(idxs[-1]):
+                for i in range(len(self.datas)):
+                    with m.Case(i):
+                        m.d.comb += dut.interface.dat_r.eq(self.datas[i])
+            
+            in_flight_next = self.in_flight + accept - dut.interface.ack
+            m.d.sync += self.in_flight.eq(in_flight_next)
+            with m.If(in_flight_next > self.peak):
+                m.d.sync += self.peak.eq(in_flight_next)
             
             return m
+        
+    count = 6
+    depth = 3
     
-    addr = random.getrandbits(32)
-    print()
-    print(hex(addr))
-    pkt = eb_read([addr])
+    datas = [random.getrandbits(32) for _ in range(count)]
+    pkt = eb_read(list(range(count)))
     
-    data = random.getrandbits(32)
-    #data = 0xBABECAFE
-    print(hex(data))
-    top = Top(data)
+    top = Top(datas, depth, latency=5)
     dut = top.dut
     i = top.dut.sink
     o = top.dut.source
@@ -283,30 +1071,24 @@ def test_read_sim():
         g = 0
         while g < len(pkt):
             c = pkt[g]
+            yield i.sop.eq(0)
+            yield i.eop.eq(0)
             if g == 0:
                 yield i.sop.eq(1)
-            elif g == len(pkt)-1:
+            if g == len(pkt)-1:
                 yield i.eop.eq(1)
-            else:
-                yield i.sop.eq(0)
-                yield i.eop.eq(0)
             yield i.data.eq(c)
             yield i.valid.eq(1)
             yield
             if (yield i.ready) == 1:
                 g += 1
-        while not (yield top.done):
-            yield i.eop.eq(0)
-            yield i.valid.eq(0)
+        yield i.valid.eq(0)
+        for _ in range(16):
             yield
-        yield
-        
-        assert (yield top.addr) == addr
+        yield top.release.eq(1)
         
     def receive_proc():
         import struct
-        for g in range(0, 16):
-            yield
         recv = bytearray()
         yield o.ready.eq(1)
         yield
@@ -319,24 +1101,27 @@ def test_read_sim():
         yield
         
         assert struct.unpack("!L", recv[8:12])[0] == 0xdeadbeef
-        assert struct.unpack("!L", recv[12:16])[0] == data
+        for g in range(count):
+            assert struct.unpack("!L", recv[12+4*g:16+4*g])[0] == datas[g]
+        assert (yield top.peak) == depth
         
     sim.add_sync_process(transmit_proc)
     sim.add_sync_process(receive_proc)
     
-    with sim.write_vcd("wb_rd.vcd", "wb_rd.gtkw"):
+    with sim.write_vcd("wb_rd_outstanding.vcd", "wb_rd_outstanding.gtkw"):
         sim.run()
 
-def test_read_delay_sim():
+def test_hold_cyc_sim():
+    import itertools
     import random
     from nmigen.back.pysim import Simulator, Passive
     
     class Top(Elaboratable):
-        def __init__(self, data):
-            self.dut = UDPTherbone()
-            self.done = Signal()
-            self.addr = Signal(32)
-            self.data = data
+        def __init__(self, count, features):
+            self.dut = UDPTherbone(features=features, hold_cyc=True)
+            self.done = Signal(range(count + 1))
+            self.cycles = Signal(8)
+            self.datas = [Signal(32) for _ in range(count)]
             pass
         
         def elaborate(self, platform):
@@ -345,36 +1130,119 @@ def test_read_delay_sim():
             
             m.submodules.dut = dut = self.dut
             
-            addr = self.addr
-            done = self.done
+            # slave acking every access on the following cycle
+            accept = Signal()
+            m.d.comb += accept.eq(dut.interface.stb & dut.interface.cyc & dut.interface.we & ~dut.interface.ack)
+            if hasattr(dut.interface, "stall"):
+                m.d.comb += dut.interface.stall.eq(0)
+            m.d.sync += dut.interface.ack.eq(accept)
             
-            counter = Signal(3)
+            with m.If(accept):
+                with m.Switch(self.done):
+                    for i in range(len(self.datas)):
+                        with m.Case(i):
+                            m.d.sync += self.datas[i].eq(dut.interface.dat_w)
+                m.d.sync += self.done.eq(self.done + 1)
             
-            m.d.sync += dut.interface.ack.eq(0)
+            # count the bus cycles
+            cyc_prev = Signal()
+            m.d.sync += cyc_prev.eq(dut.interface.cyc)
+            with m.If(dut.interface.cyc & ~cyc_prev):
+                m.d.sync += self.cycles.eq(self.cycles + 1)
             
-            with m.If(dut.interface.stb & dut.interface.cyc & ~dut.interface.we):
-                m.d.sync += counter.eq(1)
-                m.d.sync += addr.eq(dut.interface.adr)
+            return m
+    
+    # the cycle is closed either by a second record with writes, or by an empty record with CYC set
+    for (features, empty) in itertools.product((["stall"], []), (False, True)):
+        datas = [random.getrandbits(32) for _ in range(2 if empty else 4)]
+        # the first record leaves the cycle open, the second one closes it
+        pkts = [eb_write(random.getrandbits(31), datas[:2], cyc=False)]
+        if empty:
+            # just the header and the record's flags and counts
+            pkts.append(eb_write(0, [])[:8])
+        else:
+            pkts.append(eb_write(random.getrandbits(31), datas[2:]))
+        
+        top = Top(len(datas), features)
+        dut = top.dut
+        i = top.dut.sink
+    
+        sim = Simulator(top)
+        sim.add_clock(1e-6)
+        
+        def transmit_proc():
+            yield
+            for pkt in pkts:
+                g = 0
+                while g < len(pkt):
+                    c = pkt[g]
+                    yield i.sop.eq(0)
+                    yield i.eop.eq(0)
+                    if g == 0:
+                        yield i.sop.eq(1)
+                    if g == len(pkt)-1:
+                        yield i.eop.eq(1)
+                    yield i.data.eq(c)
+                    yield i.valid.eq(1)
+                    yield
+                    if (yield i.ready) == 1:
+                        g += 1
+                yield i.valid.eq(0)
+                for _ in range(8):
+                    yield
+                # the first record's cycle is still open while we wait for the next one
+                if pkt is pkts[0]:
+                    assert (yield dut.interface.cyc) == 1
+            while (yield top.done) < len(datas):
+                yield
+            for _ in range(4):
+                yield
             
-            with m.If(counter > 0):
-                m.d.sync += counter.eq(counter + 1)
+            for g in range(len(datas)):
+                assert (yield top.datas[g]) == datas[g]
+            assert (yield top.cycles) == 1
+            assert (yield dut.interface.cyc) == 0
             
-            with m.If(counter == 4):
-                m.d.sync += dut.interface.dat_r.eq(self.data)
-                m.d.sync += dut.interface.ack.eq(1)
-                m.d.sync += done.eq(1)
+        sim.add_sync_process(transmit_proc)
+        
+        with sim.write_vcd("wb_hold_cyc.vcd", "wb_hold_cyc.gtkw"):
+            sim.run()
+
+def test_cut_through_sim():
+    import random
+    from nmigen.back.pysim import Simulator, Passive
+    
+    class Top(Elaboratable):
+        def __init__(self, count, data):
+            self.dut = UDPTherbone(cut_through=True)
+            self.done = Signal(range(count + 1))
+            self.datas = [Signal(32) for _ in range(count)]
+            self.data = data
+            pass
+        
+        def elaborate(self, platform):
+            
+            m = Module()
+            
+            m.submodules.dut = dut = self.dut
+            
+            m.d.comb += dut.interface.ack.eq(dut.interface.stb)
+            m.d.comb += dut.interface.dat_r.eq(self.data)
+            
+            with m.If(dut.interface.stb & dut.interface.cyc & dut.interface.we):
+                with m.Switch(self.done):
+                    for i in range(len(self.datas)):
+                        with m.Case(i):
+                            m.d.sync += self.datas[i].eq(dut.interface.dat_w)
+                m.d.sync += self.done.eq(self.done + 1)
             
             return m
     
-    addr = random.getrandbits(32)
-    print()
-    print(hex(addr))
-    pkt = eb_read([addr])
-    
+    datas = [random.getrandbits(32) for _ in range(3)]
     data = random.getrandbits(32)
-    #data = 0xBABECAFE
-    print(hex(data))
-    top = Top(data)
+    pkts = [eb_write(random.getrandbits(32), datas), eb_read([random.getrandbits(32)])]
+    
+    top = Top(len(datas), data)
     dut = top.dut
     i = top.dut.sink
     o = top.dut.source
@@ -384,35 +1252,33 @@ def test_read_delay_sim():
     
     def transmit_proc():
         yield
-        g = 0
-        while g < len(pkt):
-            c = pkt[g]
-            if g == 0:
-                yield i.sop.eq(1)
-            elif g == len(pkt)-1:
-                yield i.eop.eq(1)
-            else:
-                yield i.sop.eq(0)
-                yield i.eop.eq(0)
-            yield i.data.eq(c)
-            yield i.valid.eq(1)
-            yield
-            if (yield i.ready) == 1:
-                g += 1
-        while not (yield top.done):
-            yield i.eop.eq(0)
+        for pkt in pkts:
+            g = 0
+            while g < len(pkt):
+                c = pkt[g]
+                yield i.sop.eq(g == 0)
+                yield i.eop.eq(g == len(pkt)-1)
+                yield i.data.eq(c)
+                yield i.valid.eq(1)
+                yield
+                if (yield i.ready) == 1:
+                    g += 1
+                    # the first write goes out a few cycles after its last byte, not after the record
+                    if pkt is pkts[0] and g == 16:
+                        for _ in range(4):
+                            yield i.valid.eq(0)
+                            yield
+                        assert (yield top.done) == 1
             yield i.valid.eq(0)
             yield
-        yield
-        
-        print("tx done")
         
-        assert (yield top.addr) == addr
+        while (yield top.done) < len(datas):
+            yield
+        for g in range(len(datas)):
+            assert (yield top.datas[g]) == datas[g]
         
     def receive_proc():
         import struct
-        for g in range(0, 16):
-            yield
         recv = bytearray()
         yield o.ready.eq(1)
         yield
@@ -430,19 +1296,20 @@ def test_read_delay_sim():
     sim.add_sync_process(transmit_proc)
     sim.add_sync_process(receive_proc)
     
-    with sim.write_vcd("wb_rd_dly.vcd", "wb_rd_dly.gtkw"):
+    with sim.write_vcd("wb_cut_through.vcd", "wb_cut_through.gtkw"):
         sim.run()
 
-def test_read_multi_sim():
+def test_burst_sim():
     import random
     from nmigen.back.pysim import Simulator, Passive
     
     class Top(Elaboratable):
-        def __init__(self, datas):
-            self.dut = UDPTherbone()
-            self.read = Signal(range(len(datas)))
-            self.addr = Signal(32)
-            self.datas = datas
+        def __init__(self, count):
+            self.dut = UDPTherbone(features=[], bursts=True)
+            self.release = Signal()
+            self.cycle = Signal(16)
+            self.done = Signal(range(count + 1))
+            self.log = [(Signal(32), Signal(32), Signal(3), Signal(16)) for _ in range(count)]
             pass
         
         def elaborate(self, platform):
@@ -451,31 +1318,32 @@ def test_read_multi_sim():
             
             m.submodules.dut = dut = self.dut
             
-            addr = self.addr
-            
-            m.d.sync += dut.interface.ack.eq(0)
+            # zero wait state slave, held off until the requests have been captured
+            accept = Signal()
+            m.d.comb += accept.eq(dut.interface.stb & dut.interface.cyc & self.release)
+            m.d.comb += dut.interface.ack.eq(accept)
+            m.d.comb += dut.interface.dat_r.eq(dut.interface.adr)
+            m.d.sync += self.cycle.eq(self.cycle + 1)
             
-            with m.If(dut.interface.stb & dut.interface.cyc & ~dut.interface.we):
-                m.d.sync += addr.eq(dut.interface.adr)
-                with m.Switch(self.read):
-                    for i in range(len(datas)):
+            with m.If(accept):
+                with m.Switch(self.done):
+                    for i, (adr, dat, cti, cycle) in enumerate(self.log):
                         with m.Case(i):
-                            m.d.sync += dut.interface.dat_r.eq(self.datas[i])
-                m.d.sync += dut.interface.ack.eq(1)
-                m.d.sync += self.read.eq(self.read + 1)
+                            m.d.sync += adr.eq(dut.interface.adr)
+                            m.d.sync += dat.eq(dut.interface.dat_w)
+                            m.d.sync += cti.eq(dut.interface.cti)
+                            m.d.sync += cycle.eq(self.cycle)
+                m.d.sync += self.done.eq(self.done + 1)
             
             return m
-        
-    count = 5
     
-    addrs = [random.getrandbits(32) for _ in range(count)]
-    print()
-    print(list(map(hex, addrs)))
-    pkts = [eb_read([addrs[i]]) for i in range(count)]
+    addr = random.getrandbits(30)
+    datas = [random.getrandbits(32) for _ in range(4)]
+    r_addrs = [addr, addr + 1, addr + 2, addr + 7]
+    pkts = [eb_write(addr, datas), eb_read(r_addrs)]
+    count = len(datas) + len(r_addrs)
     
-    datas = [random.getrandbits(32) for _ in range(count)]
-    print(list(map(hex, datas)))
-    top = Top(datas)
+    top = Top(count)
     dut = top.dut
     i = top.dut.sink
     o = top.dut.source
@@ -485,7 +1353,7 @@ def test_read_multi_sim():
     
     def transmit_proc():
         yield
-        for pkt in pkts:
+        for (pkt, target) in zip(pkts, [len(datas), count]):
             g = 0
             while g < len(pkt):
                 c = pkt[g]
@@ -500,35 +1368,48 @@ def test_read_multi_sim():
                 yield
                 if (yield i.ready) == 1:
                     g += 1
-            print("sent pkt")
+            yield i.valid.eq(0)
+            for _ in range(16):
+                yield
+            yield top.release.eq(1)
+            while (yield top.done) < target:
+                yield
+            yield top.release.eq(0)
+        yield
+        
+        log = []
+        for (adr, dat, cti, cycle) in top.log:
+            log.append(((yield adr), (yield dat), (yield cti), (yield cycle)))
+        
+        # incrementing write burst, one beat per clock
+        assert [x[0] for x in log[:4]] == [addr + g for g in range(4)]
+        assert [x[1] for x in log[:4]] == datas
+        assert [x[2] for x in log[:4]] == [0b010, 0b010, 0b010, 0b111]
+        assert log[3][3] - log[0][3] == 3
+        # reads only burst while their addresses are consecutive
+        assert [x[0] for x in log[4:]] == r_addrs
+        assert [x[2] for x in log[4:]] == [0b010, 0b010, 0b111, 0b000]
         
     def receive_proc():
         import struct
-        for g in range(0, 16):
-            yield
         recv = bytearray()
         yield o.ready.eq(1)
         yield
-        recv = [bytearray() for _ in range(count)]
-        for g in range(count):
-            while not (yield o.sop):
-                yield
-            while not (yield o.eop):
-                if (yield o.valid) == 1:
-                    recv[g].append((yield o.data))
-                yield
+        while not (yield o.eop):
             if (yield o.valid) == 1:
-                recv[g].append((yield o.data))
+                recv.append((yield o.data))
+            yield
+        if (yield o.valid) == 1:
+            recv.append((yield o.data))
+        yield
         
-        for g in range(count):
-            print(list(map(hex, recv[g])))
-            assert struct.unpack("!L", recv[g][8:12])[0] == 0xdeadbeef
-            assert struct.unpack("!L", recv[g][12:16])[0] == datas[g]
+        for g in range(len(r_addrs)):
+            assert struct.unpack("!L", recv[12+4*g:16+4*g])[0] == r_addrs[g]
         
     sim.add_sync_process(transmit_proc)
     sim.add_sync_process(receive_proc)
     
-    with sim.write_vcd("wb_rd_multi.vcd", "wb_rd_multi.gtkw"):
+    with sim.write_vcd("wb_burst.vcd", "wb_burst.gtkw"):
         sim.run()
 
 def test_full_sim():
@@ -828,3 +1709,139 @@ def test_full_multi_sim():
     with sim.write_vcd("wb_full_multi.vcd", "wb_full_multi.gtkw"):
         sim.run()
 
+
+def test_baud_switch_sim():
+    from nmigen.back.pysim import Simulator, Passive
+    from ipaddress import IPv4Address
+    from udptherbone.slip import SLIPUnframer, SLIPFramer, slip_encode, slip_decode
+    from udptherbone.uart import UARTTx, UARTRx, UARTBaudControl, divisor_fixed
+    import struct
+    
+    old_divisor = 8
+    new_divisor = 5.5
+    
+    class Top(Elaboratable):
+        def __init__(self):
+            host_addr = IPv4Address("127.0.0.1")
+            host_port = 2574
+            dest_addr = IPv4Address("127.0.0.2")
+            dest_port = 7777
+            self.i = i = StreamSource(Layout([("data", 8, DIR_FANOUT)]), name="input", sop=False, eop=False)
+            # host side
+            self.tx1 = tx1 = UARTTx(divisor = old_divisor, dynamic = True)
+            self.rx1 = rx1 = UARTRx(divisor = old_divisor, dynamic = True, min_divisor = 4)
+            self.o = o = rx1.source
+            # device side
+            self.rx = rx = UARTRx(divisor = old_divisor, dynamic = True, min_divisor = 4)
+            self.u = u = SLIPUnframer(rx.source)
+            self.d = d = UDPDepacketizer(u.source, dest_addr, port = dest_port)
+            self.wb = wb = UDPTherbone()
+            self.p = p = UDPPacketizer(wb.source, dest_addr, host_addr, source_port = dest_port, dest_port = host_port)
+            self.f = f = SLIPFramer(p.source)
+            self.tx = tx = UARTTx(divisor = old_divisor, dynamic = True)
+            self.ctl = ctl = UARTBaudControl(divisor = old_divisor, timeout = 4000)
+        
+        def elaborate(self, platform):
+            m = Module()
+            
+            m.submodules.tx1 = self.tx1
+            m.submodules.rx1 = self.rx1
+            m.submodules.rx = self.rx
+            m.submodules.u = self.u
+            m.submodules.d = self.d
+            m.submodules.wb = self.wb
+            m.submodules.p = self.p
+            m.submodules.f = self.f
+            m.submodules.tx = self.tx
+            m.submodules.ctl = ctl = self.ctl
+            
+            m.d.comb += self.rx.rx_i.eq(self.tx1.tx_o)
+            m.d.comb += self.rx1.rx_i.eq(self.tx.tx_o)
+            
+            m.d.comb += self.tx1.sink.connect(self.i)
+            m.d.comb += self.tx.sink.connect(self.f.source)
+            m.d.comb += self.wb.sink.connect(self.d.source)
+            
+            # the control registers are the whole bus
+            interface = self.wb.interface
+            m.d.comb += [
+                    ctl.bus.adr.eq(interface.adr),
+                    ctl.bus.dat_w.eq(interface.dat_w),
+                    ctl.bus.sel.eq(interface.sel),
+                    ctl.bus.cyc.eq(interface.cyc),
+                    ctl.bus.stb.eq(interface.stb),
+                    ctl.bus.we.eq(interface.we),
+                    interface.dat_r.eq(ctl.bus.dat_r),
+                    interface.ack.eq(ctl.bus.ack),
+                    interface.stall.eq(ctl.bus.stall),
+                ]
+            
+            m.d.comb += [
+                    ctl.sent_i.eq(self.p.source.valid & self.p.source.ready & self.p.source.eop),
+                    ctl.idle_i.eq(~self.f.source.valid & self.tx.sink.ready),
+                    ctl.valid_i.eq(self.d.source.valid & self.d.source.ready & self.d.source.sop),
+                    self.tx.divisor_i.eq(ctl.divisor_o),
+                    self.rx.divisor_i.eq(ctl.divisor_o),
+                ]
+            
+            return m
+    
+    def packet(eb):
+        return slip_encode(raw(IP(src='127.0.0.1', dst='127.0.0.2', flags='DF')/UDP(dport=7777, sport=2574)/eb))
+    
+    top = Top()
+    i = top.i
+    o = top.o
+    
+    sim = Simulator(top)
+    sim.add_clock(1e-6)
+    
+    def send(pkt):
+        g = 0
+        while g < len(pkt):
+            yield i.data.eq(pkt[g])
+            yield i.valid.eq(1)
+            yield
+            if (yield i.ready) == 1:
+                g += 1
+        yield i.valid.eq(0)
+    
+    def receive():
+        recv = bytearray()
+        yield o.ready.eq(1)
+        while True:
+            yield
+            if (yield o.valid) == 1:
+                recv.append((yield o.data))
+                if recv[-1] == 0xc0:
+                    break
+        return IP(bytes(slip_decode(bytes(recv))))
+    
+    def host_proc():
+        # ask for the new divisor, then read it back at the old one
+        yield from send(packet(eb_write(0, [divisor_fixed(new_divisor)])))
+        yield from send(packet(eb_read([0, 1])))
+        r = yield from receive()
+        assert struct.unpack("!L", r.load[12:16])[0] == divisor_fixed(old_divisor)
+        assert struct.unpack("!L", r.load[16:20])[0] == 0b01
+        
+        # switch the host once the last byte is done
+        for _ in range(old_divisor * 2):
+            yield
+        assert (yield top.ctl.divisor_o) == divisor_fixed(new_divisor)
+        yield top.tx1.divisor_i.eq(divisor_fixed(new_divisor))
+        yield top.rx1.divisor_i.eq(divisor_fixed(new_divisor))
+        
+        # confirm at the new rate
+        yield from send(packet(eb_read([0, 1])))
+        r = yield from receive()
+        assert struct.unpack("!L", r.load[12:16])[0] == divisor_fixed(new_divisor)
+        assert struct.unpack("!L", r.load[16:20])[0] == 0b00
+        for _ in range(5000):
+            yield
+        assert (yield top.ctl.divisor_o) == divisor_fixed(new_divisor)
+    
+    sim.add_sync_process(host_proc)
+    
+    with sim.write_vcd("wb_baud.vcd", "wb_baud.gtkw"):
+        sim.run()
@@ -0,0 +1,280 @@
+from nmigen import *
+from nmigen.lib.fifo import SyncFIFO, SyncFIFOBuffered
+from .stream import *
+
+COBS_END = C(0x00, 8)
+# longest run of non-zero bytes in one block
+COBS_BLOCK = 254
+
+def cobs_encode(b):
+    res = bytearray()
+    block = bytearray()
+    for c in b:
+        if c == 0:
+            res.append(len(block) + 1)
+            res += block
+            block = bytearray()
+        else:
+            block.append(c)
+            if len(block) == COBS_BLOCK:
+                res.append(0xFF)
+                res += block
+                block = bytearray()
+    res.append(len(block) + 1)
+    res += block
+    res.append(0)
+    return bytes(res)
+
+def cobs_decode(b):
+    res = bytearray()
+    b = b[:-1]
+    g = 0
+    while g < len(b):
+        code = b[g]
+        res += b[g+1:g+code]
+        g += code
+        if code != 0xFF and g < len(b):
+            res.append(0)
+    return bytes(res)
+
+class COBSFramer(Elaboratable):
+    """
+    TODO formal docstring
+    Input: stream with framing
+    Output: stream without framing
+    Parameter: depth (block buffer, at least one block of 254 bytes)
+    Control signals: error
+    """
+    def __init__(self, input: StreamSource, depth: int = 512):
+        assert Record(input.payload_type).shape().width == 8
+        assert input.sop_enabled
+        assert input.eop_enabled
+        assert depth >= COBS_BLOCK
+        
+        self._input = input
+        self._depth = depth
+        self.sink = StreamSink.from_source(input, name="uncobs_sink")
+        self.source = StreamSource(Layout([("data", 8, DIR_FANOUT)]), sop=False, eop=False, name="cobs_source")
+        
+        # never set, kept so COBSFramer can stand in for SLIPFramer
+        self.err  = Signal()
+    
+    def elaborate(self, platform):
+        sink = self.sink
+        source = self.source
+        
+        m = Module()
+        
+        m.d.comb += sink.connect(self._input)
+        
+        m.d.comb += self.err.eq(0)
+        
+        # a block's code byte goes out before its data, so blocks wait here until they're complete
+        m.submodules.data_fifo = data_fifo = SyncFIFOBuffered(width=8, depth=self._depth)
+        # one entry per complete block: data byte count, and whether the block ends the packet
+        m.submodules.code_fifo = code_fifo = SyncFIFO(width=9, depth=16, fwft=True)
+        
+        count = Signal(range(COBS_BLOCK + 1))
+        
+        block_length = Signal(8)
+        block_end = Signal()
+        m.d.comb += code_fifo.w_data.eq(Cat(block_length, block_end))
+        m.d.comb += data_fifo.w_data.eq(sink.data)
+        
+        # input FSM
+        with m.FSM():
+            with m.State("ACTIVE"):
+                m.d.comb += sink.ready.eq(data_fifo.w_rdy & code_fifo.w_rdy)
+                with m.If(sink.we):
+                    with m.If(sink.data != COBS_END):
+                        m.d.comb += data_fifo.w_en.eq(1)
+                        with m.If(count == COBS_BLOCK - 1):
+                            # block is full, no zero follows it
+                            m.d.comb += block_length.eq(COBS_BLOCK)
+                            m.d.comb += code_fifo.w_en.eq(1)
+                            m.d.sync += count.eq(0)
+                            with m.If(sink.eop):
+                                m.next = "FINISH"
+                        with m.Elif(sink.eop):
+                            # last block of the packet
+                            m.d.comb += block_length.eq(count + 1)
+                            m.d.comb += block_end.eq(1)
+                            m.d.comb += code_fifo.w_en.eq(1)
+                            m.d.sync += count.eq(0)
+                        with m.Else():
+                            m.d.sync += count.eq(count + 1)
+                    with m.Else():
+                        # the zero ends the block
+                        m.d.comb += block_length.eq(count)
+                        m.d.comb += code_fifo.w_en.eq(1)
+                        m.d.sync += count.eq(0)
+                        with m.If(sink.eop):
+                            m.next = "FINISH"
+            
+            with m.State("FINISH"):
+                # empty last block
+                m.d.comb += block_end.eq(1)
+                m.d.comb += code_fifo.w_en.eq(1)
+                with m.If(code_fifo.w_rdy):
+                    m.next = "ACTIVE"
+        
+        left = Signal(8)
+        
+        # output FSM
+        with m.FSM():
+            with m.State("CODE"):
+                # send code byte
+                m.d.comb += source.data.eq(code_fifo.r_data[:8] + 1)
+                m.d.comb += source.valid.eq(code_fifo.r_rdy)
+                with m.If(source.re):
+                    m.d.sync += left.eq(code_fifo.r_data[:8])
+                    with m.If(code_fifo.r_data[:8] != 0):
+                        m.next = "DATA"
+                    with m.Elif(code_fifo.r_data[8]):
+                        m.next = "END"
+                    with m.Else():
+                        m.d.comb += code_fifo.r_en.eq(1)
+            
+            with m.State("DATA"):
+                # send block data
+                m.d.comb += source.data.eq(data_fifo.r_data)
+                m.d.comb += source.valid.eq(data_fifo.r_rdy)
+                m.d.comb += data_fifo.r_en.eq(source.ready)
+                with m.If(source.re):
+                    m.d.sync += left.eq(left - 1)
+                    with m.If(left == 1):
+                        with m.If(code_fifo.r_data[8]):
+                            m.next = "END"
+                        with m.Else():
+                            m.d.comb += code_fifo.r_en.eq(1)
+                            m.next = "CODE"
+            
+            with m.State("END"):
+                # send delimiter
+                m.d.comb += source.data.eq(COBS_END)
+                m.d.comb += source.valid.eq(1)
+                with m.If(source.re):
+                    m.d.comb += code_fifo.r_en.eq(1)
+                    m.next = "CODE"
+        
+        return m
+
+class COBSUnframer(Elaboratable):
+    """
+    TODO formal docstring
+    Input: stream without framing
+    Output: stream with framing
+    Parameter: none?
+    Control signals: error
+    """
+    def __init__(self, input: StreamSource):
+        assert Record(input.payload_type).shape().width == 8
+        assert not input.sop_enabled
+        assert not input.eop_enabled
+        
+        self._input = input
+        self.sink = StreamSink.from_source(input, name="cobs_sink")
+        self.source = StreamSource(Layout([("data", 8, DIR_FANOUT)]), sop=True, eop=True, name="uncobs_source")
+        
+        self.err  = Signal()
+    
+    def elaborate(self, platform):
+        sink = self.sink
+        source = self.source
+        
+        m = Module()
+        
+        m.d.comb += [
+                sink.data.eq(self._input.data),
+                self._input.ready.eq(sink.ready),
+                sink.valid.eq(self._input.valid),
+            ]
+        
+        m.d.comb += self.err.eq(0)
+        
+        # data bytes left in the current block, the next byte is a code byte when this is 0
+        left = Signal(8)
+        # the current block is followed by a zero, unless the packet ends
+        zero = Signal()
+        
+        # decoded bytes wait in held until the next input says whether they end the packet
+        first = Signal(reset=1)
+        held = Signal(8)
+        held_sop = Signal()
+        held_valid = Signal()
+        
+        decoded = Signal(8)
+        decode = Signal()
+        
+        # bytes leaving held, either pushed out by the next byte or ended by the delimiter
+        push = Signal()
+        push_eop = Signal()
+        
+        # skid register behind the output register, so sink.ready doesn't depend on source.ready
+        skid_data = Signal(8)
+        skid_sop = Signal()
+        skid_eop = Signal()
+        skid_valid = Signal()
+        
+        m.d.comb += sink.ready.eq(~skid_valid)
+        
+        with m.If(sink.we):
+            with m.If(sink.data == COBS_END):
+                with m.If(left != 0):
+                    # delimiter inside a block, pulse err and drop the packet so far
+                    m.d.comb += self.err.eq(1)
+                with m.Else():
+                    # the held byte ends the packet (nothing held is an empty packet, ignore it)
+                    m.d.comb += push.eq(held_valid)
+                    m.d.comb += push_eop.eq(1)
+                m.d.sync += held_valid.eq(0)
+                m.d.sync += first.eq(1)
+                m.d.sync += left.eq(0)
+                m.d.sync += zero.eq(0)
+            with m.Elif(left == 0):
+                # code byte, the last block was followed by a zero after all
+                m.d.comb += decoded.eq(0)
+                m.d.comb += decode.eq(zero)
+                m.d.sync += left.eq(sink.data - 1)
+                m.d.sync += zero.eq(sink.data != 0xFF)
+            with m.Else():
+                # data byte
+                m.d.comb += decoded.eq(sink.data)
+                m.d.comb += decode.eq(1)
+                m.d.sync += left.eq(left - 1)
+        
+        with m.If(decode):
+            # push out the previous byte, hold this one
+            m.d.comb += push.eq(held_valid)
+            m.d.sync += held.eq(decoded)
+            m.d.sync += held_sop.eq(first)
+            m.d.sync += held_valid.eq(1)
+            m.d.sync += first.eq(0)
+        
+        # output register, refilled from the skid register first
+        with m.If(~source.valid | source.ready):
+            with m.If(skid_valid):
+                m.d.sync += [
+                        source.data.eq(skid_data),
+                        source.sop.eq(skid_sop),
+                        source.eop.eq(skid_eop),
+                        source.valid.eq(1),
+                        skid_valid.eq(0),
+                    ]
+            with m.Else():
+                m.d.sync += [
+                        source.data.eq(held),
+                        source.sop.eq(held_sop),
+                        source.eop.eq(push_eop),
+                        source.valid.eq(push),
+                    ]
+        with m.Elif(push):
+            # output is stalled, park the byte
+            m.d.sync += [
+                    skid_data.eq(held),
+                    skid_sop.eq(held_sop),
+                    skid_eop.eq(push_eop),
+                    skid_valid.eq(1),
+                ]
+        
+        return m
@@ -0,0 +1,52 @@
+from nmigen import *
+
+import binascii
+import zlib
+
+# width: (polynomial, initial value, reflected, final xor, residue, trailer byte order)
+# the residue is what the CRC register holds after running over the data and its own trailer
+CRC_PARAMETERS = {
+    16: (0x1021, 0xFFFF, False, 0x0000, 0x0000, "big"), # CRC-16/CCITT-FALSE
+    32: (0xEDB88320, 0xFFFFFFFF, True, 0xFFFFFFFF, 0xDEBB20E3, "little"), # CRC-32, as zlib and Ethernet
+}
+
+def crc(data, width):
+    if width == 16:
+        return binascii.crc_hqx(data, 0xFFFF)
+    elif width == 32:
+        return zlib.crc32(data)
+    raise ValueError("unsupported CRC width {}".format(width))
+
+def crc_trailer(data, width):
+    return crc(data, width).to_bytes(width // 8, CRC_PARAMETERS[width][5])
+
+def _crc_matrix(width):
+    # each register bit after one byte, as the set of register bits ("c", n) and data bits ("d", n) XORed into it
+    (poly, _, reflected, _, _, _) = CRC_PARAMETERS[width]
+    c = [{("c", n)} for n in range(width)]
+    if reflected:
+        for n in range(8):
+            feedback = c[0] ^ {("d", n)}
+            c = c[1:] + [set()]
+            c = [c[k] ^ feedback if (poly >> k) & 1 else c[k] for k in range(width)]
+    else:
+        for n in range(8):
+            c[width - 8 + n] = c[width - 8 + n] ^ {("d", n)}
+        for n in range(8):
+            feedback = c[width - 1]
+            c = [set()] + c[:-1]
+            c = [c[k] ^ feedback if (poly >> k) & 1 else c[k] for k in range(width)]
+    return c
+
+def crc_byte(value, byte, width):
+    """
+    Next value of a CRC register after one byte, as XORs of the register and data bits
+    """
+    bits = []
+    for inputs in _crc_matrix(width):
+        terms = [value[n] if kind == "c" else byte[n] for (kind, n) in sorted(inputs)]
+        bit = C(0, 1)
+        for term in terms:
+            bit = bit ^ term
+        bits.append(bit)
+    return Cat(*bits)
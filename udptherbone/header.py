@@ -0,0 +1,204 @@
+from nmigen import *
+
+import enum
+
+class FieldAction(enum.Enum):
+    MATCH = 0
+    CAPTURE = 1
+    IGNORE = 2
+
+def _field_bytes(offset, width):
+    """
+    Bytes a field covers, as (byte, field bits, data bits) with both bit ranges as (start, stop) from the LSB
+    """
+    for byte in range(offset // 8, (offset + width - 1) // 8 + 1):
+        lo = max(offset, 8 * byte)
+        hi = min(offset + width, 8 * byte + 8)
+        yield (byte, (width - (hi - offset), width - (lo - offset)), (8 * byte + 8 - hi, 8 * byte + 8 - lo))
+
+class HeaderParser(Elaboratable):
+    """
+    TODO formal docstring
+    Input: header bytes (data, valid), start of header
+    Output: captured fields
+    Parameter: field table, header length in bytes
+    Control signals: done, error (pulses with the last header byte)
+    
+    Each field in the table is (name, offset, width, action, value), with offset and width in bits and bit 0 the
+    MSB of the first byte, as drawn in the RFCs. MATCH fields compare against value (an int or a Value, which can
+    change at runtime), CAPTURE fields are stored in `fields[name]`, and IGNORE fields (or bits not in any field)
+    are skipped. The table is folded into per-byte expected values and masks, so parsing is one compare per byte
+    at whatever offset `index` has reached, instead of a state per byte.
+    
+    A byte with `start` set is byte 0 of a new header, unless a header is already being parsed. After the last
+    byte, bytes are ignored until the next `start`. Captured bytes are registered, so a field is readable the
+    cycle after its last byte.
+    """
+    def __init__(self, fields, length: int):
+        assert length >= 1
+        for (name, offset, width, action, value) in fields:
+            assert offset + width <= length * 8
+        
+        self._fields = fields
+        self._length = length
+        
+        self.data = Signal(8)
+        self.valid = Signal()
+        self.start = Signal()
+        
+        # offset of the next header byte, length when no header is being parsed
+        self.index = Signal(range(length + 1), reset=length)
+        # offset of the byte on data, and whether it's part of a header
+        self.offset = Signal(range(length + 1))
+        self.active = Signal()
+        
+        self.done = Signal()
+        self.err = Signal()
+        self.fields = {name: Signal(width, name=name) for (name, offset, width, action, value) in fields
+                if action == FieldAction.CAPTURE}
+    
+    def elaborate(self, platform):
+        m = Module()
+        
+        # expected value and mask of every header byte
+        expect = [[C(0, 1)] * 8 for _ in range(self._length)]
+        mask = [0] * self._length
+        for (name, offset, width, action, value) in self._fields:
+            if action != FieldAction.MATCH:
+                continue
+            if not isinstance(value, Value):
+                value = C(value, width)
+            for (byte, (field_lo, field_hi), (data_lo, data_hi)) in _field_bytes(offset, width):
+                for n in range(data_hi - data_lo):
+                    expect[byte][data_lo + n] = value[field_lo + n]
+                    mask[byte] |= 1 << (data_lo + n)
+        expect = Array(Cat(*bits) for bits in expect)
+        mask = Array(C(x, 8) for x in mask)
+        
+        # a new header only starts between headers
+        first = Signal()
+        m.d.comb += first.eq(self.start & (self.index == self._length))
+        m.d.comb += self.offset.eq(Mux(first, 0, self.index))
+        m.d.comb += self.active.eq(self.valid & (first | (self.index != self._length)))
+        
+        mismatch = Signal()
+        byte_mismatch = Signal()
+        m.d.comb += byte_mismatch.eq(((self.data ^ expect[self.offset]) & mask[self.offset]).any())
+        
+        m.d.comb += self.done.eq(0)
+        m.d.comb += self.err.eq(0)
+        with m.If(self.active):
+            m.d.sync += self.index.eq(self.offset + 1)
+            m.d.sync += mismatch.eq(byte_mismatch | (mismatch & ~first))
+            with m.If(self.offset == self._length - 1):
+                with m.If(byte_mismatch | (mismatch & ~first)):
+                    m.d.comb += self.err.eq(1)
+                with m.Else():
+                    m.d.comb += self.done.eq(1)
+            
+            # capture
+            for (name, offset, width, action, value) in self._fields:
+                if action != FieldAction.CAPTURE:
+                    continue
+                for (byte, (field_lo, field_hi), (data_lo, data_hi)) in _field_bytes(offset, width):
+                    with m.If(self.offset == byte):
+                        m.d.sync += self.fields[name][field_lo:field_hi].eq(self.data[data_lo:data_hi])
+        
+        return m
+
+def _ones_complement_sum(words):
+    total = 0
+    for word in words:
+        total += word
+        total = (total & 0xFFFF) + (total >> 16)
+    return total
+
+def _static_value(value):
+    # ints and Consts are known at elaboration time, anything else is patched in at runtime
+    if isinstance(value, Const):
+        return value.value
+    if isinstance(value, int):
+        return value
+    return None
+
+def header_checksum(fields, start: int = 0, stop: int = None):
+    """
+    One's complement sum of the 16 bit words of bytes start to stop of a header template, with the dynamic fields
+    as 0 - the partial checksum that only the dynamic fields need adding to at runtime
+    """
+    length = max(offset + width for (name, offset, width, value) in fields) // 8
+    if stop is None:
+        stop = length
+    assert start % 2 == 0
+    data = bytearray(length + 1)
+    for (name, offset, width, value) in fields:
+        value = _static_value(value)
+        if value is None:
+            continue
+        for (byte, (field_lo, field_hi), (data_lo, data_hi)) in _field_bytes(offset, width):
+            bits = (value >> field_lo) & ((1 << (field_hi - field_lo)) - 1)
+            data[byte] |= bits << data_lo
+    return _ones_complement_sum(int.from_bytes(data[n:n + 2], "big") if n + 1 < stop else data[n] << 8
+            for n in range(start, stop, 2))
+
+class HeaderInserter(Elaboratable):
+    """
+    TODO formal docstring
+    Input: advance to the next header byte
+    Output: header bytes
+    Parameter: field template, header length in bytes
+    
+    Each field in the template is (name, offset, width, value), laid out as for HeaderParser. Fields with an int or
+    Const value are static and go in a ROM built at elaboration time, any other Value (a length or checksum
+    register) is patched in as its bytes go out, so it has to be settled by then. Bits not in any field are 0.
+    
+    `data` is the header byte at `index`. Raising `advance` moves on to the next byte, or back to the first after
+    the `last`.
+    """
+    def __init__(self, fields, length: int):
+        for (name, offset, width, value) in fields:
+            assert offset + width <= length * 8
+        
+        self._fields = fields
+        self._length = length
+        
+        self.data = Signal(8)
+        self.advance = Signal()
+        self.index = Signal(range(length))
+        self.first = Signal()
+        self.last = Signal()
+        
+    def elaborate(self, platform):
+        m = Module()
+        
+        # static bits of every byte, and the dynamic bits patched over them
+        rom = [0] * self._length
+        patches = [[] for _ in range(self._length)]
+        for (name, offset, width, value) in self._fields:
+            static = _static_value(value)
+            for (byte, (field_lo, field_hi), (data_lo, data_hi)) in _field_bytes(offset, width):
+                if static is None:
+                    patches[byte].append((data_lo, value[field_lo:field_hi]))
+                else:
+                    rom[byte] |= ((static >> field_lo) & ((1 << (field_hi - field_lo)) - 1)) << data_lo
+        
+        header = []
+        for (byte, patch) in zip(rom, patches):
+            if not patch:
+                header.append(C(byte, 8))
+                continue
+            bits = [C((byte >> n) & 1, 1) for n in range(8)]
+            for (data_lo, value) in patch:
+                for n in range(len(value)):
+                    bits[data_lo + n] = value[n]
+            header.append(Cat(*bits))
+        header = Array(header)
+        
+        m.d.comb += self.data.eq(header[self.index])
+        m.d.comb += self.first.eq(self.index == 0)
+        m.d.comb += self.last.eq(self.index == self._length - 1)
+        
+        with m.If(self.advance):
+            m.d.sync += self.index.eq(Mux(self.last, 0, self.index + 1))
+        
+        return m
@@ -1,7 +1,7 @@
 
 from nmigen import *
-from nmigen.lib.fifo import SyncFIFO
 from .stream import *
+from .header import *
 
 import enum
 import ipaddress
@@ -31,8 +31,8 @@ class IPv4Packetizer(Elaboratable):
     TODO formal docstring
     Input: stream with framing
     Output: stream with framing
-    Parameter: MTU (FIFO depth), proto (protocol number), source IP, dest IP
-    Control signals: Overflow error
+    Parameter: MTU (buffer size), # in flight at once, proto (protocol number), source IP, dest IP
+    Control signals: Overflow error, framing error
     """
     def __init__(self, input: StreamSource, source_ip: ipaddress.IPv4Address, dest_ip: ipaddress.IPv4Address, 
             mtu: int = 1500, in_flight: int = 2, proto: IPProtocolNumber = IPProtocolNumber.NA):
@@ -53,23 +53,26 @@ class IPv4Packetizer(Elaboratable):
         self._source_ip = C(int.from_bytes(source_ip.packed, byteorder='big'), 32)
         self._dest_ip = C(int.from_bytes(dest_ip.packed, byteorder='big'), 32)
         
-        self._partial_checksum = self._calc_partial_checksum()
-        
         self.overflow  = Signal()
         self.err  = Signal()
         
-    def _calc_partial_checksum(self):
-        full_sum = Cat(ECN, DSCP, IHL, IP_VERSION) + \
-            ID + \
-            Cat(FO, FLAGS) +  \
-            Cat(self._proto, TTL) +  \
-            self._source_ip[16:] +  \
-            self._source_ip[:16] + \
-            self._dest_ip[16:] + \
-            self._dest_ip[:16]
-        
-        full_sum = full_sum[:16] + full_sum[16:]
-        return (full_sum[:16] + full_sum[16:])[:16]
+    def _header(self, length, checksum):
+        # see HeaderInserter
+        return [
+                ("version", 0, 4, IP_VERSION),
+                ("ihl", 4, 4, IHL),
+                ("dscp", 8, 6, DSCP),
+                ("ecn", 14, 2, ECN),
+                ("total_length", 16, 16, (length + 20)[:16]),
+                ("id", 32, 16, ID),
+                ("flags", 48, 3, FLAGS),
+                ("fo", 51, 13, FO),
+                ("ttl", 64, 8, TTL),
+                ("protocol", 72, 8, self._proto),
+                ("checksum", 80, 16, ~checksum),
+                ("source", 96, 32, self._source_ip),
+                ("dest", 128, 32, self._dest_ip),
+            ]
             
 
     def elaborate(self, platform):
@@ -80,18 +83,17 @@ class IPv4Packetizer(Elaboratable):
         
         m.d.comb += self.sink.connect(self._input)
         
-        counter = Signal(16)
+        # Payloads wait in a packet buffer, whose descriptors carry the length the header needs. A packet takes
+        # buffer space as it arrives and a descriptor slot only with its EOP, so up to in_flight complete packets
+        # queue behind the one going out while the next streams in.
+        payload = StreamSource(Layout([("data", 8, DIR_FANOUT)]), sop=True, eop=True, name="payload")
+        m.submodules.buffer = buffer = PacketBuffer(payload, depth=self._mtu - 20, in_flight=self._in_flight)
         
-        # TODO this should be a FIFO stream, why am I reimplementing it here?
-        m.submodules.fifo = fifo = SyncFIFO(width=8, depth=self._mtu)
-        m.submodules.counter_fifo = counter_fifo = SyncFIFO(width=16, depth=self._in_flight)
-        self.counter_fifo = counter_fifo
-        
-        stall = Signal()
-        m.d.comb += sink.ready.eq(fifo.w_rdy & ~stall)
+        # payload bytes written so far
+        counter = Signal(range(self._mtu - 20))
         
         output_active = Signal()
-        m.d.comb += source.valid.eq(counter_fifo.r_rdy | output_active)
+        m.d.comb += source.valid.eq(buffer.pending | output_active)
         
         we = Signal()
         m.d.comb += we.eq(sink.valid & sink.ready)
@@ -102,251 +104,120 @@ class IPv4Packetizer(Elaboratable):
         m.d.sync += self.overflow.eq(0)
         m.d.sync += self.err.eq(0)
                     
-        # data plugs directly into FIFO
-        m.d.comb += fifo.w_data.eq(sink.data)
+        # data plugs directly into the buffer
+        m.d.comb += [
+                payload.data.eq(sink.data),
+                payload.sop.eq(sink.sop),
+                payload.eop.eq(sink.eop),
+                ]
         
-        with m.If(we):
-            # input FSM
-            # each state needs to handle four cases: 0, SOP, EOP, SOP&EOP.
-            with m.FSM() as fsm:
-                with m.State("IDLE"):
-                    # between packets
-                    with m.If(sink.sop & sink.eop):
-                        # store input data
-                        m.d.comb += fifo.w_en.eq(1)
-                        
-                        with m.If(counter_fifo.w_rdy):
-                            # write counter of 1 to counter fifo if space exists
-                            m.d.comb += counter_fifo.w_data.eq(1)
-                            m.d.comb += counter_fifo.w_en.eq(1)
-                        with m.Else():
-                            # otherwise, stall until space is available
-                            m.next = "STALL"
-                            m.d.sync += counter.eq(1)
-                            m.d.sync += stall.eq(0)
-                            
-                    with m.If(sink.sop & ~sink.eop):
-                        # store input data
-                        m.d.comb += fifo.w_en.eq(1)
-                        
+        # input FSM
+        with m.FSM():
+            with m.State("IDLE"):
+                # between packets
+                with m.If(sink.sop):
+                    # store input data
+                    m.d.comb += payload.valid.eq(sink.valid)
+                    m.d.comb += sink.ready.eq(payload.ready)
+                    with m.If(we & ~sink.eop):
                         # start counter
                         m.d.sync += counter.eq(1)
-                        
                         # advance to packet state
                         m.next = "PKT"
-                        
-                    with m.If(~sink.sop): # action independent of eop state
-                        # write between packets but not SOP - illegal
+                with m.Else():
+                    # write between packets but not SOP - illegal, skip it
+                    m.d.comb += sink.ready.eq(1)
+                    with m.If(sink.valid):
                         m.d.sync += self.err.eq(1)
-                        
-                with m.State("PKT"):
-                    # processing a packet
-                    with m.If(sink.sop): # action independent of eop state
-                        # new SOP without corresponding EOP - illegal
+                    
+            with m.State("PKT"):
+                # processing a packet
+                with m.If(sink.sop):
+                    # new SOP without corresponding EOP - illegal. Roll back the packet so far with a dummy EOP, then
+                    # start again from this SOP.
+                    m.d.comb += payload.valid.eq(sink.valid)
+                    m.d.comb += payload.eop.eq(1)
+                    m.d.comb += buffer.drop.eq(1)
+                    with m.If(sink.valid & payload.ready):
                         m.d.sync += self.err.eq(1)
                         # return to idle state
                         m.next = "IDLE"
-                        
-                    with m.If(~sink.sop & sink.eop):
-                        with m.If(counter >= self._mtu):
-                            # this state should not be accessible but is included for safety/completeness
-                            # signal overflow
-                            m.d.sync += self.overflow.eq(1)
-                            # return to idle state
-                            m.next = "IDLE"
-                            
-                        with m.Else():
-                            # store input data
-                            m.d.comb += fifo.w_en.eq(1)
-                            
-                            with m.If(counter_fifo.w_rdy):
-                                # write counter value to counter fifo if space exists
-                                m.d.comb += counter_fifo.w_data.eq(counter + 1)
-                                m.d.comb += counter_fifo.w_en.eq(1)
-                                
-                                # reset input counter
-                                m.d.sync += counter.eq(0)
-                            
-                                # return to idle state
-                                m.next = "IDLE"
-                                
-                            with m.Else():
-                                # otherwise, stall until space is available
-                                m.next = "STALL"
-                                m.d.sync += counter.eq(counter + 1)
-                                m.d.sync += stall.eq(0)
-                            
-                    with m.If(~sink.sop & ~sink.eop):
-                        with m.If(counter >= self._mtu):
-                            # signal overflow
-                            m.d.sync += self.overflow.eq(1)
+                with m.Elif((counter == self._mtu - 21) & ~sink.eop):
+                    # this byte fills the buffer without ending the packet - signal overflow, roll back the packet
+                    # with this byte and drop the rest of it
+                    m.d.comb += payload.valid.eq(sink.valid)
+                    m.d.comb += sink.ready.eq(payload.ready)
+                    m.d.comb += payload.eop.eq(1)
+                    m.d.comb += buffer.drop.eq(1)
+                    with m.If(we):
+                        m.d.sync += self.overflow.eq(1)
+                        m.next = "DISCARD"
+                with m.Else():
+                    # store input data
+                    m.d.comb += payload.valid.eq(sink.valid)
+                    m.d.comb += sink.ready.eq(payload.ready)
+                    with m.If(we):
+                        # advance counter
+                        m.d.sync += counter.eq(counter + 1)
+                        with m.If(sink.eop):
                             # return to idle state
                             m.next = "IDLE"
-                        with m.Else():
-                            # store input data
-                            m.d.comb += fifo.w_en.eq(1)
-                            # advance counter
-                            m.d.sync += counter.eq(counter + 1)
-                with m.State("STALL"):
-                    pass # TODO this doesn't actually work oops, needs to be outside the FSM
+                    
+            with m.State("DISCARD"):
+                # skip the rest of an overflowed packet, up to its EOP or the next SOP
+                m.d.comb += sink.ready.eq(~sink.sop)
+                with m.If(sink.valid & (sink.sop | sink.eop)):
+                    m.next = "IDLE"
             
-        header_idx = Signal(range(4), reset=0)
+        # the header goes out of a template, with the length and checksum patched in from these
         pkt_len = Signal(16)
         checksum = Signal(16)
+        header_fields = self._header(pkt_len, checksum)
+        m.submodules.header = header = HeaderInserter(header_fields, length=20)
 
         # output FSM
         with m.FSM() as fsm:
-            with m.State("INIT"):
-                # send first header byte
-                m.d.comb += source.data.eq(Cat(IHL, IP_VERSION))
-                
-                with m.If(re):
-                    # set SOP
-                    m.d.comb += self.source.sop.eq(1)
-                    
-                    # mark output active
-                    m.d.sync += output_active.eq(1)
-                    
-                    # latch out counter value
-                    m.d.comb += counter_fifo.r_en.eq(1)
-                    m.d.sync += pkt_len.eq(counter_fifo.r_data)
-                    
-                    # calculate full checksum from counter value
-                    checksum_intermediate = self._partial_checksum + counter_fifo.r_data
-                    checksum_intermediate = checksum_intermediate[:16] + checksum_intermediate[16:]
-                    checksum_intermediate = checksum_intermediate[:16] + checksum_intermediate[16:]
-                    m.d.sync += checksum.eq(checksum_intermediate[:16])
-                    
-                    # advance state
-                    m.next = "HEADER_BYTE1"
-                
-            with m.State("HEADER_BYTE1"):
-                # send second header byte
-                m.d.comb += source.data.eq(Cat(ECN, DSCP))
-                
-                with m.If(re):
-                    # set index for Length
-                    m.d.sync += header_idx.eq(1)
-                    # advance state
-                    m.next = "LENGTH"
-                
-            with m.State("LENGTH"):
-                # send current length byte
-                m.d.comb += source.data.eq(pkt_len.word_select(header_idx, 8))
-                
-                with m.If(re):
-                    # decrement index
-                    m.d.sync += header_idx.eq(header_idx - 1)
-                    with m.If(header_idx == 0):
-                        # set index for ID
-                        m.d.sync += header_idx.eq(1)
-                    
-                        # advance state
-                        m.next = "ID"
-                
-            with m.State("ID"):
-                # send current id byte
-                m.d.comb += source.data.eq(ID.word_select(header_idx, 8))
-                
-                with m.If(re):
-                    # decrement index
-                    m.d.sync += header_idx.eq(header_idx - 1)
-                    with m.If(header_idx == 0):
-                        # advance state
-                        m.next = "FLAGS"
-
-            with m.State("FLAGS"):
-                # send flags
-                m.d.comb += source.data.eq(Cat(FO[8:], FLAGS))
-                
-                with m.If(re):
-                    # advance state
-                    m.next = "FO"
-                
-            with m.State("FO"):
-                # send fragment offset low bits
-                m.d.comb += source.data.eq(FO[:8])
+            with m.State("HEADER"):
+                # send current header byte
+                m.d.comb += source.data.eq(header.data)
                 
                 with m.If(re):
-                    # advance state
-                    m.next = "TTL"
-                
-            with m.State("TTL"):
-                # send time-to-live
-                m.d.comb += source.data.eq(TTL)
-                
-                with m.If(re):
-                    # advance state
-                    m.next = "PROTOCOL"
-                
-            with m.State("PROTOCOL"):
-                # send protocol number
-                m.d.comb += source.data.eq(self._proto)
-                
-                with m.If(re):
-                    # set index for checksum
-                    m.d.sync += header_idx.eq(1)
+                    m.d.comb += header.advance.eq(1)
                     
-                    # advance state
-                    m.next = "CHECKSUM"
-                
-            with m.State("CHECKSUM"):
-                # send current checksum byte
-                m.d.comb += source.data.eq(~checksum.word_select(header_idx, 8))
-                
-                with m.If(re):
-                    # decrement index
-                    m.d.sync += header_idx.eq(header_idx - 1)
-                    with m.If(header_idx == 0):
-                        # set index for source address
-                        m.d.sync += header_idx.eq(3)
-                    
-                        # advance state
-                        m.next = "ADDR_SOURCE"
-                
-            with m.State("ADDR_SOURCE"):
-                # send current source address byte
-                m.d.comb += source.data.eq(self._source_ip.word_select(header_idx, 8))
-                
-                with m.If(re):
-                    # decrement index
-                    m.d.sync += header_idx.eq(header_idx - 1)
-                    with m.If(header_idx == 0):
-                        # set index for dest address
-                        m.d.sync += header_idx.eq(3)
-                    
-                        # advance state
-                        m.next = "ADDR_DEST"
+                    with m.If(header.first):
+                        # set SOP
+                        m.d.comb += self.source.sop.eq(1)
                         
-            with m.State("ADDR_DEST"):
-                # send current destination address byte
-                m.d.comb += source.data.eq(self._dest_ip.word_select(header_idx, 8))
-                
-                with m.If(re):
-                    # decrement index
-                    m.d.sync += header_idx.eq(header_idx - 1)
-                    with m.If(header_idx == 0):
+                        # mark output active
+                        m.d.sync += output_active.eq(1)
+                        
+                        # latch out packet length
+                        m.d.sync += pkt_len.eq(buffer.length)
+                        
+                        # calculate full checksum from packet length
+                        checksum_intermediate = C(header_checksum(header_fields), 16) + buffer.length + 20
+                        checksum_intermediate = checksum_intermediate[:16] + checksum_intermediate[16:]
+                        checksum_intermediate = checksum_intermediate[:16] + checksum_intermediate[16:]
+                        m.d.sync += checksum.eq(checksum_intermediate[:16])
+                    
+                    with m.If(header.last):
                         # advance state
                         m.next = "PAYLOAD"
             
             with m.State("PAYLOAD"):
                 # send current payload byte
-                m.d.comb += source.data.eq(fifo.r_data)
+                m.d.comb += source.data.eq(buffer.source.data)
+                m.d.comb += source.valid.eq(buffer.source.valid)
+                m.d.comb += buffer.source.ready.eq(source.ready)
                 
                 with m.If(re):
-                    # advance FIFO
-                    m.d.comb += fifo.r_en.eq(1)
-                    
-                    # decrement length
-                    m.d.sync += pkt_len.eq(pkt_len - 1)
-                    
-                    with m.If(pkt_len - 1 == 0):
+                    with m.If(buffer.source.eop):
                         # set EOP
                         m.d.comb += self.source.eop.eq(1)
                         # mark output inactive
                         m.d.sync += output_active.eq(0)
                         # packet complete
-                        m.next = "INIT"
+                        m.next = "HEADER"
                     
         return m
 
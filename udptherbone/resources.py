@@ -0,0 +1,79 @@
+from nmigen import *
+from nmigen.hdl.ir import Fragment, Instance
+
+import math
+
+# (width, depth) configurations of a single block RAM
+# shallower memories than this are left in logic by the synthesizer
+BRAM_MIN_DEPTH = 32
+BRAM_SHAPES = {
+    "ice40": [(16, 256), (8, 512), (4, 1024), (2, 2048)],
+    "ecp5": [(36, 512), (18, 1024), (9, 2048), (4, 4096), (2, 8192), (1, 16384)],
+}
+
+def memories(elaboratable, platform=None):
+    """
+    TODO formal docstring
+    Returns (path, memory, synchronous read) for every memory in the elaborated design
+    """
+    found = {}
+
+    def walk(fragment, path):
+        if isinstance(fragment, Instance) and fragment.type in ("$memrd", "$memwr"):
+            memory = fragment.parameters["MEMID"]
+            entry = found.setdefault(id(memory), [".".join(path[:-1]), memory, True])
+            if fragment.type == "$memrd" and not fragment.parameters["CLK_ENABLE"]:
+                # asynchronous read ports only map to LUT RAM
+                entry[2] = False
+        for (subfragment, name) in fragment.subfragments:
+            walk(subfragment, path + [name or "U$"])
+
+    walk(Fragment.get(elaboratable, platform), [])
+    return [tuple(x) for x in found.values()]
+
+def bram_blocks(width, depth, family):
+    return min(math.ceil(width / w) * math.ceil(depth / d) for (w, d) in BRAM_SHAPES[family])
+
+def bram_report(elaboratable, family="ice40", platform=None):
+    """
+    TODO formal docstring
+    Returns (path, width, depth, blocks) for every memory, with 0 blocks for memories that don't go in block RAM
+    """
+    report = []
+    for (path, memory, sync_read) in memories(elaboratable, platform):
+        if sync_read and memory.depth >= BRAM_MIN_DEPTH:
+            blocks = bram_blocks(memory.width, memory.depth, family)
+        else:
+            blocks = 0
+        report.append((path, memory.width, memory.depth, blocks))
+
+    return report
+
+def print_bram_report(name, elaboratable, family="ice40"):
+    report = bram_report(elaboratable, family)
+    print("{} ({}): {} block RAMs".format(name, family, sum(x[3] for x in report)))
+    for (path, width, depth, blocks) in report:
+        print("    {:40} {:4} x {:5} {}".format(path, width, depth,
+            "{} blocks".format(blocks) if blocks else "logic"))
+
+
+if __name__ == "__main__":
+    import argparse
+    import ipaddress
+    from .stream import *
+    from .udp import UDPDepacketizer, UDPPacketizer
+    from .udptherbone import UDPTherbone
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--family", choices=BRAM_SHAPES.keys(), default="ice40")
+    parser.add_argument("--mtu", type=int, default=1500)
+    args = parser.parse_args()
+
+    def byte_stream():
+        return StreamSource(Layout([("data", 8, DIR_FANOUT)]))
+
+    ip = ipaddress.IPv4Address("127.0.0.1")
+    print_bram_report("UDPDepacketizer", UDPDepacketizer(byte_stream(), ip, 2574, mtu=args.mtu), args.family)
+    print_bram_report("UDPPacketizer", UDPPacketizer(byte_stream(), ip, ip, 2574, 7777, mtu=args.mtu), args.family)
+    print_bram_report("UDPTherbone", UDPTherbone(mtu=args.mtu), args.family)
+    print_bram_report("UDPTherbone (classic)", UDPTherbone(mtu=args.mtu, features=[]), args.family)
@@ -2,37 +2,81 @@
 from nmigen import *
 from nmigen.lib.fifo import SyncFIFO
 from .stream import *
+from .crc import *
 
 SLIP_END = C(0xC0, 8)
 SLIP_ESC = C(0xDB, 8)
 SLIP_ESC_END = C(0xDC, 8)
 SLIP_ESC_ESC = C(0xDD, 8)
 
-def slip_encode(b):
+def slip_encode(b, crc=None):
+    if crc:
+        b = b + crc_trailer(b, crc)
     res = b.replace(b'\xdb', b'\xdb\xdd')
     res = res.replace(b'\xc0', b'\xdb\xdc')
     res += b'\xc0'
     return res
 
-def slip_decode(b):
-    res = b.replace(b'\xdb\xdd', b'\xdb')
-    res = res.replace(b'\xdb\xdc', b'\xc0')
-    return res[:-1]
+def slip_decode(b, crc=None):
+    # split on ESC ESC_ESC first, so a decoded ESC can't pair up with a following ESC_END
+    res = b'\xdb'.join(x.replace(b'\xdb\xdc', b'\xc0') for x in b.split(b'\xdb\xdd'))
+    res = res[:-1]
+    if crc:
+        (res, trailer) = (res[:-(crc // 8)], res[-(crc // 8):])
+        if len(trailer) != crc // 8 or crc_trailer(res, crc) != trailer:
+            raise ValueError("bad CRC-{} trailer".format(crc))
+    return res
+
+def slip_stripe(b, lanes):
+    # byte k of a frame goes on lane k % lanes, then every other lane carries END too so each lane ends each frame
+    res = [bytearray() for _ in range(lanes)]
+    lane = 0
+    for c in b:
+        res[lane].append(c)
+        if c == SLIP_END.value:
+            for l in range(lanes):
+                if l != lane:
+                    res[l].append(c)
+            lane = 0
+        else:
+            lane = (lane + 1) % lanes
+    return [bytes(x) for x in res]
+
+def slip_unstripe(lanes):
+    # the other lanes are read up to their END, so one that's out of step lines up again for the next frame
+    res = bytearray()
+    pos = [0] * len(lanes)
+    lane = 0
+    while pos[lane] < len(lanes[lane]):
+        c = lanes[lane][pos[lane]]
+        pos[lane] += 1
+        res.append(c)
+        if c == SLIP_END.value:
+            for l in range(len(lanes)):
+                if l != lane:
+                    end = lanes[l].find(SLIP_END.value, pos[l])
+                    pos[l] = len(lanes[l]) if end < 0 else end + 1
+            lane = 0
+        else:
+            lane = (lane + 1) % len(lanes)
+    return bytes(res)
 
 class SLIPFramer(Elaboratable):
     """
     TODO formal docstring
     Input: stream with framing
     Output: stream without framing
-    Parameter: none?
+    Parameter: crc (None, 16 or 32 - width of a CRC trailer appended to each packet before END)
     Control signals: error
     """
-    def __init__(self, input: StreamSource):
+    def __init__(self, input: StreamSource, crc=None):
         assert Record(input.payload_type).shape().width == 8
         assert input.sop_enabled
         assert input.eop_enabled
+        assert crc in (None,) + tuple(CRC_PARAMETERS)
         
         self._input = input
+        self._crc = crc
         self.sink = StreamSink.from_source(input, name="unslip_sink")
         self.source = StreamSource(Layout([("data", 8, DIR_FANOUT)]), sop=False, eop=False, name="slip_source")
         
@@ -44,10 +88,6 @@ class SLIPFramer(Elaboratable):
         
         m = Module()
         
-        stalled = Signal(range(4))
-        
-        m.d.comb += sink.ready.eq(stalled == 0)
-        
         # this should be a "connect" call
         m.d.comb += [
                 sink.eop.eq(self._input.eop),
@@ -57,55 +97,83 @@ class SLIPFramer(Elaboratable):
                 sink.data.eq(self._input.data),
                 ]
         
-        m.d.comb += source.valid.eq(stalled > 0)
+        # the output register can take a new byte when it's empty or being read
+        advance = Signal()
+        m.d.comb += advance.eq(~source.valid | source.ready)
         
         escapable = Signal()
         m.d.comb += escapable.eq((sink.data == SLIP_END) | (sink.data == SLIP_ESC))
         
-        escaped = Signal(8)
         held = Signal(8)
         
+        # with a CRC, the trailer goes out between the last byte and END
+        after_eop = "CRC" if self._crc else "END"
+        if self._crc:
+            (_, init, _, xorout, _, order) = CRC_PARAMETERS[self._crc]
+            crc_bytes = self._crc // 8
+            
+            crc_value = Signal(self._crc, reset=init)
+            next_crc = Signal(self._crc)
+            m.d.comb += next_crc.eq(crc_byte(crc_value, sink.data, self._crc))
+            
+            # trailer bytes in the order they go out, crc_index counts through them
+            trailer = Signal(self._crc)
+            trailer_bytes = [(next_crc ^ xorout)[8*k:8*k+8] for k in range(crc_bytes)]
+            if order == "big":
+                trailer_bytes.reverse()
+            crc_index = Signal(range(crc_bytes))
+            trailer_byte = Signal(8)
+            m.d.comb += trailer_byte.eq(trailer.word_select(crc_index, 8))
+            
+            with m.If(sink.we):
+                with m.If(sink.eop):
+                    m.d.sync += trailer.eq(Cat(*trailer_bytes))
+                    m.d.sync += crc_value.eq(init)
+                with m.Else():
+                    m.d.sync += crc_value.eq(next_crc)
+        
         with m.If(source.re):
-            m.d.sync += stalled.eq(stalled - 1)
+            m.d.sync += source.valid.eq(0) # may be overridden below
             
         with m.FSM():
             with m.State("ACTIVE"):
+                # take a byte every cycle the output register can advance
+                m.d.comb += sink.ready.eq(advance)
                 with m.If(sink.we):
                     m.d.sync += held.eq(sink.data)
+                    m.d.sync += source.valid.eq(1)
                     with m.Switch(Cat(self.sink.eop, escapable)):
                         with m.Case(0b00):
                             # not EOP, not escapable
                             # simply pass through
-                            m.d.sync += stalled.eq(1)
                             m.d.sync += source.data.eq(sink.data)
                         with m.Case(0b01):
                             # EOP, not escapable
-                            # write out and then transition to END state - stall for one additional cycle
-                            m.d.sync += stalled.eq(2)
+                            # write out and then transition to END state (via the CRC)
                             m.d.sync += source.data.eq(sink.data)
-                            m.next = "END"
+                            m.next = after_eop
                         with m.Case(0b10):
                             # not EOP, escapable
-                            # escape, stall for one additional cycle
-                            m.d.sync += stalled.eq(2)
+                            # escape, then send the escaped value
                             m.d.sync += source.data.eq(SLIP_ESC)
                             m.next = "ESC"
                         with m.Case(0b11):
                             # EOP, escapable
-                            # stall for two additional cycles while ending packet
-                            m.d.sync += stalled.eq(3)
+                            # escape, then send the escaped value and end the packet
                             m.d.sync += source.data.eq(SLIP_ESC)
                             m.next = "ESC_END"
                         
             with m.State("END"):
                 # end only
-                with m.If(source.re):
+                with m.If(advance):
                     m.d.sync += source.data.eq(SLIP_END)
+                    m.d.sync += source.valid.eq(1)
                     m.next = "ACTIVE"
                 
             with m.State("ESC"):
                 # escape only
-                with m.If(source.re):
+                with m.If(advance):
+                    m.d.sync += source.valid.eq(1)
                     with m.Switch(held):
                         with m.Case(SLIP_END.value):
                             m.d.sync += source.data.eq(SLIP_ESC_END)
@@ -118,7 +186,8 @@ class SLIPFramer(Elaboratable):
                 
             with m.State("ESC_END"):
                 # escape, then end
-                with m.If(source.re):
+                with m.If(advance):
+                    m.d.sync += source.valid.eq(1)
                     with m.Switch(held):
                         with m.Case(SLIP_END.value):
                             m.d.sync += source.data.eq(SLIP_ESC_END)
@@ -127,8 +196,36 @@ class SLIPFramer(Elaboratable):
                         with m.Default():
                             # TODO assert this can't happen?
                             m.d.sync += self.err.eq(1)
-                            m.next = "ACTIVE"
-                    m.next = "END"
+                    m.next = after_eop
+            
+            if self._crc:
+                with m.State("CRC"):
+                    # trailer byte, escaped like any other
+                    with m.If(advance):
+                        m.d.sync += source.valid.eq(1)
+                        with m.If((trailer_byte == SLIP_END) | (trailer_byte == SLIP_ESC)):
+                            m.d.sync += source.data.eq(SLIP_ESC)
+                            m.d.sync += held.eq(trailer_byte)
+                            m.next = "CRC_ESC"
+                        with m.Else():
+                            m.d.sync += source.data.eq(trailer_byte)
+                            with m.If(crc_index == crc_bytes - 1):
+                                m.d.sync += crc_index.eq(0)
+                                m.next = "END"
+                            with m.Else():
+                                m.d.sync += crc_index.eq(crc_index + 1)
+                
+                with m.State("CRC_ESC"):
+                    # escaped trailer byte
+                    with m.If(advance):
+                        m.d.sync += source.valid.eq(1)
+                        m.d.sync += source.data.eq(Mux(held == SLIP_END, SLIP_ESC_END, SLIP_ESC_ESC))
+                        with m.If(crc_index == crc_bytes - 1):
+                            m.d.sync += crc_index.eq(0)
+                            m.next = "END"
+                        with m.Else():
+                            m.d.sync += crc_index.eq(crc_index + 1)
+                            m.next = "CRC"
                         
         return m
 
@@ -137,23 +234,36 @@ class SLIPUnframer(Elaboratable):
     TODO formal docstring
     Input: stream without framing
     Output: stream with framing
-    Parameter: none?
-    Control signals: error
+    Parameter: crc (None, 16 or 32 - width of the CRC trailer on each packet), mtu (largest packet, with a CRC)
+    Control signals: error, crc error
+    
+    With a CRC, packets are checked and the trailer stripped before they leave; packets go through a
+    PacketBuffer so a bad one is dropped there and never reaches (or takes space in) anything downstream.
     """
-    def __init__(self, input: StreamSource):
+    def __init__(self, input: StreamSource, crc=None, mtu: int = 1500):
         assert Record(input.payload_type).shape().width == 8
         assert not input.sop_enabled
         assert not input.eop_enabled
+        assert crc in (None,) + tuple(CRC_PARAMETERS)
         
         self._input = input
+        self._crc = crc
+        self._mtu = mtu
         self.sink = StreamSink.from_source(input, name="slip_sink")
-        self.source = StreamSource(Layout([("data", 8, DIR_FANOUT)]), sop=True, eop=True, name="unslip_source")
+        if crc:
+            self._frame = StreamSource(Layout([("data", 8, DIR_FANOUT)]), sop=True, eop=True, name="unslip_frame")
+            self.buffer = PacketBuffer(self._frame, depth=mtu)
+            self.source = self.buffer.source
+        else:
+            self.source = StreamSource(Layout([("data", 8, DIR_FANOUT)]), sop=True, eop=True, name="unslip_source")
         
         self.err  = Signal()
+        self.crc_err = Signal()
         
     def elaborate(self, platform):
         sink = self.sink
-        source = self.source
+        # output register, feeding the packet buffer when there's a CRC to check
+        out = self._frame if self._crc else self.source
         
         m = Module()
         
@@ -164,94 +274,536 @@ class SLIPUnframer(Elaboratable):
                 sink.valid.eq(self._input.valid),
             ]
         
-        future = sink.data
-        current = Signal(8)
+        m.d.comb += self.err.eq(0)
+        m.d.comb += self.crc_err.eq(0)
         
-        init = Signal()
-        read_en = Signal()
+        # decoded bytes wait in held until the next input says whether they end the packet
+        # with a CRC the trailer is held back as well, held[0] is the oldest byte once held is full
+        depth = 1 + (self._crc or 0) // 8
+        escaped = Signal()
+        held = [Signal(8, name="held{}".format(k)) for k in range(depth)]
+        held_count = Signal(range(depth + 1))
+        full = Signal()
+        m.d.comb += full.eq(held_count == depth)
+        # some of this packet has been pushed out already
+        pushed = Signal()
         
-        with m.If(source.re):
-            m.d.sync += read_en.eq(0) # may be overridden below
-            m.d.sync += source.eop.eq(0)
+        decoded = Signal(8)
+        decode = Signal()
+        # END or an illegal escape, start over with the next byte
+        restart = Signal()
+        # skipping the rest of a frame that's too long, until END (only with a CRC)
+        discard = Signal()
         
-        with m.If(sink.we):
-            m.d.sync += current.eq(future)
-            m.d.sync += init.eq(1) # have to skip first write, prime the pump
-            with m.If(future == SLIP_END.value):
-                m.d.sync += source.eop.eq(1)
+        # bytes leaving held, either pushed out by the next byte or ended by END
+        push = Signal()
+        push_eop = Signal()
+        # the packet ends here, but drop it
+        push_drop = Signal()
+        
+        # skid register behind the output register, so sink.ready doesn't depend on out.ready
+        skid_data = Signal(8)
+        skid_sop = Signal()
+        skid_eop = Signal()
+        skid_drop = Signal()
+        skid_valid = Signal()
+        out_drop = Signal()
+        
+        if self._crc:
+            (_, init, _, _, residue, _) = CRC_PARAMETERS[self._crc]
+            # runs over the data and the trailer, so a good packet leaves the residue behind
+            crc_value = Signal(self._crc, reset=init)
+            crc_ok = Signal()
+            m.d.comb += crc_ok.eq(crc_value == residue)
             
+            with m.If(decode):
+                m.d.sync += crc_value.eq(crc_byte(crc_value, decoded, self._crc))
+            with m.If(restart):
+                m.d.sync += crc_value.eq(init)
         
-        m.d.comb += self.err.eq(0)
+        m.d.comb += sink.ready.eq(~skid_valid)
         
-        m.d.comb += sink.ready.eq(~read_en)
-        m.d.comb += source.valid.eq(read_en)
+        with m.If(sink.we):
+            with m.If(discard):
+                with m.If(sink.data == SLIP_END):
+                    m.d.sync += discard.eq(0)
+            with m.Elif(escaped):
+                m.d.sync += escaped.eq(0)
+                with m.Switch(sink.data):
+                    with m.Case(SLIP_ESC_ESC.value):
+                        m.d.comb += decoded.eq(SLIP_ESC)
+                        m.d.comb += decode.eq(1)
+                    with m.Case(SLIP_ESC_END.value):
+                        m.d.comb += decoded.eq(SLIP_END)
+                        m.d.comb += decode.eq(1)
+                    with m.Default():
+                        # pulse err, drop the packet so far
+                        m.d.comb += self.err.eq(1)
+                        m.d.comb += restart.eq(1)
+                        if self._crc:
+                            # including whatever is already in the packet buffer
+                            m.d.comb += push.eq(pushed)
+                            m.d.comb += push_eop.eq(1)
+                            m.d.comb += push_drop.eq(1)
+            with m.Else():
+                with m.Switch(sink.data):
+                    with m.Case(SLIP_ESC.value):
+                        # wait for the escaped value
+                        m.d.sync += escaped.eq(1)
+                    with m.Case(SLIP_END.value):
+                        # the held byte ends the packet (nothing held is an empty packet, ignore it)
+                        m.d.comb += push.eq(full)
+                        m.d.comb += push_eop.eq(1)
+                        m.d.comb += restart.eq(1)
+                        if self._crc:
+                            # the rest of held is the trailer, drop the packet if it doesn't check out
+                            m.d.comb += push_drop.eq(~crc_ok)
+                            m.d.comb += self.crc_err.eq((held_count != 0) & ~(full & crc_ok))
+                    with m.Default():
+                        # normal stuff
+                        m.d.comb += decoded.eq(sink.data)
+                        m.d.comb += decode.eq(1)
         
-        with m.If(sink.we & init):
-            with m.FSM():
-                with m.State("INIT"):
-                    with m.Switch(current):
-                        with m.Case(SLIP_ESC.value):
-                            # go to escape state, wait for next input
-                            m.d.sync += read_en.eq(0)
-                            m.next = "ESCAPED_INIT"
-                        with m.Case(SLIP_END.value):
-                            # we can ignore this, it's an empty packet
-                            m.d.sync += read_en.eq(0)
-                            m.next = "INIT" # for clarity
-                        with m.Default():
-                            # normal stuff, output, set SOP, advance to ACTIVE
-                            m.d.sync += source.data.eq(current)
-                            m.d.sync += read_en.eq(1)
-                            m.d.sync += source.sop.eq(1)
-                            m.next = "ACTIVE"
-                with m.State("ACTIVE"):
-                    m.d.sync += source.sop.eq(0)
-                    with m.Switch(current):
-                        with m.Case(SLIP_ESC.value):
-                            # legal. go to escape state, wait for input
-                            m.d.sync += read_en.eq(0)
-                            m.next = "ESCAPED"
-                        with m.Case(SLIP_END.value):
-                            # EOP handled above, wait + reset
-                            m.d.sync += read_en.eq(0)
-                            m.next = "INIT"
-                        with m.Default():
-                            # normal stuff, stay here
-                            m.d.sync += source.data.eq(current)
-                            m.d.sync += read_en.eq(1)
-                            m.next = "ACTIVE" # for clarity
-                with m.State("ESCAPED"):
-                    with m.Switch(current):
-                        with m.Case(SLIP_ESC_ESC.value):
-                            m.d.sync += read_en.eq(1)
-                            m.d.sync += source.data.eq(SLIP_ESC)
-                            m.next = "ACTIVE"
-                        with m.Case(SLIP_ESC_END.value):
-                            m.d.sync += read_en.eq(1)
-                            m.d.sync += source.data.eq(SLIP_END)
-                            m.next = "ACTIVE"
-                        with m.Default():
-                            # pulse err, return to INIT
-                            m.d.comb += self.err.eq(1)
-                            m.d.sync += read_en.eq(0)
-                            m.next = "INIT"
-                with m.State("ESCAPED_INIT"):
-                    # same as Escaped except sets SOP
-                    m.d.sync += source.sop.eq(1)
-                    with m.Switch(current):
-                        with m.Case(SLIP_ESC_ESC.value):
-                            m.d.sync += read_en.eq(1)
-                            m.d.sync += source.data.eq(SLIP_ESC)
-                            m.next = "ACTIVE"
-                        with m.Case(SLIP_ESC_END.value):
-                            m.d.sync += read_en.eq(1)
-                            m.d.sync += source.data.eq(SLIP_END)
-                            m.next = "ACTIVE"
-                        with m.Default():
-                            # pulse err, return to INIT
-                            m.d.sync += read_en.eq(0)
-                            m.d.comb += self.err.eq(1)
-                            m.next = "INIT"
+        with m.If(decode):
+            # push out the oldest byte, hold this one
+            m.d.comb += push.eq(full)
+            m.d.sync += [held[k].eq(held[k + 1]) for k in range(depth - 1)]
+            m.d.sync += held[-1].eq(decoded)
+            m.d.sync += pushed.eq(pushed | full)
+            with m.If(~full):
+                m.d.sync += held_count.eq(held_count + 1)
+        
+        if self._crc:
+            # bytes decoded in this frame, trailer included - a frame longer than mtu would fill the packet buffer
+            # without ever reaching EOP, so it's dropped there and the rest of it skipped
+            length = Signal(range(self._mtu + 1))
+            with m.If(decode):
+                m.d.sync += length.eq(length + 1)
+                with m.If(length == self._mtu):
+                    m.d.comb += self.err.eq(1)
+                    m.d.comb += restart.eq(1)
+                    m.d.comb += push.eq(pushed)
+                    m.d.comb += push_eop.eq(1)
+                    m.d.comb += push_drop.eq(1)
+                    m.d.sync += discard.eq(1)
+            with m.If(restart):
+                m.d.sync += length.eq(0)
+        
+        with m.If(restart):
+            m.d.sync += held_count.eq(0)
+            m.d.sync += pushed.eq(0)
+        
+        # output register, refilled from the skid register first
+        with m.If(~out.valid | out.ready):
+            with m.If(skid_valid):
+                m.d.sync += [
+                        out.data.eq(skid_data),
+                        out.sop.eq(skid_sop),
+                        out.eop.eq(skid_eop),
+                        out_drop.eq(skid_drop),
+                        out.valid.eq(1),
+                        skid_valid.eq(0),
+                    ]
+            with m.Else():
+                m.d.sync += [
+                        out.data.eq(held[0]),
+                        out.sop.eq(~pushed),
+                        out.eop.eq(push_eop),
+                        out_drop.eq(push_drop),
+                        out.valid.eq(push),
+                    ]
+        with m.Elif(push):
+            # output is stalled, park the byte
+            m.d.sync += [
+                    skid_data.eq(held[0]),
+                    skid_sop.eq(~pushed),
+                    skid_eop.eq(push_eop),
+                    skid_drop.eq(push_drop),
+                    skid_valid.eq(1),
+                ]
+        
+        if self._crc:
+            m.submodules.buffer = self.buffer
+            m.d.comb += self.buffer.drop.eq(out_drop)
                         
         return m
 
+class SLIPStriper(Elaboratable):
+    """
+    TODO formal docstring
+    Input: stream without framing (SLIP bytes)
+    Output: one stream without framing per lane
+    Parameter: # of lanes
+    Control signals: none
+    
+    Matches slip_stripe - bytes go round the lanes in turn, and after END every other lane gets END too, so every
+    lane ends every frame and the next one starts on lane 0.
+    """
+    def __init__(self, input: StreamSource, lanes: int):
+        assert Record(input.payload_type).shape().width == 8
+        assert not input.sop_enabled
+        assert not input.eop_enabled
+        assert lanes >= 1
+        
+        self._input = input
+        self._lanes = lanes
+        self.sink = StreamSink.from_source(input, name="stripe_sink")
+        self.sources = [StreamSource(Layout([("data", 8, DIR_FANOUT)]), sop=False, eop=False, name="stripe_source{}".format(l))
+                for l in range(lanes)]
+        
+    def elaborate(self, platform):
+        sink = self.sink
+        
+        m = Module()
+        
+        m.d.comb += [
+                sink.data.eq(self._input.data),
+                self._input.ready.eq(sink.ready),
+                sink.valid.eq(self._input.valid),
+            ]
+        
+        lane = Signal(range(self._lanes))
+        next_lane = Signal(range(self._lanes))
+        m.d.comb += next_lane.eq(Mux(lane == self._lanes - 1, 0, lane + 1))
+        # the lane END came in on
+        end_lane = Signal(range(self._lanes))
+        
+        for source in self.sources:
+            m.d.comb += source.data.eq(sink.data)
+        
+        with m.FSM():
+            with m.State("ACTIVE"):
+                with m.Switch(lane):
+                    for (l, source) in enumerate(self.sources):
+                        with m.Case(l):
+                            m.d.comb += source.valid.eq(sink.valid)
+                            m.d.comb += sink.ready.eq(source.ready)
+                with m.If(sink.we):
+                    m.d.sync += lane.eq(next_lane)
+                    with m.If(sink.data == SLIP_END):
+                        m.d.sync += end_lane.eq(lane)
+                        if self._lanes > 1:
+                            m.next = "PAD"
+            
+            with m.State("PAD"):
+                # END on the other lanes, then start over on lane 0
+                with m.Switch(lane):
+                    for (l, source) in enumerate(self.sources):
+                        with m.Case(l):
+                            m.d.comb += source.data.eq(SLIP_END)
+                            m.d.comb += source.valid.eq(1)
+                            with m.If(source.ready):
+                                m.d.sync += lane.eq(next_lane)
+                                with m.If(next_lane == end_lane):
+                                    m.d.sync += lane.eq(0)
+                                    m.next = "ACTIVE"
+        
+        return m
+
+class SLIPMerger(Elaboratable):
+    """
+    TODO formal docstring
+    Input: one stream without framing per lane
+    Output: stream without framing (SLIP bytes)
+    Parameter: skew buffer depth
+    Control signals: none
+    
+    Undoes SLIPStriper (or slip_stripe), with a FIFO on each lane to soak up skew between them. After END the other
+    lanes are read up to their END, which also brings a lane that has lost or gained bytes back in step.
+    """
+    def __init__(self, inputs: List[StreamSource], depth: int = 16):
+        for input in inputs:
+            assert Record(input.payload_type).shape().width == 8
+            assert not input.sop_enabled
+            assert not input.eop_enabled
+        
+        self._lanes = len(inputs)
+        self.fifos = [SyncFIFOStream(input, depth) for input in inputs]
+        self.source = StreamSource(Layout([("data", 8, DIR_FANOUT)]), sop=False, eop=False, name="merge_source")
+        
+    def elaborate(self, platform):
+        source = self.source
+        
+        m = Module()
+        
+        for (l, fifo) in enumerate(self.fifos):
+            m.submodules["fifo{}".format(l)] = fifo
+        
+        lane = Signal(range(self._lanes))
+        next_lane = Signal(range(self._lanes))
+        m.d.comb += next_lane.eq(Mux(lane == self._lanes - 1, 0, lane + 1))
+        # the lane END came in on
+        end_lane = Signal(range(self._lanes))
+        
+        with m.FSM():
+            with m.State("ACTIVE"):
+                with m.Switch(lane):
+                    for (l, fifo) in enumerate(self.fifos):
+                        with m.Case(l):
+                            m.d.comb += [
+                                    source.data.eq(fifo.source.data),
+                                    source.valid.eq(fifo.source.valid),
+                                    fifo.source.ready.eq(source.ready),
+                                ]
+                with m.If(source.re):
+                    m.d.sync += lane.eq(next_lane)
+                    with m.If(source.data == SLIP_END):
+                        m.d.sync += end_lane.eq(lane)
+                        if self._lanes > 1:
+                            m.next = "SKIP"
+            
+            with m.State("SKIP"):
+                # drop the other lanes up to their END, then start over on lane 0
+                with m.Switch(lane):
+                    for (l, fifo) in enumerate(self.fifos):
+                        with m.Case(l):
+                            m.d.comb += fifo.source.ready.eq(1)
+                            with m.If(fifo.source.valid & (fifo.source.data == SLIP_END)):
+                                m.d.sync += lane.eq(next_lane)
+                                with m.If(next_lane == end_lane):
+                                    m.d.sync += lane.eq(0)
+                                    m.next = "ACTIVE"
+        
+        return m
+
+
+def wide_slip_layout(width):
+    return Layout([("data", width, DIR_FANOUT), ("keep", width // 8, DIR_FANOUT)])
+
+class WideSLIPFramer(Elaboratable):
+    """
+    TODO formal docstring
+    Input: wide stream with framing, lane 0 in data[0:8] goes first, keep marks the valid lanes
+    Output: wide stream without framing, packed (keep is all ones except on a partial word)
+    Parameter: none?
+    Control signals: none
+    """
+    def __init__(self, input: StreamSource):
+        payload = Record(input.payload_type)
+        assert payload.data.shape().width % 8 == 0
+        assert payload.keep.shape().width == payload.data.shape().width // 8
+        assert input.sop_enabled
+        assert input.eop_enabled
+        
+        self._input = input
+        self._lanes = lanes = payload.keep.shape().width
+        self.sink = StreamSink.from_source(input, name="unslip_sink")
+        self.source = StreamSource(wide_slip_layout(lanes * 8), sop=False, eop=False, name="slip_source")
+        
+    def elaborate(self, platform):
+        sink = self.sink
+        source = self.source
+        lanes = self._lanes
+        
+        m = Module()
+        
+        m.d.comb += sink.connect(self._input)
+        
+        # every lane can escape, plus END - at most this many bytes out per word in
+        expanded_bytes = 2 * lanes + 1
+        
+        # expand the input word
+        expanded = Signal(8 * expanded_bytes)
+        expanded_count = Signal(range(expanded_bytes + 1))
+        
+        # output position of each lane (and of END after the last one)
+        pos = [Signal(range(expanded_bytes + 1), name="pos{}".format(i)) for i in range(lanes + 1)]
+        m.d.comb += pos[0].eq(0)
+        
+        expanded_value = Mux(sink.eop, SLIP_END, 0) << (pos[lanes] * 8)
+        for i in range(lanes):
+            byte = sink.data.data[8*i:8*i+8]
+            escapable = (byte == SLIP_END) | (byte == SLIP_ESC)
+            code = Mux(escapable, Cat(SLIP_ESC, Mux(byte == SLIP_END, SLIP_ESC_END, SLIP_ESC_ESC)), byte)
+            expanded_value = expanded_value | (Mux(sink.data.keep[i], code, 0) << (pos[i] * 8))
+            m.d.comb += pos[i + 1].eq(pos[i] + Mux(sink.data.keep[i], 1 + escapable, 0))
+        m.d.comb += expanded.eq(expanded_value)
+        m.d.comb += expanded_count.eq(pos[lanes] + sink.eop)
+        
+        # output byte buffer, lowest byte goes out first
+        capacity = lanes + expanded_bytes
+        buffer = Signal(8 * capacity)
+        level = Signal(range(capacity + 1))
+        
+        take = Signal(range(lanes + 1))
+        with m.If(level >= lanes):
+            # full word
+            m.d.comb += take.eq(lanes)
+        with m.Elif(~sink.valid):
+            # flush what's left rather than wait on an idle input
+            m.d.comb += take.eq(level)
+        
+        m.d.comb += [
+                source.valid.eq(take != 0),
+                source.data.data.eq(buffer[:8 * lanes]),
+                source.data.keep.eq((C(1, lanes + 1) << take) - 1),
+            ]
+        
+        remaining = Signal(range(capacity + 1))
+        m.d.comb += remaining.eq(Mux(source.ready, level - take, level))
+        
+        # take a word whenever the worst case expansion fits
+        m.d.comb += sink.ready.eq(remaining + expanded_bytes <= capacity)
+        
+        kept = Signal(8 * capacity)
+        m.d.comb += kept.eq(Mux(source.ready, buffer >> (take * 8), buffer))
+        
+        with m.If(sink.we):
+            m.d.sync += buffer.eq(kept | (expanded << (remaining * 8)))
+            m.d.sync += level.eq(remaining + expanded_count)
+        with m.Else():
+            m.d.sync += buffer.eq(kept)
+            m.d.sync += level.eq(remaining)
+        
+        return m
+
+class WideSLIPUnframer(Elaboratable):
+    """
+    TODO formal docstring
+    Input: wide stream without framing, lane 0 in data[0:8] goes first, keep marks the valid lanes
+    Output: wide stream with framing, packed (keep is all ones except on the last word of a packet)
+    Parameter: none?
+    Control signals: error
+    """
+    def __init__(self, input: StreamSource):
+        payload = Record(input.payload_type)
+        assert payload.data.shape().width % 8 == 0
+        assert payload.keep.shape().width == payload.data.shape().width // 8
+        assert not input.sop_enabled
+        assert not input.eop_enabled
+        
+        self._input = input
+        self._lanes = lanes = payload.keep.shape().width
+        self.sink = StreamSink.from_source(input, name="slip_sink")
+        self.source = StreamSource(wide_slip_layout(lanes * 8), sop=True, eop=True, name="unslip_source")
+        
+        self.err  = Signal()
+        
+    def elaborate(self, platform):
+        sink = self.sink
+        source = self.source
+        lanes = self._lanes
+        
+        m = Module()
+        
+        m.d.comb += sink.connect(self._input)
+        
+        # lanes before start were already decoded on an earlier cycle (the word had an END in the middle)
+        start = Signal(range(lanes))
+        escaped = Signal()
+        
+        # decode lanes from start up to and including the first END (or illegal escape), one packet per cycle
+        decoded = Signal(8 * lanes)
+        decoded_count = Signal(range(lanes + 1))
+        
+        # escape state, and whether an END or illegal escape has been seen, before each lane
+        esc = [Signal(name="esc{}".format(i)) for i in range(lanes + 1)]
+        stop = [Signal(name="stop{}".format(i)) for i in range(lanes + 1)]
+        # output position of each lane
+        pos = [Signal(range(lanes + 1), name="pos{}".format(i)) for i in range(lanes + 1)]
+        m.d.comb += [
+                esc[0].eq(escaped),
+                stop[0].eq(0),
+                pos[0].eq(0),
+            ]
+        
+        decoded_value = 0
+        ends = []
+        illegals = []
+        for i in range(lanes):
+            byte = sink.data.data[8*i:8*i+8]
+            active = Signal(name="active{}".format(i))
+            m.d.comb += active.eq(sink.data.keep[i] & (start <= i) & ~stop[i])
+            is_end = active & ~esc[i] & (byte == SLIP_END)
+            is_esc = active & ~esc[i] & (byte == SLIP_ESC)
+            legal = (byte == SLIP_ESC_ESC) | (byte == SLIP_ESC_END)
+            illegal = active & esc[i] & ~legal
+            value = Mux(esc[i], Mux(byte == SLIP_ESC_END, SLIP_END, SLIP_ESC), byte)
+            out = active & ~is_end & ~is_esc & ~illegal
+            
+            decoded_value = decoded_value | (Mux(out, value, 0) << (pos[i] * 8))
+            ends.append(is_end)
+            illegals.append(illegal)
+            
+            m.d.comb += [
+                    pos[i + 1].eq(pos[i] + out),
+                    esc[i + 1].eq(Mux(active, is_esc, esc[i])),
+                    stop[i + 1].eq(stop[i] | is_end | illegal),
+                ]
+        
+        m.d.comb += decoded.eq(decoded_value)
+        m.d.comb += decoded_count.eq(pos[lanes])
+        
+        end = Signal()
+        m.d.comb += end.eq(Cat(*ends).any())
+        m.d.comb += self.err.eq(0)
+        
+        # first lane after the END or illegal escape, if the word goes on past it
+        resume = Signal(range(lanes + 1))
+        m.d.comb += resume.eq(lanes)
+        for i in reversed(range(lanes)):
+            with m.If(ends[i] | illegals[i]):
+                m.d.comb += resume.eq(i + 1)
+        
+        # decoded bytes, lowest byte goes out first
+        # bytes wait until there are more than a word's worth, or the packet has ended, so EOP lands on the last word
+        buffer = Signal(16 * lanes)
+        level = Signal(range(2 * lanes + 1))
+        ending = Signal()
+        first = Signal(reset=1)
+        
+        take = Signal(range(lanes + 1))
+        with m.If(level > lanes):
+            m.d.comb += take.eq(lanes)
+        with m.Elif(ending):
+            m.d.comb += take.eq(level)
+        
+        m.d.comb += [
+                source.valid.eq(take != 0),
+                source.data.data.eq(buffer[:8 * lanes]),
+                source.data.keep.eq((C(1, lanes + 1) << take) - 1),
+                source.sop.eq(first),
+                source.eop.eq(ending & (level <= lanes)),
+            ]
+        
+        remaining = Signal(range(2 * lanes + 1))
+        m.d.comb += remaining.eq(Mux(source.ready, level - take, level))
+        
+        kept = Signal(16 * lanes)
+        m.d.comb += kept.eq(Mux(source.ready, buffer >> (take * 8), buffer))
+        
+        with m.If(source.re):
+            m.d.sync += first.eq(0)
+            with m.If(source.eop):
+                m.d.sync += ending.eq(0)
+                m.d.sync += first.eq(1)
+        
+        # decode when there's room for a word, a new packet waits until the last one has gone out
+        room = Signal()
+        m.d.comb += room.eq(~ending & (remaining <= lanes))
+        go = Signal()
+        m.d.comb += go.eq(sink.valid & room)
+        
+        # the word is done unless an END or illegal escape came before a lane still to be decoded
+        done = Signal()
+        m.d.comb += done.eq((resume == lanes) | ((sink.data.keep >> resume) == 0))
+        m.d.comb += sink.ready.eq(room & done)
+        
+        with m.If(go):
+            m.d.sync += escaped.eq(esc[lanes])
+            m.d.sync += start.eq(Mux(done, 0, resume))
+            m.d.sync += buffer.eq(kept | (decoded << (remaining * 8)))
+            m.d.sync += level.eq(remaining + decoded_count)
+            with m.If(Cat(*illegals).any()):
+                # pulse err, drop the packet so far
+                m.d.comb += self.err.eq(1)
+                m.d.sync += level.eq(0)
+                m.d.sync += first.eq(1)
+            with m.Elif(end & (remaining + decoded_count != 0)):
+                # flush out the end of the packet (an END with nothing before it is an empty packet, ignore it)
+                m.d.sync += ending.eq(1)
+        with m.Else():
+            m.d.sync += buffer.eq(kept)
+            m.d.sync += level.eq(remaining)
+        
+        return m
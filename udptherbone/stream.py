@@ -1,6 +1,6 @@
 from nmigen import *
 from nmigen.hdl.rec import *
-from nmigen.lib.fifo import SyncFIFO, AsyncFIFO
+from nmigen.lib.fifo import SyncFIFO, SyncFIFOBuffered, AsyncFIFO
 
 from typing import *
 
@@ -143,6 +143,183 @@ class SyncFIFOStream(Elaboratable):
         return m
 
 
+class SyncFIFOBypass(Elaboratable):
+    """
+    TODO formal docstring
+    Input: FIFO write port
+    Output: FIFO read port
+    Parameter: width, depth
+    
+    A SyncFIFOBuffered with a one word register beside it. A word written while the FIFO is empty goes into the
+    register instead and is readable the next cycle, as from a first-word-fall-through SyncFIFO, but the memory
+    keeps a synchronous read port so it can go in block RAM.
+    """
+    def __init__(self, width: int, depth: int):
+        self.width = width
+        self.depth = depth
+        
+        self.w_data = Signal(width)
+        self.w_en = Signal()
+        self.w_rdy = Signal()
+        self.r_data = Signal(width)
+        self.r_en = Signal()
+        self.r_rdy = Signal()
+        self.level = Signal(range(depth + 2))
+        
+    def elaborate(self, platform):
+        m = Module()
+        
+        m.submodules.fifo = fifo = SyncFIFOBuffered(width=self.width, depth=self.depth)
+        
+        bypass = Signal(self.width)
+        bypass_valid = Signal()
+        # the register only takes a word when nothing older is queued behind it, so it always holds the oldest
+        bypass_we = Signal()
+        m.d.comb += bypass_we.eq(self.w_en & (fifo.level == 0) & (~bypass_valid | self.r_en))
+        
+        m.d.comb += [
+                fifo.w_data.eq(self.w_data),
+                fifo.w_en.eq(self.w_en & ~bypass_we),
+                self.w_rdy.eq(fifo.w_rdy),
+                fifo.r_en.eq(self.r_en & ~bypass_valid),
+                self.r_rdy.eq(bypass_valid | fifo.r_rdy),
+                self.r_data.eq(Mux(bypass_valid, bypass, fifo.r_data)),
+                self.level.eq(fifo.level + bypass_valid),
+            ]
+        
+        with m.If(bypass_we):
+            m.d.sync += bypass.eq(self.w_data)
+            m.d.sync += bypass_valid.eq(1)
+        with m.Elif(self.r_en):
+            m.d.sync += bypass_valid.eq(0)
+        
+        return m
+
+
+class PacketBuffer(Elaboratable):
+    """
+    TODO formal docstring
+    Input: stream with framing
+    Output: stream with framing
+    Parameter: depth (bytes of storage), # of packets in flight at once
+    
+    Packets are stored back to back in one memory ring. Each packet gets a descriptor (offset, length) that is
+    queued on EOP, so the output side only ever sees complete packets. `pending` and `length` show the descriptor
+    of the packet being read out (or next to be), for stages that need the length before the payload.
+    Raising `drop` with EOP discards the packet being written instead of queueing it.
+    A packet only needs a free descriptor for its EOP, so the next packet streams in while in_flight packets wait.
+    
+    A PacketBuffer has one writer and one reader, so each stage that buffers packets (the UDP and IPv4 packetizers,
+    UDPDepacketizer, SLIPUnframer with a CRC) owns a private one, sized for that stage - packets aren't handed along
+    the pipeline through a single shared ring. UDPTherbone keeps its own word-wide capture and response FIFOs.
+    """
+    def __init__(self, input: StreamSource, depth: int, in_flight: int = 2):
+        assert input.sop_enabled
+        assert input.eop_enabled
+        
+        self._input = input
+        self._depth = depth
+        self._in_flight = in_flight
+        self.sink = StreamSink.from_source(input)
+        self.source = StreamSource(input.payload_type, sop=True, eop=True)
+        
+        # bytes of storage in use, including the packet being written
+        self.level = Signal(range(depth + 1))
+        self.pending = Signal()
+        self.length = Signal(range(depth + 1))
+        self.drop = Signal()
+        
+        width = self.source.data.shape().width
+        self.storage = Memory(width=width, depth=depth)
+        self.descriptors = SyncFIFO(width=len(Signal(range(depth))) + len(self.length), depth=in_flight)
+        
+    def _incr(self, ptr):
+        return Mux(ptr == self._depth - 1, 0, ptr + 1)
+        
+    def elaborate(self, platform):
+        m = Module()
+        
+        sink = self.sink
+        source = self.source
+        m.submodules.descriptors = descriptors = self.descriptors
+        m.submodules.w_port = w_port = self.storage.write_port()
+        m.submodules.r_port = r_port = self.storage.read_port()
+        
+        m.d.comb += sink.connect(self._input)
+        
+        we = Signal()
+        re = Signal()
+        m.d.comb += we.eq(sink.valid & sink.ready)
+        m.d.comb += re.eq(source.valid & source.ready)
+        
+        # input side - write at produce, queue a descriptor when the packet is complete
+        produce = Signal(range(self._depth))
+        start = Signal(range(self._depth))
+        count = Signal(range(self._depth + 1))
+        
+        m.d.comb += sink.ready.eq((self.level != self._depth) & (descriptors.w_rdy | ~sink.eop | self.drop))
+        m.d.comb += [
+                w_port.addr.eq(produce),
+                w_port.data.eq(sink.data),
+                w_port.en.eq(we),
+                ]
+        
+        with m.If(we):
+            m.d.sync += produce.eq(self._incr(produce))
+            m.d.sync += count.eq(count + 1)
+            with m.If(sink.eop & self.drop):
+                # roll back to the start of the packet
+                m.d.sync += produce.eq(start)
+                m.d.sync += count.eq(0)
+            with m.Elif(sink.eop):
+                m.d.comb += descriptors.w_data.eq(Cat(start, count + 1))
+                m.d.comb += descriptors.w_en.eq(1)
+                m.d.sync += start.eq(self._incr(produce))
+                m.d.sync += count.eq(0)
+        
+        with m.If(we & sink.eop & self.drop):
+            m.d.sync += self.level.eq(self.level - count - re)
+        with m.Elif(we & ~re):
+            m.d.sync += self.level.eq(self.level + 1)
+        with m.Elif(~we & re):
+            m.d.sync += self.level.eq(self.level - 1)
+        
+        # output side - the read port is registered, so it's always addressed one byte ahead
+        consume = Signal(range(self._depth))
+        remaining = Signal(range(self._depth + 1))
+        first = Signal()
+        
+        offset = descriptors.r_data[:len(consume)]
+        m.d.comb += self.pending.eq(descriptors.r_rdy)
+        m.d.comb += self.length.eq(descriptors.r_data[len(consume):])
+        m.d.comb += source.data.eq(r_port.data)
+        m.d.comb += r_port.addr.eq(consume)
+        
+        with m.FSM(name="output"):
+            with m.State("IDLE"):
+                with m.If(descriptors.r_rdy):
+                    m.d.comb += r_port.addr.eq(offset)
+                    m.d.sync += consume.eq(offset)
+                    m.d.sync += remaining.eq(self.length)
+                    m.d.sync += first.eq(1)
+                    m.next = "PAYLOAD"
+            with m.State("PAYLOAD"):
+                m.d.comb += source.valid.eq(1)
+                m.d.comb += source.sop.eq(first)
+                m.d.comb += source.eop.eq(remaining == 1)
+                with m.If(re):
+                    m.d.comb += r_port.addr.eq(self._incr(consume))
+                    m.d.sync += consume.eq(self._incr(consume))
+                    m.d.sync += remaining.eq(remaining - 1)
+                    m.d.sync += first.eq(0)
+                    with m.If(remaining == 1):
+                        # the descriptor stays at the head of the queue until its last byte is read
+                        m.d.comb += descriptors.r_en.eq(1)
+                        m.next = "IDLE"
+        
+        return m
+
+
 class AsyncFIFOStream(Elaboratable):
     def __init__(self, payload_type: Layout, depth: int, sop: bool = True, eop: bool = True):
         self.source = StreamSource(payload_type, sop, eop)
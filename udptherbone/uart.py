@@ -1,7 +1,10 @@
 from nmigen import *
 from .stream import *
+from .slip import SLIPStriper, SLIPMerger
+from nmigen_soc.wishbone.bus import *
 
 import enum
+from fractions import Fraction
 
 # TODO support parity, stop bits
 class UARTParity(enum.Enum):
@@ -9,21 +12,59 @@ class UARTParity(enum.Enum):
     ODD  = 1
     EVEN = 2
 
+# largest denominator used to approximate a fractional divisor
+MAX_DIVISOR_DENOMINATOR = 1 << 12
+
+# runtime divisors are fixed point, in 1/256ths of a clock
+DIVISOR_FRAC_BITS = 8
+DIVISOR_WIDTH = 24
+
+def divisor_fraction(divisor):
+    return Fraction(divisor).limit_denominator(MAX_DIVISOR_DENOMINATOR)
+
+def divisor_fixed(divisor):
+    return round(divisor * (1 << DIVISOR_FRAC_BITS))
+
+def _baud_tick(m, p, q, restart):
+    # tick every p/q clocks on average, add q each clock and tick (taking off p) on reaching p
+    # p is a constant, or a Signal for a divisor that changes at runtime
+    if isinstance(p, int):
+        assert p >= q
+        acc = Signal(range(p))
+    else:
+        acc = Signal(len(p))
+    tick = Signal()
+    m.d.comb += tick.eq(acc >= p - q)
+    with m.If(restart):
+        m.d.sync += acc.eq(0)
+    with m.Elif(tick):
+        m.d.sync += acc.eq(acc + q - p)
+    with m.Else():
+        m.d.sync += acc.eq(acc + q)
+    return tick
+
 class UARTTx(Elaboratable):
     """
     Parameters
     ----------
-    divisor : int
-        Set to ``round(clk-rate / baud-rate)``.
-        E.g. ``12e6 / 115200`` = ``104``.
+    divisor : int, float or Fraction
+        Set to ``clk-rate / baud-rate``.
+        E.g. ``12e6 / 115200`` = ``104.17``, or ``50e6 / 3e6`` = ``16.67``.
+        Fractional divisors are approximated to ``MAX_DIVISOR_DENOMINATOR``, bit edges jitter by a clock.
+    dynamic : bool
+        Take the divisor from ``divisor_i`` (see ``divisor_fixed``) instead, starting at ``divisor``.
+        Only change it between bytes.
     """
-    def __init__(self, divisor, data_bits=8):
+    def __init__(self, divisor, data_bits=8, dynamic=False):
         assert divisor >= 4
 
         self.data_bits = data_bits
         self.divisor   = divisor
+        self.dynamic   = dynamic
 
         self.tx_o    = Signal()
+        if dynamic:
+            self.divisor_i = Signal(DIVISOR_WIDTH, reset=divisor_fixed(divisor))
 
         self.layout = Layout([("data", data_bits)])
         self.sink = StreamSink(self.layout, False, False, name="tx_sink")
@@ -31,13 +72,19 @@ class UARTTx(Elaboratable):
     def elaborate(self, platform):
         m = Module()
         
-        tx_phase = Signal(range(self.divisor))
         tx_shreg = Signal(1 + self.data_bits + 1, reset=-1)
         tx_count = Signal(range(len(tx_shreg)))
         
         # could wrap this into tx.ready
         tx_active = Signal()
         
+        # bit clock, restarted with each byte
+        if self.dynamic:
+            tx_tick = _baud_tick(m, self.divisor_i, 1 << DIVISOR_FRAC_BITS, ~tx_active)
+        else:
+            divisor = divisor_fraction(self.divisor)
+            tx_tick = _baud_tick(m, divisor.numerator, divisor.denominator, ~tx_active)
+        
         m.d.comb += self.sink.ready.eq(~tx_active)
         m.d.comb += self.tx_o.eq(tx_shreg[0])
         
@@ -46,43 +93,153 @@ class UARTTx(Elaboratable):
             with m.If(self.sink.we):
                 # start bit 0, data, stop bit 1
                 m.d.sync += tx_shreg.eq(Cat(C(0, 1), self.sink.data, C(1, 1)))
-                # reset phase counter - update every divisor clocks
-                m.d.sync += tx_phase.eq(self.divisor - 1)
                 # reset bit counter
                 m.d.sync += tx_count.eq(len(tx_shreg) - 1)
                 m.d.sync += tx_active.eq(1)
         with m.If(tx_active):
-            m.d.sync += tx_phase.eq(tx_phase - 1)
-            with m.If(tx_phase == 0):
+            with m.If(tx_tick):
                 # advance shreg
                 m.d.sync += tx_shreg.eq(Cat(tx_shreg[1:], C(1, 1)))
                 # decrease count
                 m.d.sync += tx_count.eq(tx_count - 1)
-                # reset phase (for non-Po2 divisors)
-                m.d.sync += tx_phase.eq(self.divisor - 1)
                 with m.If(tx_count == 0):
                     # ready for more inputs
                     m.d.sync += tx_active.eq(0)
         
         return m
-                
+
+class UARTAutobaud(Elaboratable):
+    """
+    TODO formal docstring
+    Measures the bit period from training bytes of 0xC0 (SLIP END) on rx_i
+    Parameter: divisor (until locked), min_divisor (a little below is taken as min_divisor)
+    Control signals: divisor out (see divisor_fixed), locked, relock
+    
+    0xC0 goes out as 7 bits low (start bit and six zeros) and at least 3 high. Each low run followed by a long
+    enough high is a candidate, and two candidates in a row that agree to 1/16 set the divisor to their average.
+    The measurement is good to about a clock over 14 bits, so divisors from 8 up are safe. relock starts over.
+    Other traffic can train it too (0x55 at seven times the rate has the same runs), so send only END until locked.
+    
+    NOTE rx_i must be synchronized externally
+    """
+    def __init__(self, divisor, min_divisor=4):
+        assert min_divisor >= 4
+        
+        self._min_divisor = min_divisor
+        
+        self.rx_i      = Signal()
+        self.divisor_o = Signal(DIVISOR_WIDTH, reset=divisor_fixed(divisor))
+        self.locked    = Signal()
+        self.relock    = Signal()
+        
+    def elaborate(self, platform):
+        m = Module()
+        
+        # seven bits of the longest divisor
+        run_width = DIVISOR_WIDTH - DIVISOR_FRAC_BITS + 3
+        run_max = (1 << run_width) - 1
+        
+        low = Signal(run_width)
+        high = Signal(run_width)
+        last = Signal(run_width)
+        last_valid = Signal()
+        
+        difference = Signal(run_width)
+        m.d.comb += difference.eq(Mux(low > last, low - last, last - low))
+        
+        # (low + last) / 14 bits, in 1/256ths - 256 / 14 is close to 37449 / 2048
+        divisor = Signal(run_width + 1 + 16)
+        m.d.comb += divisor.eq(((low + last) * 37449) >> 11)
+        # measurements this short are taken as min_divisor, anything shorter is out of range
+        min_divisor = divisor_fixed(self._min_divisor)
+        min_low = int(7 * self._min_divisor * 15 / 16)
+        
+        with m.FSM():
+            with m.State("IDLE"):
+                with m.If(~self.rx_i):
+                    m.d.sync += low.eq(1)
+                    m.next = "LOW"
+            
+            with m.State("LOW"):
+                with m.If(~self.rx_i):
+                    with m.If(low != run_max):
+                        m.d.sync += low.eq(low + 1)
+                with m.Else():
+                    m.d.sync += high.eq(1)
+                    m.next = "HIGH"
+            
+            with m.State("HIGH"):
+                with m.If(~self.rx_i):
+                    # high for less than two bits, not 0xC0
+                    m.d.sync += last_valid.eq(0)
+                    m.d.sync += low.eq(1)
+                    m.next = "LOW"
+                with m.Elif(high >= low[2:]):
+                    with m.If((low < min_low) | (low == run_max)):
+                        # out of range
+                        m.d.sync += last_valid.eq(0)
+                        m.next = "IDLE"
+                    with m.Elif(last_valid & (difference <= last[4:])):
+                        m.d.sync += self.divisor_o.eq(Mux(divisor < min_divisor, min_divisor, divisor))
+                        m.d.sync += self.locked.eq(1)
+                        m.next = "LOCKED"
+                    with m.Else():
+                        m.d.sync += last.eq(low)
+                        m.d.sync += last_valid.eq(1)
+                        m.next = "IDLE"
+                with m.Else():
+                    m.d.sync += high.eq(high + 1)
+            
+            with m.State("LOCKED"):
+                with m.If(self.relock):
+                    m.d.sync += self.locked.eq(0)
+                    m.d.sync += last_valid.eq(0)
+                    m.next = "IDLE"
+        
+        return m
+
 class UARTRx(Elaboratable):
     """
     Parameters
     ----------
-    divisor : int
-        Set to ``round(clk-rate / baud-rate)``.
-        E.g. ``12e6 / 115200`` = ``104``.
-        
+    divisor : int, float or Fraction
+        Set to ``clk-rate / baud-rate``.
+        E.g. ``12e6 / 115200`` = ``104.17``, or ``50e6 / 3e6`` = ``16.67``.
+    oversample : int
+        Samples per bit, at most ``divisor``. Each bit is the majority of the three samples around mid-bit,
+        and the sample clock restarts on every start bit edge.
+    dynamic : bool
+        Take the divisor from ``divisor_i`` (see ``divisor_fixed``) instead, starting at ``divisor``.
+        Only change it between bytes, and no lower than ``min_divisor``, which sets the oversampling.
+    autobaud : bool
+        Take the divisor from a UARTAutobaud on rx_i instead, nothing comes out until it has locked.
+        ``divisor_o`` can drive a dynamic UARTTx, ``locked`` and ``relock`` are the UARTAutobaud's.
+
     NOTE rx_i must be synchronized externally
+    err pulses on a framing error (stop bit 0), the byte is dropped
+    overrun pulses when a byte arrives before the last one was read, the last one is lost
     """
-    def __init__(self, divisor, data_bits=8):
-        assert divisor >= 4
+    def __init__(self, divisor, data_bits=8, oversample=16, dynamic=False, min_divisor=None, autobaud=False):
+        if min_divisor is None:
+            min_divisor = divisor
+        assert 4 <= min_divisor <= divisor
+        assert not (dynamic and autobaud)
 
-        self.data_bits = data_bits
-        self.divisor   = divisor
+        self.data_bits  = data_bits
+        self.divisor    = divisor
+        self.dynamic    = dynamic
+        self.oversample = min(oversample, int(min_divisor))
 
         self.rx_i    = Signal()
+        if dynamic:
+            self.divisor_i = Signal(DIVISOR_WIDTH, reset=divisor_fixed(divisor))
+        self.autobaud = UARTAutobaud(divisor, min_divisor) if autobaud else None
+        if autobaud:
+            self.divisor_o = self.autobaud.divisor_o
+            self.locked    = self.autobaud.locked
+            self.relock    = self.autobaud.relock
+        self.err     = Signal()
+        self.overrun = Signal()
 
         self.layout = Layout([("data", data_bits)])
         self.source = StreamSource(self.layout, False, False, name="rx")
@@ -90,37 +247,290 @@ class UARTRx(Elaboratable):
     def elaborate(self, platform):
         m = Module()
         
-        rx_phase = Signal(range(self.divisor))
+        n = self.oversample
+        
         rx_shreg = Signal(1 + self.data_bits + 1, reset=-1)
         rx_count = Signal(range(len(rx_shreg)))
         
-        m.d.sync += self.source.valid.eq(0) # overridden in some states
+        # sample clock, n ticks per bit, lined up with the start bit edge
+        restart = Signal()
+        if self.autobaud:
+            m.submodules.autobaud = self.autobaud
+            m.d.comb += self.autobaud.rx_i.eq(self.rx_i)
+            rx_tick = _baud_tick(m, self.autobaud.divisor_o, n << DIVISOR_FRAC_BITS, restart)
+        elif self.dynamic:
+            rx_tick = _baud_tick(m, self.divisor_i, n << DIVISOR_FRAC_BITS, restart)
+        else:
+            divisor = divisor_fraction(self.divisor) / n
+            rx_tick = _baud_tick(m, divisor.numerator, divisor.denominator, restart)
+        # sample number within the bit, the start bit edge is sample 0
+        rx_sample = Signal(range(n))
+        # the two samples before this one
+        rx_window = Signal(2)
+        # the divisor was good when the byte started
+        rx_locked = Signal()
+        rx_bit = Signal()
+        m.d.comb += rx_bit.eq((rx_window[0] & rx_window[1]) | (rx_window[0] & self.rx_i) | (rx_window[1] & self.rx_i))
+        
+        with m.If(self.source.re):
+            m.d.sync += self.source.valid.eq(0) # may be overridden below
+        
+        m.d.comb += self.err.eq(0)
+        m.d.comb += self.overrun.eq(0)
         
-        m.d.comb += self.source.data.eq(rx_shreg[1:-1])
-
         with m.FSM():
             with m.State("IDLE"):
                 with m.If(~self.rx_i):
+                    m.d.comb += restart.eq(1)
+                    m.d.sync += rx_sample.eq(1)
                     m.d.sync += rx_count.eq(len(rx_shreg) - 1)
-                    m.d.sync += rx_phase.eq(self.divisor // 2) # sample mid-bit
+                    m.d.sync += rx_locked.eq(self.locked if self.autobaud else 1)
                     m.next = "SAMPLING"
             with m.State("SAMPLING"):
-                m.d.sync += rx_phase.eq(rx_phase - 1)
-                with m.If(rx_phase == 0):
-                    # sample
-                    m.d.sync += rx_shreg.eq(Cat(rx_shreg[1:], self.rx_i))
-                    # decrease count
-                    m.d.sync += rx_count.eq(rx_count - 1)
-                    # reset phase (for non-Po2 divisors)
-                    m.d.sync += rx_phase.eq(self.divisor - 1)
-                    with m.If(rx_count == 0):
-                        # ready to be read out
-                        m.d.sync += self.source.valid.eq(1)
-                        m.next = "HOLDING"
-            with m.State("HOLDING"):
-                m.d.sync += self.source.valid.eq(1)
-                with m.If(self.source.re):
-                    m.d.sync += self.source.valid.eq(0)
+                with m.If(rx_tick):
+                    m.d.sync += rx_window.eq(Cat(self.rx_i, rx_window[0]))
+                    m.d.sync += rx_sample.eq(Mux(rx_sample == n - 1, 0, rx_sample + 1))
+                    with m.If(rx_sample == n // 2 + 1):
+                        # vote
+                        m.d.sync += rx_shreg.eq(Cat(rx_shreg[1:], rx_bit))
+                        # decrease count
+                        m.d.sync += rx_count.eq(rx_count - 1)
+                        with m.If((rx_count == len(rx_shreg) - 1) & rx_bit):
+                            # glitch, not a start bit
+                            m.next = "IDLE"
+                        with m.Elif(rx_count == 0):
+                            # stop bit, go back to looking for the next edge right away
+                            with m.If(rx_bit & rx_locked):
+                                m.d.sync += self.source.data.eq(rx_shreg[2:])
+                                m.d.sync += self.source.valid.eq(1)
+                                m.d.comb += self.overrun.eq(self.source.valid & ~self.source.ready)
+                                m.next = "IDLE"
+                            with m.Elif(rx_bit):
+                                # started before the divisor locked
+                                m.next = "IDLE"
+                            with m.Else():
+                                m.d.comb += self.err.eq(rx_locked)
+                                m.next = "BREAK"
+            with m.State("BREAK"):
+                # wait for the line to go idle before looking for a start bit
+                with m.If(self.rx_i):
                     m.next = "IDLE"
+        
+        return m
 
+class BufferedUART(Elaboratable):
+    """
+    TODO formal docstring
+    Input: stream to send
+    Output: received stream
+    Parameter: divisor, data bits, FIFO depths, RTS headroom
+    Control signals: error, overrun
+    
+    UARTTx and UARTRx with a SyncFIFOStream on each side and RTS/CTS flow control. rts_o and cts_i are active low,
+    as on the wire. rts_o goes high once fewer than rts_headroom entries are free in the receive FIFO, which has
+    to cover what the other end sends before it notices. A byte only starts going out while cts_i is low.
+    
+    NOTE rx_i and cts_i must be synchronized externally
+    """
+    def __init__(self, input: StreamSource, divisor, data_bits=8, tx_depth: int = 16, rx_depth: int = 64,
+            rts_headroom: int = 16, dynamic=False, min_divisor=None):
+        assert 0 < rts_headroom < rx_depth
+        
+        self.rx_depth = rx_depth
+        self.rts_headroom = rts_headroom
+        self.dynamic = dynamic
+        
+        self.tx = UARTTx(divisor, data_bits, dynamic=dynamic)
+        self.rx = UARTRx(divisor, data_bits, dynamic=dynamic, min_divisor=min_divisor)
+        self.tx_fifo = SyncFIFOStream(input, tx_depth)
+        self.rx_fifo = SyncFIFOStream(self.rx.source, rx_depth)
+        
+        self.sink = self.tx_fifo.sink
+        self.source = self.rx_fifo.source
+        
+        self.tx_o    = Signal()
+        self.rx_i    = Signal()
+        self.rts_o   = Signal(reset=1)
+        self.cts_i   = Signal()
+        
+        self.err     = Signal()
+        self.overrun = Signal()
+        # nothing left to send
+        self.idle    = Signal()
+        if dynamic:
+            self.divisor_i = Signal(DIVISOR_WIDTH, reset=divisor_fixed(divisor))
+        
+    def elaborate(self, platform):
+        m = Module()
+        
+        m.submodules.tx = tx = self.tx
+        m.submodules.rx = rx = self.rx
+        m.submodules.tx_fifo = tx_fifo = self.tx_fifo
+        m.submodules.rx_fifo = rx_fifo = self.rx_fifo
+        
+        m.d.comb += [
+                self.tx_o.eq(tx.tx_o),
+                rx.rx_i.eq(self.rx_i),
+                self.err.eq(rx.err),
+                self.overrun.eq(rx.overrun),
+                self.idle.eq(~self.tx_fifo.source.valid & tx.sink.ready),
+            ]
+        
+        if self.dynamic:
+            m.d.comb += tx.divisor_i.eq(self.divisor_i)
+            m.d.comb += rx.divisor_i.eq(self.divisor_i)
+        
+        # hold back the next byte while the other end can't take it
+        m.d.comb += [
+                tx.sink.data.eq(tx_fifo.source.data),
+                tx.sink.valid.eq(tx_fifo.source.valid & ~self.cts_i),
+                tx_fifo.source.ready.eq(tx.sink.ready & ~self.cts_i),
+            ]
+        
+        # ask the other end to stop while the receive FIFO is nearly full
+        m.d.sync += self.rts_o.eq(rx_fifo.fifo.level >= self.rx_depth - self.rts_headroom)
+        
+        return m
+
+class UARTBaudControl(Elaboratable):
+    """
+    TODO formal docstring
+    Wishbone registers for switching the divisor of dynamic UARTs at runtime
+    Parameter: divisor (at reset), timeout (clocks), bus width and features
+    Control signals: sent, idle, valid in, divisor out
+    
+    Registers (bus words):
+        0 DIVISOR  write to request a new divisor (see divisor_fixed), read for the divisor in use
+        1 STATUS   bit 0 - a new divisor is waiting to take effect, bit 1 - on trial at the new divisor
+    
+    A new divisor takes effect once the next response has gone out (sent pulses at its end, then idle is high when
+    the UART has nothing left to send), so the host follows the write with a read and switches itself after the
+    reply. After that, unless valid pulses (a good packet arrived) within timeout clocks, the divisor goes back
+    to what it was.
+    """
+    def __init__(self, divisor, timeout: int, data_width=32, features=["stall"]):
+        assert data_width >= DIVISOR_WIDTH
+        
+        self.bus = Interface(addr_width=1, data_width=data_width, features=features)
+        self._features = features
+        self._timeout = timeout
+        
+        self.divisor_o = Signal(DIVISOR_WIDTH, reset=divisor_fixed(divisor))
+        
+        self.sent_i  = Signal()
+        self.idle_i  = Signal()
+        self.valid_i = Signal()
+        
+    def elaborate(self, platform):
+        m = Module()
+        
+        bus = self.bus
+        
+        requested = Signal(DIVISOR_WIDTH)
+        # the divisor to go back to
+        previous = Signal(DIVISOR_WIDTH)
+        timer = Signal(range(self._timeout + 1))
+        
+        pending = Signal()
+        trial = Signal()
+        
+        # single cycle registers, one ack per request
+        access = Signal()
+        if "stall" in self._features:
+            m.d.comb += bus.stall.eq(0)
+            m.d.comb += access.eq(bus.cyc & bus.stb)
+        else:
+            m.d.comb += access.eq(bus.cyc & bus.stb & ~bus.ack)
+        m.d.sync += bus.ack.eq(access)
+        
+        with m.If(access & ~bus.we):
+            m.d.sync += bus.dat_r.eq(Mux(bus.adr[0], Cat(pending, trial), self.divisor_o))
+        
+        write = Signal()
+        m.d.comb += write.eq(access & bus.we & (bus.adr[0] == 0))
+        
+        with m.FSM():
+            with m.State("IDLE"):
+                with m.If(write):
+                    m.d.sync += requested.eq(bus.dat_w)
+                    m.d.sync += pending.eq(1)
+                    m.next = "RESPOND"
+            
+            with m.State("RESPOND"):
+                # wait for the end of the response to the request
+                with m.If(write):
+                    m.d.sync += requested.eq(bus.dat_w)
+                with m.If(self.sent_i):
+                    m.next = "DRAIN"
+            
+            with m.State("DRAIN"):
+                # and for it to leave the UART
+                with m.If(self.idle_i):
+                    m.d.sync += [
+                            previous.eq(self.divisor_o),
+                            self.divisor_o.eq(requested),
+                            pending.eq(0),
+                            trial.eq(1),
+                            timer.eq(self._timeout),
+                        ]
+                    m.next = "TRIAL"
+            
+            with m.State("TRIAL"):
+                m.d.sync += timer.eq(timer - 1)
+                with m.If(self.valid_i):
+                    # the host made it across, keep the new divisor
+                    m.d.sync += trial.eq(0)
+                    m.next = "IDLE"
+                with m.Elif(timer == 0):
+                    # nothing heard, go back
+                    m.d.sync += self.divisor_o.eq(previous)
+                    m.d.sync += trial.eq(0)
+                    m.next = "IDLE"
+        
+        return m
+
+class BondedUART(Elaboratable):
+    """
+    TODO formal docstring
+    Input: SLIP stream to send
+    Output: received SLIP stream
+    Parameter: # of lanes, divisor, skew buffer depth
+    Control signals: error, overrun (any lane)
+    
+    SLIP bytes striped over several UARTs (see SLIPStriper and slip_stripe), for a link lanes times as fast.
+    tx_o and rx_i have a bit per lane, the receive side buffers up to depth bytes of skew between lanes.
+    
+    NOTE rx_i must be synchronized externally
+    """
+    def __init__(self, input: StreamSource, lanes: int, divisor, depth: int = 16):
+        self.striper = SLIPStriper(input, lanes)
+        self.txs = [UARTTx(divisor) for _ in range(lanes)]
+        self.rxs = [UARTRx(divisor) for _ in range(lanes)]
+        self.merger = SLIPMerger([rx.source for rx in self.rxs], depth)
+        
+        self.sink = self.striper.sink
+        self.source = self.merger.source
+        
+        self.tx_o    = Signal(lanes)
+        self.rx_i    = Signal(lanes)
+        
+        self.err     = Signal()
+        self.overrun = Signal()
+        
+    def elaborate(self, platform):
+        m = Module()
+        
+        m.submodules.striper = self.striper
+        m.submodules.merger = self.merger
+        
+        for (l, (tx, rx)) in enumerate(zip(self.txs, self.rxs)):
+            m.submodules["tx{}".format(l)] = tx
+            m.submodules["rx{}".format(l)] = rx
+            m.d.comb += tx.sink.connect(self.striper.sources[l])
+            m.d.comb += self.tx_o[l].eq(tx.tx_o)
+            m.d.comb += rx.rx_i.eq(self.rx_i[l])
+        
+        m.d.comb += self.err.eq(Cat(rx.err for rx in self.rxs).any())
+        m.d.comb += self.overrun.eq(Cat(rx.overrun for rx in self.rxs).any())
+        
         return m
@@ -2,6 +2,7 @@
 from nmigen import *
 from nmigen.lib.fifo import SyncFIFOBuffered
 from .stream import *
+from .header import *
 
 import enum
 import ipaddress
@@ -29,10 +30,14 @@ class UDPDepacketizer(Elaboratable):
     TODO formal docstring
     Input: stream with framing
     Output: stream with framing
-    Parameter: IP, port
+    Parameter: IP, port, MTU (buffer size), # in flight at once, cut-through, UDP checksum
+    Control signals: checksum error, UDP checksum error, length error (pulses, and counts of dropped packets)
     """
-    def __init__(self, input: StreamSource, ip: ipaddress.IPv4Address, port: int, mtu: int = 1500, in_flight: int = 2):
+    def __init__(self, input: StreamSource, ip: ipaddress.IPv4Address, port: int, mtu: int = 1500, in_flight: int = 2,
+            cut_through: bool = False, udp_checksum: bool = False):
         assert port <= 65535
+        # a bad UDP checksum is only known at the last payload byte, by then a cut-through payload is already gone
+        assert not (cut_through and udp_checksum)
 
         assert Record(input.payload_type).shape().width == 8
         # these come from the SLIP decoder
@@ -47,6 +52,34 @@ class UDPDepacketizer(Elaboratable):
         self._port = C(port, 16)
         self._mtu = mtu
         self._in_flight = in_flight
+        # with cut_through, payload bytes are passed downstream as they arrive instead of once the datagram is
+        # complete - nothing is buffered, but a datagram can't be dropped once its payload has started
+        self._cut_through = cut_through
+        
+        # packets dropped for a bad IPv4 header checksum, before their payload is buffered
+        self.checksum_err = Signal()
+        self.checksum_errors = Signal(32)
+        
+        # with udp_checksum, datagrams are also checked end to end and a bad one is rolled back out of the packet
+        # buffer instead of being passed on (a checksum of 0 means the sender didn't compute one)
+        self._udp_checksum = udp_checksum
+        self.udp_checksum_err = Signal()
+        self.udp_checksum_errors = Signal(32)
+        
+        # datagrams dropped for a payload that's empty or doesn't fit the MTU, before any of it is buffered
+        self.length_err = Signal()
+        self.length_errors = Signal(32)
+        
+    def _partial_udp_checksum(self, ihl):
+        # pseudo-header fields known up front: destination IP and protocol, and minus the IP header length so that
+        # summing the IP total length as it arrives leaves the UDP length
+        full_sum = self._ip[16:] + \
+            self._ip[:16] + \
+            C(IPProtocolNumber.UDP.value, 16) + \
+            ~Cat(C(0, 2), ihl, C(0, 10))
+        
+        full_sum = full_sum[:16] + full_sum[16:]
+        return (full_sum[:16] + full_sum[16:])[:16]
         
     def elaborate(self, platform):
         sink = self.sink
@@ -54,231 +87,187 @@ class UDPDepacketizer(Elaboratable):
         
         m = Module()
         
-        m.submodules.fifo = fifo = SyncFIFOBuffered(width=8, depth=self._mtu)
-        m.submodules.counter_fifo = counter_fifo = SyncFIFOBuffered(width=16, depth=self._in_flight)
+        payload = StreamSource(Layout([("data", 8, DIR_FANOUT)]), sop=True, eop=True, name="payload")
         
         counter = Signal(16)
-        input_counter = Signal(16)
         
         we = Signal()
         m.d.comb += we.eq(sink.valid & sink.ready)
         
-        m.d.comb += fifo.w_data.eq(sink.data)
-        m.d.comb += fifo.w_en.eq(0)
-        m.d.comb += counter_fifo.w_data.eq(input_counter)
-        m.d.comb += counter_fifo.w_en.eq(0)
-        
-        input_active = Signal()
+        m.d.comb += payload.data.eq(sink.data)
+        
+        in_payload = Signal()
+        payload_first = Signal()
+        
+        # IPv4 header, any options are skipped after it
+        m.submodules.ip_header = ip_header = HeaderParser([
+                ("version", 0, 4, FieldAction.MATCH, IP_VERSION),
+                ("ihl", 4, 4, FieldAction.CAPTURE, None),
+                ("dscp", 8, 6, FieldAction.MATCH, DSCP),
+                ("ecn", 14, 2, FieldAction.MATCH, ECN),
+                ("total_length", 16, 16, FieldAction.CAPTURE, None),
+                ("id", 32, 16, FieldAction.IGNORE, None),
+                ("flags", 48, 3, FieldAction.MATCH, FLAGS),
+                ("fo", 51, 13, FieldAction.MATCH, FO),
+                ("ttl", 64, 8, FieldAction.IGNORE, None),
+                ("protocol", 72, 8, FieldAction.MATCH, IPProtocolNumber.UDP.value),
+                # checksum is summed with the rest, checked at the end of the header
+                ("checksum", 80, 16, FieldAction.IGNORE, None),
+                ("source", 96, 32, FieldAction.IGNORE, None),
+                ("dest", 128, 32, FieldAction.MATCH, self._ip),
+            ], length=20)
+        ihl = ip_header.fields["ihl"]
+        idle = Signal()
+        m.d.comb += [
+                ip_header.data.eq(sink.data),
+                ip_header.valid.eq(we & idle),
+                ip_header.start.eq(sink.sop),
+            ]
+        
+        # UDP header, the length has to agree with the IPv4 header (or the datagram is fragmented)
+        udp_length = Signal(16)
+        m.d.comb += udp_length.eq(ip_header.fields["total_length"] - Cat(C(0, 2), ihl))
+        m.submodules.udp_header = udp_header = HeaderParser([
+                ("source_port", 0, 16, FieldAction.IGNORE, None),
+                ("dest_port", 16, 16, FieldAction.MATCH, self._port),
+                ("length", 32, 16, FieldAction.MATCH, udp_length),
+                # checksum is summed with the rest, checked at the end of the payload
+                ("checksum", 48, 16, FieldAction.CAPTURE, None),
+            ], length=8)
+        udp_first = Signal()
+        m.d.comb += [
+                udp_header.data.eq(sink.data),
+                udp_header.start.eq(udp_first),
+            ]
+        
+        # bytes of IPv4 options left
+        options = Signal(6)
+        
+        # running one's complement sums, high byte of each word first - the IPv4 header, and the UDP pseudo-header,
+        # header and payload
+        odd = Signal()
+        odd_byte = Signal()
+        word = Signal(16)
+        m.d.comb += odd_byte.eq(odd & ~(ip_header.active & (ip_header.offset == 0)))
+        m.d.comb += word.eq(Mux(odd_byte, sink.data, Cat(C(0, 8), sink.data)))
+        with m.If(we):
+            m.d.sync += odd.eq(~odd_byte)
+        
+        header_sum = Signal(16)
+        header_total = Signal(17)
+        next_header_sum = Signal(16)
+        m.d.comb += header_total.eq(header_sum + word)
+        m.d.comb += next_header_sum.eq(header_total[:16] + header_total[16])
+        
+        udp_sum = Signal(16)
+        udp_total = Signal(17)
+        next_udp_sum = Signal(16)
+        udp_unchecked = Signal()
+        m.d.comb += udp_total.eq(udp_sum + word)
+        m.d.comb += next_udp_sum.eq(udp_total[:16] + udp_total[16])
+        # a checksum of 0 means the sender didn't compute one
+        m.d.comb += udp_unchecked.eq(udp_header.fields["checksum"] == 0)
+        
+        m.d.comb += self.checksum_err.eq(0)
+        with m.If(self.checksum_err):
+            m.d.sync += self.checksum_errors.eq(self.checksum_errors + 1)
+        m.d.comb += self.udp_checksum_err.eq(0)
+        with m.If(self.udp_checksum_err):
+            m.d.sync += self.udp_checksum_errors.eq(self.udp_checksum_errors + 1)
+        m.d.comb += self.length_err.eq(0)
+        with m.If(self.length_err):
+            m.d.sync += self.length_errors.eq(self.length_errors + 1)
         
         m.d.comb += self.sink.connect(self._input)
-        m.d.comb += sink.ready.eq((fifo.level == 0) | input_active)
+        # headers are always accepted, payload bytes when there's somewhere to put them
+        m.d.comb += sink.ready.eq(~in_payload | payload.ready)
+        if not self._cut_through:
+            # Payloads go into a packet buffer sized for the largest UDP payload that fits the MTU. Headers are parsed
+            # and payloads written while earlier datagrams drain, up to in_flight complete datagrams.
+            m.submodules.buffer = buffer = PacketBuffer(payload, depth=self._mtu - 28, in_flight=self._in_flight)
         
         # input FSM
         with m.FSM(name='input_fsm') as fsm:
             with m.State("IDLE"):
+                # the IPv4 header is parsed from any SOP
+                with m.If(ip_header.done):
+                    with m.If(ihl == 5):
+                        with m.If(next_header_sum != 0xFFFF):
+                            # corrupted header, drop the packet before any of it is buffered
+                            m.d.comb += self.checksum_err.eq(1)
+                        with m.Else():
+                            m.d.sync += udp_first.eq(1)
+                            m.next = "UDP_HEADER"
+                    with m.Elif(ihl > 5):
+                        m.d.sync += options.eq(Cat(C(0, 2), ihl) - 20)
+                        m.next = "OPTIONS"
+            with m.State("OPTIONS"):
                 with m.If(we):
-                    with m.If(self._input.sop):
-                        m.d.sync += input_active.eq(1)
-                        with m.If(sink.data == Cat(IHL, IP_VERSION)):
-                            # possible legal IPv4 packet, advance
-                            m.next = "HEADER_BYTE1"
-            with m.State("HEADER_BYTE1"):
-                with m.If(we):
-                    with m.If(sink.data == Cat(ECN, DSCP)):
-                        m.next = "HEADER_BYTE2"
-                    with m.Else():
-                        # error - return to IDLE
-                        m.d.sync += input_active.eq(0)
-                        m.next = "IDLE"
-            with m.State("HEADER_BYTE2"):
-                with m.If(we):
-                    m.d.sync += counter[8:].eq(sink.data)
-                    m.next = "HEADER_BYTE3"
-            with m.State("HEADER_BYTE3"):
-                with m.If(we):
-                    m.d.sync += counter[:8].eq(sink.data)
-                    m.next = "HEADER_BYTE4"
-            with m.State("HEADER_BYTE4"):
-                with m.If(we):
-                    # ignore Identification field
-                    #with m.If(sink.data == ID[8:]):
-                    m.next = "HEADER_BYTE5"
-                    #with m.Else():
-                    #    m.d.sync += input_active.eq(0)
-                    #    m.next = "IDLE"
-            with m.State("HEADER_BYTE5"):
-                with m.If(we):
-                    # ignore Identification field
-                    #with m.If(sink.data == ID[:8]):
-                    m.next = "HEADER_BYTE6"
-                    #with m.Else():
-                    #    m.d.sync += input_active.eq(0)
-                    #    m.next = "IDLE"
-            with m.State("HEADER_BYTE6"):
-                with m.If(we):
-                    with m.If(sink.data == Cat(FO[8:], FLAGS)):
-                        m.next = "HEADER_BYTE7"
-                    with m.Else():
-                        m.d.sync += input_active.eq(0)
-                        m.next = "IDLE"
-            with m.State("HEADER_BYTE7"):
-                with m.If(we):
-                    with m.If(sink.data == FO[:8]):
-                        m.next = "HEADER_BYTE8"
-                    with m.Else():
-                        m.d.sync += input_active.eq(0)
-                        m.next = "IDLE"
-            with m.State("HEADER_BYTE8"):
-                with m.If(we):
-                    # TTL is ignored
-                    m.next = "HEADER_BYTE9"
-            with m.State("HEADER_BYTE9"):
-                with m.If(we):
-                    with m.If(sink.data == IPProtocolNumber.UDP.value):
-                        m.next = "HEADER_BYTE10"
-                    with m.Else():
-                        m.d.sync += input_active.eq(0)
-                        m.next = "IDLE"
-            with m.State("HEADER_BYTE10"):
-                with m.If(we):
-                    # TODO validate checksum
-                    m.next = "HEADER_BYTE11"
-            with m.State("HEADER_BYTE11"):
-                with m.If(we):
-                    # TODO validate checksum
-                    m.next = "HEADER_BYTE12"
-            with m.State("HEADER_BYTE12"):
-                with m.If(we):
-                    # source IP is ignored
-                    m.next = "HEADER_BYTE13"
-            with m.State("HEADER_BYTE13"):
-                with m.If(we):
-                    # source IP is ignored
-                    m.next = "HEADER_BYTE14"
-            with m.State("HEADER_BYTE14"):
-                with m.If(we):
-                    # source IP is ignored
-                    m.next = "HEADER_BYTE15"
-            with m.State("HEADER_BYTE15"):
-                with m.If(we):
-                    # source IP is ignored
-                    m.next = "HEADER_BYTE16"
-            with m.State("HEADER_BYTE16"):
-                with m.If(we):
-                    with m.If(sink.data == self._ip[24:]):
-                        m.next = "HEADER_BYTE17"
-                    with m.Else():
-                        m.d.sync += input_active.eq(0)
-                        m.next = "IDLE"
-            with m.State("HEADER_BYTE17"):
-                with m.If(we):
-                    with m.If(sink.data == self._ip[16:24]):
-                        m.next = "HEADER_BYTE18"
-                    with m.Else():
-                        m.d.sync += input_active.eq(0)
-                        m.next = "IDLE"
-            with m.State("HEADER_BYTE18"):
-                with m.If(we):
-                    with m.If(sink.data == self._ip[8:16]):
-                        m.next = "HEADER_BYTE19"
-                    with m.Else():
-                        m.d.sync += input_active.eq(0)
-                        m.next = "IDLE"
-            with m.State("HEADER_BYTE19"):
-                with m.If(we):
-                    with m.If(sink.data == self._ip[:8]):
-                        # assume no options
-                        m.next = "UDP_HEADER_BYTE0"
-                    with m.Else():
-                        m.d.sync += input_active.eq(0)
-                        m.next = "IDLE"
-            with m.State("UDP_HEADER_BYTE0"):
-                with m.If(we):
-                    # source port is ignored
-                    m.next = "UDP_HEADER_BYTE1"
-            with m.State("UDP_HEADER_BYTE1"):
-                with m.If(we):
-                    # source port is ignored
-                    m.next = "UDP_HEADER_BYTE2"
-            with m.State("UDP_HEADER_BYTE2"):
-                with m.If(we):
-                    with m.If(sink.data == self._port[8:]):
-                        m.next = "UDP_HEADER_BYTE3"
-                    with m.Else():
-                        m.d.sync += input_active.eq(0)
-                        m.next = "IDLE"
-            with m.State("UDP_HEADER_BYTE3"):
+                    # options are summed with the rest of the header, but otherwise ignored
+                    m.d.sync += options.eq(options - 1)
+                    with m.If(options == 1):
+                        with m.If(next_header_sum != 0xFFFF):
+                            m.d.comb += self.checksum_err.eq(1)
+                            m.next = "IDLE"
+                        with m.Else():
+                            m.d.sync += udp_first.eq(1)
+                            m.next = "UDP_HEADER"
+            with m.State("UDP_HEADER"):
+                m.d.comb += udp_header.valid.eq(we)
                 with m.If(we):
-                    with m.If(sink.data == self._port[:8]):
-                        m.next = "UDP_HEADER_BYTE4"
-                    with m.Else():
-                        m.d.sync += input_active.eq(0)
+                    m.d.sync += udp_first.eq(0)
+                with m.If(udp_header.done):
+                    with m.If((udp_length <= 8) | (udp_length > self._mtu - 20)):
+                        # a payload that would never fill or never fit the packet buffer, skip to the next SOP
+                        m.d.comb += self.length_err.eq(1)
                         m.next = "IDLE"
-            with m.State("UDP_HEADER_BYTE4"):
-                with m.If(we):
-                    with m.If(sink.data == (counter - 20)[8:]):
-                        m.next = "UDP_HEADER_BYTE5"
                     with m.Else():
-                        # length mismatch between IP and UDP headers - fragmented?
-                        m.d.sync += input_active.eq(0)
-                        m.next = "IDLE"
-            with m.State("UDP_HEADER_BYTE5"):
-                with m.If(we):
-                    with m.If(sink.data == (counter - 20)[:8]):
-                        m.next = "UDP_HEADER_BYTE6"
-                    with m.Else():
-                        m.d.sync += input_active.eq(0)
-                        m.next = "IDLE"
-            with m.State("UDP_HEADER_BYTE6"):
-                with m.If(we):
-                    # TODO validate checksum
-                    m.next = "UDP_HEADER_BYTE7"
-            with m.State("UDP_HEADER_BYTE7"):
-                with m.If(we):
-                    # TODO validate checksum
-                    m.d.sync += input_counter.eq(counter - 28)
-                    m.d.sync += counter.eq(counter - 20)
-                    m.next = "PAYLOAD"
+                        m.d.sync += counter.eq(udp_length)
+                        m.d.sync += payload_first.eq(1)
+                        m.next = "PAYLOAD"
+                with m.If(udp_header.err):
+                    m.next = "IDLE"
             with m.State("PAYLOAD"):
+                m.d.comb += in_payload.eq(1)
+                m.d.comb += payload.valid.eq(sink.valid)
+                m.d.comb += payload.sop.eq(payload_first)
+                m.d.comb += payload.eop.eq(counter == 9)
+                if self._udp_checksum:
+                    with m.If((counter == 9) & ~udp_unchecked & (next_udp_sum != 0xFFFF)):
+                        # corrupted datagram, roll it back out of the buffer instead of queueing it
+                        m.d.comb += buffer.drop.eq(1)
+                        m.d.comb += self.udp_checksum_err.eq(we)
                 with m.If(we):
                     # TODO handle a too-early EOP correctly (or at all)
+                    m.d.sync += payload_first.eq(0)
                     m.d.sync += counter.eq(counter - 1)
-                    m.d.comb += fifo.w_en.eq(1)
                     with m.If(counter == 9):
-                        # latch counter and re-set
-                        m.d.comb += counter_fifo.w_en.eq(1)
-                        m.d.sync += input_active.eq(0)
                         m.next = "IDLE"
         
-        re = Signal()
-        m.d.comb += re.eq(source.valid & source.ready)
-        
-        m.d.comb += fifo.r_en.eq(0)
-        m.d.comb += counter_fifo.r_en.eq(0)
-        
-        output_counter = Signal(16)
-        
-        m.d.comb += source.data.eq(fifo.r_data)
-        m.d.comb += source.valid.eq(counter_fifo.r_rdy)
-        m.d.comb += source.sop.eq(0)
-        m.d.comb += source.eop.eq(0)
-        
-        # output FSM
-        with m.FSM(name='output_fsm') as fsm:
-            with m.State("IDLE"):
-                with m.If(re):
-                    m.d.comb += source.sop.eq(1)
-                    m.d.sync += output_counter.eq(counter_fifo.r_data - 1)
-                    m.d.comb += fifo.r_en.eq(1)
-                    m.next = "PAYLOAD"
-            with m.State("PAYLOAD"):
-                with m.If(re):
-                    m.d.sync += output_counter.eq(output_counter - 1)
-                    m.d.comb += fifo.r_en.eq(1)
-                    with m.If(output_counter == 1):
-                        m.d.comb += source.eop.eq(1)
-                        m.d.comb += counter_fifo.r_en.eq(1)
-                        m.next = "IDLE"
+        m.d.comb += idle.eq(fsm.ongoing("IDLE"))
+        with m.If(ip_header.active | (we & fsm.ongoing("OPTIONS"))):
+            m.d.sync += header_sum.eq(Mux(ip_header.offset == 0, word, next_header_sum))
+        # the UDP sum takes the IP total length and source IP, then everything from the UDP header on
+        in_udp = Signal()
+        m.d.comb += in_udp.eq((ip_header.active & Cat(ip_header.offset == n for n in [2, 3, 12, 13, 14, 15]).any()) |
+                udp_header.active | (we & fsm.ongoing("PAYLOAD")))
+        with m.If(ip_header.active & (ip_header.offset == 0)):
+            m.d.sync += udp_sum.eq(self._partial_udp_checksum(sink.data[:4]))
+        with m.Elif(in_udp):
+            m.d.sync += udp_sum.eq(next_udp_sum)
+        
+        # output side - complete payloads come out of the packet buffer, or the payload is passed straight through
+        if self._cut_through:
+            output = payload
+        else:
+            output = buffer.source
+        m.d.comb += [
+                source.data.eq(output.data),
+                source.valid.eq(output.valid),
+                source.sop.eq(output.sop),
+                source.eop.eq(output.eop),
+                output.ready.eq(source.ready),
+                ]
                 
         return m
     
@@ -288,10 +277,11 @@ class UDPPacketizer(Elaboratable):
     TODO formal docstring
     Input: stream with framing
     Output: stream with framing
-    Parameter: MTU (FIFO depth), # in flight at once, source IP, dest IP, source port, dest port
+    Parameter: MTU (FIFO depth), # in flight at once, source IP, dest IP, source port, dest port, cut-through
+    Control signals: length (cut-through only)
     """
     def __init__(self, input: StreamSource, source_ip: ipaddress.IPv4Address, dest_ip: ipaddress.IPv4Address, 
-            source_port: int, dest_port: int, mtu: int = 1500, in_flight: int = 2):
+            source_port: int, dest_port: int, mtu: int = 1500, in_flight: int = 2, cut_through: bool = False):
         assert mtu >= 68
         assert mtu < 65535
         assert source_port <= 65535
@@ -314,31 +304,44 @@ class UDPPacketizer(Elaboratable):
         self._source_port = C(source_port, 16)
         self._dest_port = C(dest_port, 16)
         
-        
-        
-    def _partial_ip_checksum(self):
-        full_sum = Cat(ECN, DSCP, IHL, IP_VERSION) + \
-            ID + \
-            Cat(FO, FLAGS) +  \
-            Cat(self._proto, TTL) +  \
-            self._source_ip[16:] +  \
-            self._source_ip[:16] + \
-            self._dest_ip[16:] + \
-            self._dest_ip[:16]
-        
-        full_sum = full_sum[:16] + full_sum[16:]
-        return (full_sum[:16] + full_sum[16:])[:16]
+        # With cut_through, the payload length comes in on `length` alongside the first payload byte and the UDP
+        # checksum is sent as 0 (no checksum, allowed over IPv4). The headers go out straight away and the payload
+        # streams through without being buffered.
+        self._cut_through = cut_through
+        self.length = Signal(16)
+        
+    def _header(self, length, ip_checksum, udp_checksum):
+        # IPv4 and UDP headers, see HeaderInserter
+        return [
+                ("version", 0, 4, IP_VERSION),
+                ("ihl", 4, 4, IHL),
+                ("dscp", 8, 6, DSCP),
+                ("ecn", 14, 2, ECN),
+                ("total_length", 16, 16, (length + 28)[:16]),
+                ("id", 32, 16, ID),
+                ("flags", 48, 3, FLAGS),
+                ("fo", 51, 13, FO),
+                ("ttl", 64, 8, TTL),
+                ("protocol", 72, 8, self._proto),
+                ("checksum", 80, 16, ~ip_checksum),
+                ("source", 96, 32, self._source_ip),
+                ("dest", 128, 32, self._dest_ip),
+                ("source_port", 160, 16, self._source_port),
+                ("dest_port", 176, 16, self._dest_port),
+                ("length", 192, 16, (length + 8)[:16]),
+                ("udp_checksum", 208, 16, udp_checksum),
+            ]
+        
+    def _partial_ip_checksum(self, header):
+        return C(header_checksum(header, 0, 20), 16)
             
-    def _partial_udp_checksum(self):
-        full_sum = self._source_ip[16:] + \
-            self._source_ip[:16] + \
-            self._dest_ip[16:] + \
-            self._dest_ip[:16] + \
-            Cat(C(0, 8), self._proto) + \
-            self._source_port + \
-            self._dest_port
-        
-        full_sum = full_sum[:16] + full_sum[16:]
+    def _partial_udp_checksum(self, header):
+        pseudo_header = [
+                ("source", 0, 32, self._source_ip),
+                ("dest", 32, 32, self._dest_ip),
+                ("protocol", 72, 8, self._proto),
+            ]
+        full_sum = C(header_checksum(pseudo_header), 16) + C(header_checksum(header, 20, 28), 16)
         return (full_sum[:16] + full_sum[16:])[:16]
             
 
@@ -347,285 +350,137 @@ class UDPPacketizer(Elaboratable):
         source = self.source
         
         m = Module()
-        # TODO figure out a _useful_ stream abstraction that can handle this use case
-        m.submodules.fifo = fifo = SyncFIFOBuffered(width=8, depth=self._mtu)
         
         # input side
         m.d.comb += self.sink.connect(self._input)
         
-        counter = Signal(16)
-        active = Signal()
-        
-        m.submodules.counter_fifo = counter_fifo = SyncFIFOBuffered(width=16, depth=self._in_flight)
-        m.submodules.checksum_fifo = checksum_fifo = SyncFIFOBuffered(width=16, depth=self._in_flight)
-        
-        # gotta stall if _either_ FIFO is full, means sink can't be exactly fifo's sink
-        m.d.comb += sink.ready.eq(fifo.w_rdy & counter_fifo.w_rdy)
-        
-        we = Signal()
-        m.d.comb += we.eq(sink.valid & sink.ready)
-
         udp_checksum = Signal(16)
         
-        m.d.comb += fifo.w_data.eq(self.sink.data)
-        m.d.comb += fifo.w_en.eq(we)
-        
-        with m.If(we):
-            with m.If(self._input.sop):
-                m.d.sync += counter.eq(1)
-                m.d.sync += udp_checksum.eq(self._partial_udp_checksum() + sink.data)
-                m.d.sync += active.eq(1)
+        # headers go out of a template, with the lengths and checksums patched in from these
+        pkt_len = Signal(16)
+        ip_checksum = Signal(16)
+        if self._cut_through:
+            header_fields = self._header(pkt_len, ip_checksum, 0)
+        else:
+            header_fields = self._header(pkt_len, ip_checksum, ~udp_checksum)
+        
+        if self._cut_through:
+            # the first payload byte waits on the sink while the headers go out
+            pending = sink.valid & sink.sop
+            length = self.length
+            output = sink
+        else:
+            # payloads wait in a packet buffer, whose descriptors carry the length the headers need
+            payload = StreamSource(Layout([("data", 8, DIR_FANOUT)]), sop=True, eop=True, name="payload")
+            m.submodules.buffer = buffer = PacketBuffer(payload, depth=self._mtu - 28, in_flight=self._in_flight)
+            pending = buffer.pending
+            length = buffer.length
+            output = buffer.source
+            
+            active = Signal()
+            
+            m.submodules.checksum_fifo = checksum_fifo = SyncFIFOBuffered(width=16, depth=self._in_flight)
             
-            with m.If(active):
-                m.d.sync += udp_checksum.eq(udp_checksum + sink.data)
-                m.d.sync += counter.eq(counter + 1)
+            # gotta stall if _either_ the buffer or the checksum FIFO is full
+            m.d.comb += sink.ready.eq(payload.ready & checksum_fifo.w_rdy)
             
-            with m.If(self._input.eop):
-                # write counter + 1 and checksum to FIFOs, become inactive
-                m.d.comb += counter_fifo.w_data.eq(counter + 1)
-                m.d.comb += counter_fifo.w_en.eq(1)
-                m.d.comb += checksum_fifo.w_data.eq(udp_checksum + sink.data)
-                m.d.comb += checksum_fifo.w_en.eq(1)
-                m.d.sync += active.eq(0)
-            with m.Else():
-                m.d.comb += counter_fifo.w_en.eq(0)
-                m.d.comb += checksum_fifo.w_en.eq(0)
+            we = Signal()
+            m.d.comb += we.eq(sink.valid & sink.ready)
+            
+            m.d.comb += [
+                    payload.data.eq(sink.data),
+                    payload.sop.eq(sink.sop),
+                    payload.eop.eq(sink.eop),
+                    payload.valid.eq(sink.valid & checksum_fifo.w_rdy),
+                    ]
+            
+            with m.If(we):
+                with m.If(self._input.sop):
+                    m.d.sync += udp_checksum.eq(self._partial_udp_checksum(header_fields) + sink.data)
+                    m.d.sync += active.eq(1)
+                
+                with m.If(active):
+                    m.d.sync += udp_checksum.eq(udp_checksum + sink.data)
+                
+                with m.If(self._input.eop):
+                    # write checksum to FIFO, become inactive
+                    m.d.comb += checksum_fifo.w_data.eq(udp_checksum + sink.data)
+                    m.d.comb += checksum_fifo.w_en.eq(1)
+                    m.d.sync += active.eq(0)
+                with m.Else():
+                    m.d.comb += checksum_fifo.w_en.eq(0)
         
         
         # output side
         output_active = Signal()
-        m.d.comb += source.valid.eq(counter_fifo.r_rdy | output_active)
+        m.d.comb += source.valid.eq(pending | output_active)
         
         re = Signal()
         m.d.comb += re.eq(source.valid & source.ready)
                     
-        header_idx = Signal(range(4), reset=0)
-        pkt_len = Signal(16)
-        ip_checksum = Signal(16)
         udp_checksum_out = Signal(16)
         
+        m.submodules.header = header = HeaderInserter(header_fields, length=28)
+        
         # normally don't advance these (ticked below in FSM)
-        m.d.comb += fifo.r_en.eq(0)
-        m.d.sync += counter_fifo.r_en.eq(0)
-        m.d.sync += checksum_fifo.r_en.eq(0)
+        if not self._cut_through:
+            m.d.sync += checksum_fifo.r_en.eq(0)
         
         # output FSM
         with m.FSM() as fsm:
-            with m.State("INIT"):
-                # send first header byte
-                m.d.comb += source.data.eq(Cat(IHL, IP_VERSION))
-                
-                with m.If(re):
-                    # set SOP
-                    m.d.comb += self.source.sop.eq(1)
-                    
-                    # mark output active
-                    m.d.sync += output_active.eq(1)
-                    
-                    # latch out counter value
-                    m.d.sync += counter_fifo.r_en.eq(1)
-                    m.d.sync += pkt_len.eq(counter_fifo.r_data)
-                    
-                    # advance checksum FIFO
-                    m.d.sync += checksum_fifo.r_en.eq(1)
-                    
-                    # calculate full checksums from counter value
-                    checksum_intermediate = self._partial_ip_checksum() + counter_fifo.r_data + 28
-                    checksum_intermediate = checksum_intermediate[:16] + checksum_intermediate[16:]
-                    checksum_intermediate = checksum_intermediate[:16] + checksum_intermediate[16:]
-                    m.d.sync += ip_checksum.eq(checksum_intermediate[:16])
-                    
-                    checksum_intermediate = checksum_fifo.r_data + counter_fifo.r_data + 8
-                    checksum_intermediate = checksum_intermediate[:16] + checksum_intermediate[16:]
-                    checksum_intermediate = checksum_intermediate[:16] + checksum_intermediate[16:]
-                    m.d.sync += udp_checksum_out.eq(checksum_intermediate[:16])
-                    
-                    # advance state
-                    m.next = "IP_HEADER_BYTE2"
-                
-            with m.State("IP_HEADER_BYTE2"):
-                # send second header byte
-                m.d.comb += source.data.eq(Cat(ECN, DSCP))
-                
-                with m.If(re):
-                    # set index for Length
-                    m.d.sync += header_idx.eq(1)
-                    # advance state
-                    m.next = "IP_LENGTH"
-                
-            with m.State("IP_LENGTH"):
-                # send current length byte
-                m.d.comb += source.data.eq((pkt_len+28).word_select(header_idx, 8))
-                
-                with m.If(re):
-                    # decrement index
-                    m.d.sync += header_idx.eq(header_idx - 1)
-                    with m.If(header_idx == 0):
-                        # set index for ID
-                        m.d.sync += header_idx.eq(1)
-                    
-                        # advance state
-                        m.next = "ID"
-                
-            with m.State("ID"):
-                # send current id byte
-                m.d.comb += source.data.eq(ID.word_select(header_idx, 8))
-                
-                with m.If(re):
-                    # decrement index
-                    m.d.sync += header_idx.eq(header_idx - 1)
-                    with m.If(header_idx == 0):
-                        # advance state
-                        m.next = "FLAGS"
-
-            with m.State("FLAGS"):
-                # send flags
-                m.d.comb += source.data.eq(Cat(FO[8:], FLAGS))
+            with m.State("HEADER"):
+                # send current header byte
+                m.d.comb += source.data.eq(header.data)
                 
                 with m.If(re):
-                    # advance state
-                    m.next = "FO"
-                
-            with m.State("FO"):
-                # send fragment offset low bits
-                m.d.comb += source.data.eq(FO[:8])
-                
-                with m.If(re):
-                    # advance state
-                    m.next = "TTL"
-                
-            with m.State("TTL"):
-                # send time-to-live
-                m.d.comb += source.data.eq(TTL)
-                
-                with m.If(re):
-                    # advance state
-                    m.next = "PROTOCOL"
-                
-            with m.State("PROTOCOL"):
-                # send protocol number
-                m.d.comb += source.data.eq(self._proto)
-                
-                with m.If(re):
-                    # set index for checksum
-                    m.d.sync += header_idx.eq(1)
+                    m.d.comb += header.advance.eq(1)
                     
-                    # advance state
-                    m.next = "IP_CHECKSUM"
-                
-            with m.State("IP_CHECKSUM"):
-                # send current checksum byte
-                m.d.comb += source.data.eq(~ip_checksum.word_select(header_idx, 8))
-                
-                with m.If(re):
-                    # decrement index
-                    m.d.sync += header_idx.eq(header_idx - 1)
-                    with m.If(header_idx == 0):
-                        # set index for source address
-                        m.d.sync += header_idx.eq(3)
-                    
-                        # advance state
-                        m.next = "ADDR_SOURCE"
-                
-            with m.State("ADDR_SOURCE"):
-                # send current source address byte
-                m.d.comb += source.data.eq(self._source_ip.word_select(header_idx, 8))
-                
-                with m.If(re):
-                    # decrement index
-                    m.d.sync += header_idx.eq(header_idx - 1)
-                    with m.If(header_idx == 0):
-                        # set index for dest address
-                        m.d.sync += header_idx.eq(3)
-                    
-                        # advance state
-                        m.next = "ADDR_DEST"
+                    with m.If(header.first):
+                        # set SOP
+                        m.d.comb += self.source.sop.eq(1)
                         
-            with m.State("ADDR_DEST"):
-                # send current destination address byte
-                m.d.comb += source.data.eq(self._dest_ip.word_select(header_idx, 8))
-                
-                with m.If(re):
-                    # decrement index
-                    m.d.sync += header_idx.eq(header_idx - 1)
-                    with m.If(header_idx == 0):
-                        # set index for source port
-                        m.d.sync += header_idx.eq(1)
+                        # mark output active
+                        m.d.sync += output_active.eq(1)
                         
-                        # advance state
-                        m.next = "PORT_SOURCE"
-            
-            with m.State("PORT_SOURCE"):
-                # send current source port byte
-                m.d.comb += source.data.eq(self._source_port.word_select(header_idx, 8))
-                
-                with m.If(re):
-                    # decrement index
-                    m.d.sync += header_idx.eq(header_idx - 1)
-                    with m.If(header_idx == 0):
-                        # set index for dest port
-                        m.d.sync += header_idx.eq(1)
+                        # latch out packet length
+                        m.d.sync += pkt_len.eq(length)
                         
-                        # advance state
-                        m.next = "PORT_DEST"
-            
-            with m.State("PORT_DEST"):
-                # send current dest port byte
-                m.d.comb += source.data.eq(self._dest_port.word_select(header_idx, 8))
-                
-                with m.If(re):
-                    # decrement index
-                    m.d.sync += header_idx.eq(header_idx - 1)
-                    with m.If(header_idx == 0):
-                        # set index for UDP length
-                        m.d.sync += header_idx.eq(1)
+                        # calculate full checksums from packet length
+                        checksum_intermediate = self._partial_ip_checksum(header_fields) + length + 28
+                        checksum_intermediate = checksum_intermediate[:16] + checksum_intermediate[16:]
+                        checksum_intermediate = checksum_intermediate[:16] + checksum_intermediate[16:]
+                        m.d.sync += ip_checksum.eq(checksum_intermediate[:16])
                         
-                        # advance state
-                        m.next = "UDP_LENGTH"
-            
-            with m.State("UDP_LENGTH"):
-                # send current length byte
-                m.d.comb += source.data.eq((pkt_len + 8).word_select(header_idx, 8))
-                
-                with m.If(re):
-                    # decrement index
-                    m.d.sync += header_idx.eq(header_idx - 1)
-                    with m.If(header_idx == 0):
-                        # set index for UDP checksum
-                        m.d.sync += header_idx.eq(1)
+                        if not self._cut_through:
+                            # advance checksum FIFO
+                            m.d.sync += checksum_fifo.r_en.eq(1)
+                            
+                            checksum_intermediate = checksum_fifo.r_data + length + 8
+                            checksum_intermediate = checksum_intermediate[:16] + checksum_intermediate[16:]
+                            checksum_intermediate = checksum_intermediate[:16] + checksum_intermediate[16:]
+                            m.d.sync += udp_checksum_out.eq(checksum_intermediate[:16])
                     
-                        # advance state
-                        m.next = "UDP_CHECKSUM"
-                        
-            with m.State("UDP_CHECKSUM"):
-                # send current checksum byte
-                m.d.comb += source.data.eq(~udp_checksum.word_select(header_idx, 8))
-                
-                with m.If(re):
-                    # decrement index
-                    m.d.sync += header_idx.eq(header_idx - 1)
-                    with m.If(header_idx == 0):
+                    with m.If(header.last):
                         # advance state
                         m.next = "PAYLOAD"
                 
             with m.State("PAYLOAD"):
                 # send current payload byte
-                m.d.comb += source.data.eq(fifo.r_data)
+                m.d.comb += source.data.eq(output.data)
+                m.d.comb += source.valid.eq(output.valid)
+                m.d.comb += output.ready.eq(source.ready)
                 
                 with m.If(re):
-                    # advance FIFO
-                    m.d.comb += fifo.r_en.eq(1)
-                    
                     # decrement length
                     m.d.sync += pkt_len.eq(pkt_len - 1)
                     
-                    with m.If(pkt_len - 1 == 0):
+                    with m.If(output.eop):
                         # set EOP
                         m.d.comb += self.source.eop.eq(1)
                         # mark output inactive
                         m.d.sync += output_active.eq(0)
                         # packet complete
-                        m.next = "INIT"
+                        m.next = "HEADER"
                     
         return m
 
@@ -1,17 +1,18 @@
 
 from .udp import *
 from .stream import *
+from .header import *
 from nmigen_soc.wishbone.bus import *
 
 import math
 
-def eb_write(addr, datas):
+def eb_write(addr, datas, cyc=True, byteen=0xFF):
     import struct
     
     magic = struct.pack("!H", 0x4E6F)
     flags = struct.pack("!H", 0x1444) # no reads, 32-bit address, 32-bit data
     # 32-bit alignment yo
-    moreflags = struct.pack("!H", 0x08FF) # CYC (end of cycle), use all byte enable bits
+    moreflags = struct.pack("!H", (0x0800 if cyc else 0x0000) | byteen) # CYC (end of cycle), byte enable bits
     counts = struct.pack("!H", len(datas) << 8) # len writes zero reads
     # 32-bit alignment yo
     addr = struct.pack("!L", addr)
@@ -22,13 +23,13 @@ def eb_write(addr, datas):
         
     return result
 
-def eb_read(addrs):
+def eb_read(addrs, cyc=True):
     import struct
     
     magic = struct.pack("!H", 0x4E6F)
     flags = struct.pack("!H", 0x1044) # 32-bit address, 32-bit data
     # 32-bit alignment yo
-    moreflags = struct.pack("!H", 0x08FF) # CYC (end of cycle), use all byte enable bits
+    moreflags = struct.pack("!H", (0x08FF if cyc else 0x00FF)) # CYC (end of cycle), use all byte enable bits
     counts = struct.pack("!H", len(addrs)) # one read zero writes
     # 32-bit alignment yo
     ret_addr = struct.pack("!L", 0xDEADBEEF) # we're not gonna use this
@@ -40,14 +41,39 @@ def eb_read(addrs):
     return result
 
 class UDPTherbone(Elaboratable):
-    def __init__(self, mtu=1500, addr_width=32, data_width=32, granularity=8, features=["stall"]):
+    def __init__(self, mtu=1500, addr_width=32, data_width=32, granularity=8, features=["stall"], 
+            max_outstanding_reads=None, max_outstanding_writes=16, bursts=False, hold_cyc=False, cut_through=False):
+        # max_outstanding_reads/max_outstanding_writes bound the accesses in flight in pipelined ("stall") mode.
+        # Classic mode has one access in flight, so max_outstanding_reads defaults to and must be 1 there
+        # and max_outstanding_writes is ignored.
+        if max_outstanding_reads is None:
+            max_outstanding_reads = 4 if "stall" in features else 1
+        assert max_outstanding_reads >= 1
+        assert max_outstanding_reads == 1 or "stall" in features
+        assert max_outstanding_writes >= 1
+        # registered feedback bursts are a classic cycle feature
+        assert not (bursts and "stall" in features)
+        
+        if bursts:
+            features = list(features) + [x for x in ["cti", "bte"] if x not in features]
+        
         self.interface = Interface(addr_width=addr_width, data_width=data_width, granularity=granularity, features=features)
         self._mtu = mtu
+        self._max_outstanding_reads = max_outstanding_reads
+        self._max_outstanding_writes = max_outstanding_writes
+        self._bursts = bursts
+        # with hold_cyc, CYC stays asserted for a whole record and only drops after a record with the CYC flag set
+        self._hold_cyc = hold_cyc
+        # with cut_through, request words reach the bus logic without the capture FIFO's output register
+        self._cut_through = cut_through
         self._features = features
         self._addr_width = addr_width
         self._data_width = data_width
+        self._granularity = granularity
         self.sink = StreamSink(Layout([("data", 8, DIR_FANIN)]), sop=True, eop=True)
         self.source = StreamSource(Layout([("data", 8, DIR_FANOUT)]), sop=True, eop=True)
+        # length in bytes of the response on source, valid with sop (for a cut-through UDPPacketizer)
+        self.length = Signal(16)
     
     def elaborate(self, platform):
         m = Module()
@@ -63,78 +89,68 @@ class UDPTherbone(Elaboratable):
         # STEP 1: Capture the packet input
         # Write data into the memory from SOP to EOP
         alignment = max(16, self._data_width, self._addr_width)
+        # every word in a packet takes at least alignment // 8 bytes, so an mtu-byte packet fits in this many words
+        words = math.ceil(self._mtu / (alignment // 8))
         nr = Signal()
         rf = Signal()
         wf = Signal()
+        cf = Signal()
+        byteen = Signal(8)
         wcount = Signal(8)
         rcount = Signal(8)
         tcount = Signal(9)
         val = Signal(alignment)
         pad_count = Signal(range(4))
+        if self._cut_through:
+            # each word is written in the cycle its last byte arrives and falls straight through to STEP 2, through
+            # the bypass register when the FIFO is empty so the memory can stay in block RAM
+            fifo_type = SyncFIFOBypass
+            capture = m.d.comb
+        else:
+            fifo_type = SyncFIFOBuffered
+            capture = m.d.sync
         if alignment == 16:
-            m.submodules.fifo = fifo = SyncFIFOBuffered(width=alignment+2, depth=self._mtu)
+            m.submodules.fifo = fifo = fifo_type(width=alignment+11, depth=words)
         else:
-            m.submodules.fifo = fifo = SyncFIFOBuffered(width=alignment, depth=self._mtu)
-            print(fifo.r_data.shape())
+            m.submodules.fifo = fifo = fifo_type(width=alignment, depth=words)
         m.d.comb += sink.ready.eq(fifo.w_rdy)
-        m.d.sync += fifo.w_en.eq(0)
+        if not self._cut_through:
+            m.d.sync += fifo.w_en.eq(0)
+        # Etherbone header, padded to 8 bytes with 64 bit alignment
+        # TODO handle PF and PR - for now, assumed 0
+        m.submodules.eb_header = eb_header = HeaderParser([
+                ("magic", 0, 16, FieldAction.MATCH, 0x4E6F),
+                ("version", 16, 4, FieldAction.MATCH, 1),
+                ("nr", 21, 1, FieldAction.CAPTURE, None),
+                ("addr_size", 24, 4, FieldAction.MATCH, self._addr_width // 8),
+                ("port_size", 28, 4, FieldAction.MATCH, self._data_width // 8),
+            ], length=8 if alignment == 64 else 4)
+        m.d.comb += [
+                eb_header.data.eq(sink.data),
+                eb_header.start.eq(sink.sop),
+                nr.eq(eb_header.fields["nr"]),
+            ]
         with m.FSM(name="capture"):
             with m.State("IDLE"):
-                # wait for sop
-                with m.If(sink_we & sink.sop):
-                    # TODO handle if eop is also set
-                    # TODO error on invalid magic value (error generally)
-                    with m.If(sink.data == 0x4E):
-                        m.next = "MAGIC1"
-            with m.State("MAGIC1"):
-                # TODO handle eop
-                with m.If(sink_we):
-                    with m.If(sink.data == 0x6F):
-                        m.next = "VERSION"
-                    with m.Else():
-                        # TODO handle error
-                        m.next = "IDLE"
-            with m.State("VERSION"):
-                # TODO handle eop
-                with m.If(sink_we):
-                    with m.If(sink.data[4:] == 1):
-                        # TODO handle PF - for now, assumed 0
-                        # TODO handle PR - for now, assumed 0
-                        # capture nr
-                        m.d.sync += nr.eq(sink.data[2])
-                        m.next = "SIZES"
-                    with m.Else():
-                        # TODO handle error
-                        m.next = "IDLE"
-            with m.State("SIZES"):
-                # TODO handle eop
-                with m.If(sink_we):
-                    with m.If((sink.data[4:] == self._addr_width // 8) & (sink.data[:4] == self._data_width // 8)):
-                        if alignment == 64:
-                            m.d.sync += pad_count.eq(3)
-                            m.next = "PADDING"
-                        else:
-                            m.next = "FLAGS"
-                    with m.Else():
-                        # TODO handle error
-                        m.next = "IDLE"
-            with m.State("PADDING"):
-                # TODO handle eop
-                with m.If(sink_we):
-                    m.d.sync += pad_count.eq(pad_count - 1)
-                    with m.If(pad_count == 0):
-                        m.next = "FLAGS"
+                # wait for sop and a good header
+                # TODO handle if eop is also set
+                # TODO error on invalid header (error generally)
+                m.d.comb += eb_header.valid.eq(sink_we)
+                with m.If(eb_header.done):
+                    m.next = "FLAGS"
             with m.State("FLAGS"):
                 # TODO handle eop
-                # Assume CYC set, BCA RCA and WCA unset. Capture others
+                # Assume BCA RCA and WCA unset. Capture others
                 with m.If(sink_we):
                     m.d.sync += rf.eq(sink.data[5])
+                    m.d.sync += cf.eq(sink.data[3])
                     m.d.sync += wf.eq(sink.data[1])
                     m.next = "BYTEEN"
             with m.State("BYTEEN"):
                 # TODO handle eop
-                # TODO figure out what this does and... deal with it somehow i guess
+                # one bit per byte lane, applied to the record's writes
                 with m.If(sink_we):
+                    m.d.sync += byteen.eq(sink.data)
                     m.next = "WCOUNT"
             with m.State("WCOUNT"):
                 # TODO handle eop
@@ -149,8 +165,8 @@ class UDPTherbone(Elaboratable):
                         m.d.sync += pad_count.eq(3)
                         m.next = "PADDING2"
                     else:
-                        m.d.sync += fifo.w_data.eq(Cat((sink.data), wcount, Repl(0, alignment - 16)))
-                        m.d.sync += fifo.w_en.eq(1)
+                        capture += fifo.w_data.eq(Cat((sink.data), wcount, rf, wf, cf, byteen, Repl(0, max(0, alignment - 27))))
+                        capture += fifo.w_en.eq(1)
                         #m.d.sync += tcount.eq(wcount + rcount)
                         m.d.sync += tcount.eq(wcount + (sink.data) + (wcount > 0) + ((sink.data) > 0))
                         m.d.sync += pad_count.eq((alignment//8)-1)
@@ -163,11 +179,8 @@ class UDPTherbone(Elaboratable):
                 with m.If(sink_we):
                     m.d.sync += pad_count.eq(pad_count - 1)
                     with m.If(pad_count == 0):
-                        if alignment == 16:
-                            m.d.sync += fifo.w_data.eq(Cat(rcount, wcount, rf))
-                        else:
-                            m.d.sync += fifo.w_data.eq(Cat(rcount, wcount, rf, wf, Repl(0, alignment - 18)))
-                        m.d.sync += fifo.w_en.eq(1)
+                        capture += fifo.w_data.eq(Cat(rcount, wcount, rf, wf, cf, byteen, Repl(0, alignment - 27)))
+                        capture += fifo.w_en.eq(1)
                         m.d.sync += tcount.eq(wcount + rcount + (wcount > 0) + (rcount > 0))
                         m.d.sync += pad_count.eq((alignment//8)-1)
                         with m.If(wcount + rcount > 0):
@@ -180,8 +193,8 @@ class UDPTherbone(Elaboratable):
                     m.d.sync += val.word_select(pad_count, 8).eq(sink.data)
                     m.d.sync += pad_count.eq(pad_count - 1)
                     with m.If(pad_count == 0):
-                        m.d.sync += fifo.w_data.eq(Cat(sink.data, val[8:]))
-                        m.d.sync += fifo.w_en.eq(1)
+                        capture += fifo.w_data.eq(Cat(sink.data, val[8:]))
+                        capture += fifo.w_en.eq(1)
                         m.d.sync += tcount.eq(tcount - 1)
                         m.d.sync += pad_count.eq((alignment//8)-1)
                         with m.If(tcount - 1 == 0):
@@ -200,19 +213,58 @@ class UDPTherbone(Elaboratable):
         value = Signal(self._data_width)
         write_start = Signal()
         read_start = Signal()
-        m.submodules.output_fifo = output_fifo = SyncFIFO(width=alignment, depth=self._mtu)
+        # cycle type for the staged access, only used with bursts
+        write_cti = Signal(3)
+        read_cti = Signal(3)
+        write_in_burst = Signal()
+        read_in_burst = Signal()
+        read_held = Signal(self._addr_width)
+        read_held_valid = Signal()
+        # CYC flag of the current record, and whether the staged access is the last one of a record that ends the
+        # cycle - only used with hold_cyc
+        record_cyc = Signal()
+        write_end = Signal()
+        read_end = Signal()
+        # an empty record with CYC set, which ends a held cycle on its own
+        cycle_end = Signal()
+        # byte lanes of the current record, and of the staged write
+        record_sel = Signal(len(interface.sel))
+        write_sel = Signal(len(interface.sel))
+        # driven by STEP 3 when it takes the pending access, so a new one can be staged in the same cycle
+        write_taken = Signal()
+        read_taken = Signal()
+        # driven by STEP 3 while a read response may still be written into output_fifo
+        read_busy = Signal()
+        with m.If(write_taken):
+            m.d.sync += write_start.eq(0)
+        with m.If(read_taken):
+            m.d.sync += read_start.eq(0)
+        m.submodules.output_fifo = output_fifo = SyncFIFOBuffered(width=alignment, depth=words)
         m.d.sync += output_fifo.w_en.eq(0) # unless overridden
+        # room in output_fifo for the response to the record at the head of fifo - header, address and values
+        output_room = Signal()
+        m.d.comb += output_room.eq((fifo.r_data[:8] == 0) | (output_fifo.level + fifo.r_data[:8] + 2 <= words))
         with m.FSM(name="extract"):
             with m.State("IDLE"):
-                # wait for data
-                with m.If(fifo.r_rdy):
+                # wait for data, and for earlier reads to land so responses don't interleave
+                # a record with reads also waits for room for its whole response
+                # an empty record ending the cycle also waits for the last write to be taken, so that write
+                # can't set the hold again after it's been cleared
+                rcount_cur = fifo.r_data[:8]
+                wcount_cur = fifo.r_data[8:16]
+                empty_end = (rcount_cur == 0) & (wcount_cur == 0) & fifo.r_data[18]
+                with m.If(fifo.r_rdy & ~read_start & ~read_busy & output_room & ~(empty_end & write_start)):
                     m.d.comb += fifo.r_en.eq(1)
-                    rcount_cur = fifo.r_data[:8]
                     m.d.sync += read_count.eq(rcount_cur)
-                    wcount_cur = fifo.r_data[8:16]
                     m.d.sync += write_count.eq(wcount_cur)
                     m.d.sync += read_inc.eq(~fifo.r_data[16])
                     m.d.sync += write_inc.eq(~fifo.r_data[17])
+                    m.d.sync += record_cyc.eq(fifo.r_data[18])
+                    # a select line covers granularity // 8 byte lanes and is set if any of them is
+                    lanes = self._granularity // 8
+                    m.d.sync += record_sel.eq(Cat(fifo.r_data[19 + i*lanes:19 + (i+1)*lanes].any() 
+                            for i in range(len(interface.sel))))
+                    m.d.comb += cycle_end.eq(empty_end)
                     with m.If(rcount_cur > 0):
                         # we need RFF and RCount in the response section
                         m.d.sync += output_fifo.w_data.eq(Cat(rcount_cur, ~read_inc))
@@ -221,23 +273,36 @@ class UDPTherbone(Elaboratable):
                     with m.If(wcount_cur > 0):
                         m.next = "WADDR"
             with m.State("WADDR"):
-                with m.If(fifo.r_rdy):
+                # the previous record's last write may still be waiting on the address
+                with m.If(fifo.r_rdy & ~write_start):
                     m.d.comb += fifo.r_en.eq(1)
                     m.d.sync += address.eq(fifo.r_data[:self._addr_width])
                     m.next = "WVAL"
             with m.State("WVAL"):
-                with m.If(fifo.r_rdy & ~write_start):
+                with m.If(fifo.r_rdy & (~write_start | write_taken)):
                     m.d.comb += fifo.r_en.eq(1)
                     m.d.sync += value.eq(fifo.r_data)
                     m.d.sync += write_start.eq(1)
                     m.d.sync += write_count.eq(write_count - 1)
+                    m.d.sync += write_end.eq(record_cyc & (write_count - 1 == 0) & (read_count == 0))
+                    m.d.sync += write_sel.eq(record_sel)
+                    if self._bursts:
+                        # addresses are consecutive by construction when incrementing
+                        with m.If(write_inc & (write_count != 1)):
+                            m.d.sync += write_cti.eq(CycleType.INCR_BURST)
+                            m.d.sync += write_in_burst.eq(1)
+                        with m.Elif(write_in_burst):
+                            m.d.sync += write_cti.eq(CycleType.END_OF_BURST)
+                            m.d.sync += write_in_burst.eq(0)
+                        with m.Else():
+                            m.d.sync += write_cti.eq(CycleType.CLASSIC)
                     with m.If(write_count - 1 == 0):
                         with m.If(read_count > 0):
                             m.next = "RADDR"
                         with m.Else():
                             m.next = "IDLE"
             with m.State("RADDR"):
-                with m.If(fifo.r_rdy):
+                with m.If(fifo.r_rdy & ~write_start & ~read_start & ~read_busy):
                     m.d.comb += fifo.r_en.eq(1)
                     m.d.sync += address.eq(fifo.r_data[:self._addr_width])
                     # we need the read address in the response section
@@ -245,70 +310,258 @@ class UDPTherbone(Elaboratable):
                     m.d.sync += output_fifo.w_en.eq(1)
                     m.next = "RVAL"
             with m.State("RVAL"):
-                with m.If(fifo.r_rdy & ~read_start):
-                    m.d.comb += fifo.r_en.eq(1)
-                    m.d.sync += value.eq(fifo.r_data)
-                    m.d.sync += read_start.eq(1)
-                    m.d.sync += read_count.eq(read_count - 1)
-                    with m.If(read_count - 1 == 0):
+                if self._bursts:
+                    # Read addresses are explicit, so hold each one back until the next has been seen - only then
+                    # do we know whether it continues a burst.
+                    with m.If(fifo.r_rdy & (~read_start | read_taken | ~read_held_valid)):
+                        m.d.comb += fifo.r_en.eq(1)
+                        m.d.sync += read_held.eq(fifo.r_data)
+                        m.d.sync += read_held_valid.eq(1)
+                        m.d.sync += read_count.eq(read_count - 1)
+                        with m.If(read_held_valid):
+                            m.d.sync += value.eq(read_held)
+                            m.d.sync += read_start.eq(1)
+                            m.d.sync += read_end.eq(0)
+                            with m.If(fifo.r_data[:self._addr_width] == read_held + 1):
+                                m.d.sync += read_cti.eq(CycleType.INCR_BURST)
+                                m.d.sync += read_in_burst.eq(1)
+                            with m.Elif(read_in_burst):
+                                m.d.sync += read_cti.eq(CycleType.END_OF_BURST)
+                                m.d.sync += read_in_burst.eq(0)
+                            with m.Else():
+                                m.d.sync += read_cti.eq(CycleType.CLASSIC)
+                        with m.If(read_count - 1 == 0):
+                            m.next = "RLAST"
+                else:
+                    with m.If(fifo.r_rdy & (~read_start | read_taken)):
+                        m.d.comb += fifo.r_en.eq(1)
+                        m.d.sync += value.eq(fifo.r_data)
+                        m.d.sync += read_start.eq(1)
+                        m.d.sync += read_count.eq(read_count - 1)
+                        m.d.sync += read_end.eq(record_cyc & (read_count - 1 == 0))
+                        with m.If(read_count - 1 == 0):
+                            m.next = "IDLE"
+            if self._bursts:
+                with m.State("RLAST"):
+                    # flush the held read, ending the burst if it was part of one
+                    with m.If(~read_start | read_taken):
+                        m.d.sync += value.eq(read_held)
+                        m.d.sync += read_start.eq(1)
+                        m.d.sync += read_end.eq(record_cyc)
+                        m.d.sync += read_held_valid.eq(0)
+                        m.d.sync += read_in_burst.eq(0)
+                        with m.If(read_in_burst):
+                            m.d.sync += read_cti.eq(CycleType.END_OF_BURST)
+                        with m.Else():
+                            m.d.sync += read_cti.eq(CycleType.CLASSIC)
                         m.next = "IDLE"
                     
         # STEP 3: Do the Wishbone transactions
-        # This is very sub-optimal from a throughput perspective but honestly, who cares
         response = Signal(self._data_width)
-        print(address.shape())
-        print(interface.adr.shape())
-        with m.FSM(name="wishbone"):
-            with m.State("IDLE"):
+        if "err" in self._features:
+            bus_done = interface.ack | interface.err
+        else:
+            bus_done = interface.ack
+        # with hold_cyc, set while the last access taken doesn't end its record's cycle
+        cycle_hold = Signal()
+        if self._hold_cyc:
+            with m.If(write_taken):
+                m.d.sync += cycle_hold.eq(~write_end)
+            with m.If(read_taken):
+                m.d.sync += cycle_hold.eq(~read_end)
+            with m.If(cycle_end):
+                m.d.sync += cycle_hold.eq(0)
+        if "stall" in self._features:
+            # Pipelined mode: STB stays up across consecutive accesses and a new one is presented every
+            # cycle the slave doesn't stall. CYC is held until every ACK we're owed has come back.
+            # reads and writes are never in flight together, so the larger limit bounds the count
+            outstanding = Signal(range(max(self._max_outstanding_reads, self._max_outstanding_writes) + 1))
+            issued = Signal()
+            acked = Signal()
+            m.d.comb += issued.eq(interface.stb & ~interface.stall)
+            # the slave may ACK in the same cycle it takes the access
+            m.d.comb += acked.eq(bus_done & ((outstanding != 0) | issued))
+            with m.If(issued & ~acked):
+                m.d.sync += outstanding.eq(outstanding + 1)
+            with m.If(~issued & acked):
+                m.d.sync += outstanding.eq(outstanding - 1)
+            
+            # the bus registers are free if nothing is presented or the slave takes it this cycle
+            free = Signal()
+            m.d.comb += free.eq(~interface.stb | ~interface.stall)
+            # never mix directions in flight, so each ACK can be matched to its access without a tag
+            # (WE holds the direction of the last access until CYC drops)
+            drained = Signal()
+            m.d.comb += drained.eq((outstanding == 0) & ~interface.stb)
+            # a presented access is either taken this cycle or still counts against the limit
+            write_room = Signal()
+            m.d.comb += write_room.eq(outstanding + interface.stb < self._max_outstanding_writes)
+            
+            # Read responses land in a small ordering queue, one slot reserved per read at issue time.
+            # ACKs arrive in issue order so the queue drains into output_fifo in request order, and a
+            # slow response path can never make us drop read data.
+            m.submodules.read_queue = read_queue = SyncFIFO(width=self._data_width, depth=self._max_outstanding_reads)
+            read_credits = Signal(range(self._max_outstanding_reads + 1), reset=self._max_outstanding_reads)
+            with m.If(read_taken & ~read_queue.r_en):
+                m.d.sync += read_credits.eq(read_credits - 1)
+            with m.If(~read_taken & read_queue.r_en):
+                m.d.sync += read_credits.eq(read_credits + 1)
+            
+            # output_fifo is written a cycle after we look at it, so keep a word of slack
+            with m.If(read_queue.r_rdy & (output_fifo.level < words - 1)):
+                m.d.comb += read_queue.r_en.eq(1)
+                m.d.sync += output_fifo.w_data.eq(read_queue.r_data)
+                m.d.sync += output_fifo.w_en.eq(1)
+            
+            m.d.comb += read_busy.eq((~drained & ~interface.we) | read_queue.r_rdy)
+            
+            with m.If(free):
                 with m.If(write_start):
-                    m.d.sync += interface.dat_w.eq(value)
-                    m.d.sync += interface.adr.eq(address)
-                    m.d.sync += interface.we.eq(1)
-                    m.d.sync += interface.sel.eq(~0)
-                    m.d.sync += interface.cyc.eq(1)
-                    m.d.sync += interface.stb.eq(1)
-                    m.d.sync += write_start.eq(0)
-                    m.next = "WRITE"
-                with m.If(read_start):
-                    m.d.sync += interface.adr.eq(value)
-                    m.d.sync += interface.we.eq(0)
-                    m.d.sync += interface.sel.eq(~0)
-                    m.d.sync += interface.cyc.eq(1)
-                    m.d.sync += interface.stb.eq(1)
-                    m.d.sync += read_start.eq(0)
-                    m.next = "READ"
-            with m.State("WRITE"):
-                # single write
-                # if pipelined, drop strobe and write enable
-                if "stall" in self._features:
-                    m.d.sync += interface.stb.eq(0)
-                    m.d.sync += interface.we.eq(0)
-                with m.If(interface.ack | interface.err):
-                    # drop cyc, and also stb and we if not dropped earlier
-                    m.d.sync += interface.cyc.eq(0)
-                    m.d.sync += interface.stb.eq(0)
-                    m.d.sync += interface.we.eq(0)
-                    with m.If(write_inc):
-                        m.d.sync += address.eq(address + 1)
-                    m.next = "IDLE"
-            with m.State("READ"):
-                # TODO this is all basically wrong actually
-                # if pipelined, drop strobe
-                if "stall" in self._features:
-                    m.d.sync += interface.stb.eq(0)
-                with m.If(interface.ack | interface.err):
-                    # drop cyc, and also stb if not dropped earlier
-                    m.d.sync += interface.cyc.eq(0)
-                    m.d.sync += interface.stb.eq(0)
-                    # latch value into output FIFO
-                    with m.If(interface.ack):
-                        m.d.sync += output_fifo.w_data.eq(interface.dat_r)
+                    with m.If((drained | interface.we) & write_room):
+                        m.d.comb += write_taken.eq(1)
+                        m.d.sync += interface.dat_w.eq(value)
+                        m.d.sync += interface.adr.eq(address)
+                        m.d.sync += interface.we.eq(1)
+                        m.d.sync += interface.sel.eq(write_sel)
+                        m.d.sync += interface.cyc.eq(1)
+                        m.d.sync += interface.stb.eq(1)
+                        with m.If(write_inc):
+                            m.d.sync += address.eq(address + 1)
                     with m.Else():
-                        m.d.sync += output_fifo.w_data.eq(0xDEADDEAD)
-                    m.d.sync += output_fifo.w_en.eq(1)
-                    with m.If(read_inc):
-                        m.d.sync += address.eq(address + 1)
-                    m.next = "IDLE"
+                        m.d.sync += interface.stb.eq(0)
+                with m.Elif(read_start):
+                    with m.If((drained | ~interface.we) & (read_credits != 0)):
+                        m.d.comb += read_taken.eq(1)
+                        m.d.sync += interface.adr.eq(value)
+                        m.d.sync += interface.we.eq(0)
+                        m.d.sync += interface.sel.eq(~0)
+                        m.d.sync += interface.cyc.eq(1)
+                        m.d.sync += interface.stb.eq(1)
+                    with m.Else():
+                        m.d.sync += interface.stb.eq(0)
+                with m.Else():
+                    m.d.sync += interface.stb.eq(0)
+                    # nothing left to present - end the cycle once the last ACK is in, unless the record holds it
+                    with m.If(((outstanding - acked + issued) == 0) & ~cycle_hold):
+                        m.d.sync += interface.cyc.eq(0)
+                        m.d.sync += interface.we.eq(0)
+            
+            # fill the oldest reserved slot
+            with m.If(acked & ~interface.we):
+                with m.If(interface.ack):
+                    m.d.comb += read_queue.w_data.eq(interface.dat_r)
+                with m.Else():
+                    m.d.comb += read_queue.w_data.eq(0xDEADDEAD)
+                m.d.comb += read_queue.w_en.eq(1)
+        else:
+            # Classic mode: one access at a time, waiting for the ACK before starting the next. With bursts
+            # enabled, consecutive accesses are chained into registered feedback bursts within one cycle.
+            with m.FSM(name="wishbone") as wishbone_fsm:
+                with m.State("IDLE"):
+                    with m.If(write_start):
+                        m.d.comb += write_taken.eq(1)
+                        m.d.sync += interface.dat_w.eq(value)
+                        m.d.sync += interface.adr.eq(address)
+                        m.d.sync += interface.we.eq(1)
+                        m.d.sync += interface.sel.eq(write_sel)
+                        m.d.sync += interface.cyc.eq(1)
+                        m.d.sync += interface.stb.eq(1)
+                        # move on as soon as the write is taken, as in pipelined mode, so the next record's WADDR
+                        # can't be overwritten by a late ACK
+                        with m.If(write_inc):
+                            m.d.sync += address.eq(address + 1)
+                        if self._bursts:
+                            m.d.sync += interface.cti.eq(write_cti)
+                            m.d.sync += interface.bte.eq(BurstTypeExt.LINEAR)
+                        m.next = "WRITE"
+                    with m.Elif(read_start):
+                        m.d.comb += read_taken.eq(1)
+                        m.d.sync += interface.adr.eq(value)
+                        m.d.sync += interface.we.eq(0)
+                        m.d.sync += interface.sel.eq(~0)
+                        m.d.sync += interface.cyc.eq(1)
+                        m.d.sync += interface.stb.eq(1)
+                        if self._bursts:
+                            m.d.sync += interface.cti.eq(read_cti)
+                            m.d.sync += interface.bte.eq(BurstTypeExt.LINEAR)
+                        m.next = "READ"
+                    with m.Elif(~cycle_hold):
+                        # a held cycle ended by an empty record
+                        m.d.sync += interface.cyc.eq(0)
+                        m.d.sync += interface.we.eq(0)
+                with m.State("WRITE"):
+                    with m.If(bus_done):
+                        if self._bursts:
+                            burst_next = interface.ack & (interface.cti == CycleType.INCR_BURST)
+                            with m.If(burst_next):
+                                # next beat back to back if it's ready, otherwise insert wait states
+                                with m.If(write_start):
+                                    m.d.comb += write_taken.eq(1)
+                                    m.d.sync += interface.dat_w.eq(value)
+                                    m.d.sync += interface.adr.eq(address)
+                                    m.d.sync += interface.sel.eq(write_sel)
+                                    m.d.sync += interface.cti.eq(write_cti)
+                                    m.d.sync += address.eq(address + 1)
+                                with m.Else():
+                                    m.d.sync += interface.stb.eq(0)
+                                    m.next = "WRITE_WAIT"
+                        else:
+                            burst_next = C(0)
+                        with m.If(~burst_next):
+                            m.d.sync += interface.stb.eq(0)
+                            with m.If(~cycle_hold):
+                                m.d.sync += interface.cyc.eq(0)
+                                m.d.sync += interface.we.eq(0)
+                            m.next = "IDLE"
+                if self._bursts:
+                    with m.State("WRITE_WAIT"):
+                        with m.If(write_start):
+                            m.d.comb += write_taken.eq(1)
+                            m.d.sync += interface.dat_w.eq(value)
+                            m.d.sync += interface.adr.eq(address)
+                            m.d.sync += interface.sel.eq(write_sel)
+                            m.d.sync += interface.cti.eq(write_cti)
+                            m.d.sync += interface.stb.eq(1)
+                            with m.If(write_inc):
+                                m.d.sync += address.eq(address + 1)
+                            m.next = "WRITE"
+                with m.State("READ"):
+                    with m.If(bus_done):
+                        # latch value into output FIFO
+                        with m.If(interface.ack):
+                            m.d.sync += output_fifo.w_data.eq(interface.dat_r)
+                        with m.Else():
+                            m.d.sync += output_fifo.w_data.eq(0xDEADDEAD)
+                        m.d.sync += output_fifo.w_en.eq(1)
+                        with m.If(read_inc):
+                            m.d.sync += address.eq(address + 1)
+                        if self._bursts:
+                            burst_next = interface.ack & (interface.cti == CycleType.INCR_BURST)
+                            with m.If(burst_next):
+                                with m.If(read_start):
+                                    m.d.comb += read_taken.eq(1)
+                                    m.d.sync += interface.adr.eq(value)
+                                    m.d.sync += interface.cti.eq(read_cti)
+                                with m.Else():
+                                    m.d.sync += interface.stb.eq(0)
+                                    m.next = "READ_WAIT"
+                        else:
+                            burst_next = C(0)
+                        with m.If(~burst_next):
+                            m.d.sync += interface.stb.eq(0)
+                            with m.If(~cycle_hold):
+                                m.d.sync += interface.cyc.eq(0)
+                            m.next = "IDLE"
+                if self._bursts:
+                    with m.State("READ_WAIT"):
+                        with m.If(read_start):
+                            m.d.comb += read_taken.eq(1)
+                            m.d.sync += interface.adr.eq(value)
+                            m.d.sync += interface.cti.eq(read_cti)
+                            m.d.sync += interface.stb.eq(1)
+                            m.next = "READ"
+            m.d.comb += read_busy.eq(wishbone_fsm.ongoing("READ") | 
+                    (wishbone_fsm.ongoing("READ_WAIT") if self._bursts else C(0)))
                 
         # STEP 4: Return any read responses
         # Need RFF and RCount in this chunk - make that the first word
@@ -353,6 +606,8 @@ class UDPTherbone(Elaboratable):
                     m.d.sync += source.data.eq(output_header[:8])
                     m.d.sync += output_offset.eq(1)
                     m.d.sync += source.sop.eq(1)
+                    # header, base address and one word per read
+                    m.d.sync += self.length.eq(len(output_header) // 8 + (output_fifo.r_data[:8] + 1) * (alignment // 8))
                     m.next = "HEADER"
             with m.State("HEADER"):
                 # reads are allowed in two cases - we have an output_offset already, or there's a word in the FIFO
@@ -419,7 +674,7 @@ class UDPTherbone(Elaboratable):
                             m.d.sync += output_count.eq(output_count - 1)
                             m.d.sync += output_value.eq(output_fifo.r_data)
                             m.d.sync += output_fifo.r_en.eq(1)
-                            m.d.sync += source.data.eq(output_value.word_select((alignment // 8) - 1, 8))
+                            m.d.sync += source.data.eq(output_fifo.r_data.word_select((alignment // 8) - 1, 8))
                             m.d.sync += output_offset.eq((alignment // 8) - 1)
                             m.next = "DATA"
 